@@ -1,23 +1,48 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file, abort, Response, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file, abort, Response, session, g, stream_with_context, has_request_context, has_app_context
 from flask_wtf.csrf import generate_csrf
+from sqlalchemy import and_, or_, update, delete, case, func, select, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from models import db, User, Topic, Message, Relationship, Reward, ForcedIdentity, RelationshipMessage, AuditLog, BreakingNews
-from models import PrivateChat, PrivateMessage, RelationshipForcedIdentity
-from werkzeug.security import generate_password_hash, check_password_hash
-from utils import save_image, save_voice, format_timestamp
+from models import PrivateChat, PrivateMessage, RelationshipForcedIdentity, MediaObject, MessageReaction, ReactionCount
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.middleware.proxy_fix import ProxyFix
+from utils import is_image, store_image, save_voice, format_timestamp, image_variant_path, voice_render_path, remove_media, is_content_addressed
 from config import Config
+from realtime import BroadcastHub, ChangeBatcher, make_broker, parse_frame
+from sqlite_tuning import configure_sqlite_engine, sqlite_pragmas
+from ratelimit import SlidingWindowLimiter
+from media import MediaProcessor
+import search as search_index
+import voice as voice_fx
+from uploads import UploadRequest
+from presence import PresenceBuffer, ActivityWindow, TTLCache, Janitor, utc_timestamp, from_utc_timestamp
 import os
 import json
 from datetime import datetime
+from urllib.parse import urlsplit
 from functools import wraps
 from datetime import timedelta
 import traceback
 import uuid
 import threading
+import time
+import base64
+import atexit
+import mimetypes
+import heapq
+import html
+from collections import Counter
 import os as _os
-import queue
 app = Flask(__name__)
 app.config.from_object(Config)
+if app.config.get('PROXY_FIX_X_FOR'):
+    # request.remote_addr is the client, not the proxy (rate limits and logs depend on it)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'], x_proto=app.config['PROXY_FIX_X_FOR'])
+# uploads are streamed to disk, hashed and type-checked while the body is parsed
+app.request_class = UploadRequest
 
 # Redis presence client will be initialized after app config is loaded
 _redis_client = None
@@ -33,6 +58,15 @@ except Exception:
     _redis_client = None
     USE_REDIS_PRESENCE = False
 
+# Optional WebSocket transport (flask-sock); the HTTP endpoints remain the fallback
+try:
+    from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
+    sock = Sock(app) if app.config.get('WEBSOCKET_ENABLED', True) else None
+except Exception:
+    sock = None
+    ConnectionClosed = Exception
+
 def admin_required(f=None, min_level=1):
     """
     Decorator to require admin access.
@@ -76,6 +110,47 @@ def admin_required(f=None, min_level=1):
     return decorator
 
 db.init_app(app)
+# FTS5 message search indexes are created and dropped with the tables (see search.py)
+search_index.register(db.metadata)
+
+# GET views that also write; their transactions take the write lock up front like POSTs
+SQLITE_WRITE_GET_ENDPOINTS = {'private_chat', 'my_private_chat', 'chat_socket'}
+# POST views that only read (heartbeats, the message poll, stream subscriptions); they must not
+# queue behind message inserts for a write lock they never use
+SQLITE_READ_POST_ENDPOINTS = {'api_ping', 'api_room_ping', 'api_new_messages', 'stream_subscribe'}
+# POST views that receive uploads: the request body may take a long time to arrive, so they
+# stay DEFERRED while it is parsed and call begin_write() right before their writes
+SQLITE_UPLOAD_ENDPOINTS = {'send_message', 'send_relationship_message'}
+
+
+def sqlite_begin_mode():
+    """BEGIN mode for the next SQLite transaction (see SQLITE_BEGIN_MODE)."""
+    mode = app.config.get('SQLITE_BEGIN_MODE', 'auto')
+    if mode != 'auto':
+        return mode
+    if not has_request_context():
+        return 'IMMEDIATE'
+    if g.get('sqlite_begin_mode'):
+        return g.sqlite_begin_mode
+    # Read-only requests stay DEFERRED so page loads keep reading concurrently under WAL
+    if request.method in ('GET', 'HEAD', 'OPTIONS') and request.endpoint not in SQLITE_WRITE_GET_ENDPOINTS:
+        return 'DEFERRED'
+    if request.endpoint in SQLITE_READ_POST_ENDPOINTS or request.endpoint in SQLITE_UPLOAD_ENDPOINTS:
+        return 'DEFERRED'
+    return 'IMMEDIATE'
+
+
+def begin_write():
+    """End the request's read transaction (e.g. the login lookup); the next one takes the write lock.
+
+    Call once the request body has been read, so a slow upload never holds the lock.
+    """
+    db.session.rollback()
+    g.sqlite_begin_mode = 'IMMEDIATE'
+
+
+with app.app_context():
+    configure_sqlite_engine(db.engine, sqlite_pragmas(app.config), begin_mode=sqlite_begin_mode)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -86,43 +161,154 @@ login_manager.login_message_category = 'info'
 ROOM_PRESENCE = {}
 ROOM_PRESENCE_LOCK = threading.Lock()
 
-# Simple in-memory SSE subscribers: room_key -> list of queue.Queue
-ROOM_SUBSCRIBERS = {}
-ROOM_SUBSCRIBERS_LOCK = threading.Lock()
-
-# Simple in-memory rate limiter for starting admin chats
-# Limits are per-user and stored in memory (suitable for single-process dev/low-traffic use)
-ADMIN_CHAT_ATTEMPTS = {}
-ADMIN_CHAT_LOCK = threading.Lock()
-ADMIN_CHAT_LIMIT = 3        # max attempts
-ADMIN_CHAT_WINDOW = 10 * 60  # window in seconds (10 minutes)
-
-def _prune_attempts(attempts, now_ts):
-    # remove timestamps older than window
-    cutoff = now_ts - ADMIN_CHAT_WINDOW
-    while attempts and attempts[0] < cutoff:
-        attempts.pop(0)
-
-def check_admin_chat_rate_limit(user_id):
-    now_ts = int(datetime.utcnow().timestamp())
-    with ADMIN_CHAT_LOCK:
-        attempts = ADMIN_CHAT_ATTEMPTS.setdefault(user_id, [])
-        # keep attempts sorted; remove old
-        _prune_attempts(attempts, now_ts)
-        if len(attempts) >= ADMIN_CHAT_LIMIT:
-            return False, ADMIN_CHAT_WINDOW - (now_ts - attempts[0])
-        attempts.append(now_ts)
-        return True, None
+# SSE fan-out hub: room_key -> open /stream subscribers in this process
+SSE_HUB = BroadcastHub(
+    max_pending=app.config.get('SSE_QUEUE_MAX', 256),
+    coalesce=app.config.get('SSE_OVERFLOW_POLICY', 'coalesce') == 'coalesce',
+    grace=app.config.get('SSE_SLOW_CONSUMER_GRACE', 30),
+    replay_size=app.config.get('SSE_REPLAY_SIZE', 200),
+    # per-stream control rooms are not worth replaying
+    replay_exclude=('stream:',),
+)
+# Comment frames sent on idle streams so proxies keep the connection open
+SSE_HEARTBEAT_SECONDS = app.config.get('SSE_HEARTBEAT_SECONDS', 15)
+SSE_PRESENCE_SECONDS = app.config.get('SSE_PRESENCE_SECONDS', 30)  # active-count refresh on /stream/multi
+SSE_MAX_ROOMS = 50  # rooms per multiplexed stream
+ACTIVE_COUNTS_MAX_IDS = 500  # ids per kind accepted by /api/active_counts
+
+# Broadcast backend carries room events between gunicorn workers/nodes (Redis pub/sub when
+# REDIS_URL is set, else a shared SQLite event log in the instance folder)
+os.makedirs(app.instance_path, exist_ok=True)
+SSE_BROKER = make_broker(
+    SSE_HUB,
+    backend=app.config.get('BROADCAST_BACKEND', 'auto'),
+    redis_client=_redis_client,
+    sqlite_path=os.path.join(app.instance_path, 'room_events.db'),
+    poll_interval=app.config.get('BROADCAST_POLL_INTERVAL', 0.2),
+    logger=app.logger,
+)
+
+
+_PRESENCE_UPDATE = (update(User.__table__)
+                    .where(User.__table__.c.id == bindparam('user_id'))
+                    .values(last_login=bindparam('seen')))
+
+
+def _write_presence(rows):
+    with app.app_context():
+        # Core executemany, one statement for the whole batch; unlike the ORM bulk UPDATE it
+        # doesn't check row counts, so a user deleted since their heartbeat is simply skipped
+        db.session.execute(_PRESENCE_UPDATE, [{'user_id': r['id'], 'seen': r['last_login']} for r in rows])
+        db.session.commit()
+
+
+# Heartbeats update last_login through this write-behind buffer instead of a commit per ping
+PRESENCE = PresenceBuffer(
+    _write_presence,
+    interval=app.config.get('PRESENCE_FLUSH_SECONDS', 15),
+    redis_client=_redis_client if USE_REDIS_PRESENCE else None,
+    logger=app.logger,
+)
+atexit.register(PRESENCE.stop)
+
+# Active-user counts are answered from sliding windows fed by pings and posts; each key is
+# re-seeded from the DB/presence store every ACTIVE_COUNT_RESEED_SECONDS to pick up other workers
+GLOBAL_ACTIVITY_KEY = '*'
+ACTIVITY = ActivityWindow(lambda: get_active_window_minutes() * 60)
+ACTIVE_COUNT_CACHE = TTLCache(app.config.get('ACTIVE_COUNT_CACHE_SECONDS', 5))
+ACTIVE_COUNT_RESEED_SECONDS = app.config.get('ACTIVE_COUNT_RESEED_SECONDS', 60)
+# How long room presence is kept in Redis (and the TTL of an idle room's key)
+PRESENCE_REDIS_RETENTION_SECONDS = app.config.get('PRESENCE_REDIS_RETENTION_SECONDS', 3600)
+
+# Per-route rate limits (see RATE_LIMITS in config.py); shared across workers when Redis is configured
+RATE_LIMITER = SlidingWindowLimiter(redis_client=_redis_client, logger=app.logger)
+RATE_LIMITS = app.config.get('RATE_LIMITS', {})
+
+
+def rate_limit_client():
+    """Who a hit is charged to: the logged-in user, else the client address."""
+    if current_user.is_authenticated:
+        return f"user:{current_user.id}"
+    return f"ip:{request.remote_addr}"
+
+
+def check_rate_limit(bucket, client=None):
+    """Charge one hit to RATE_LIMITS[bucket]; returns seconds to wait if over budget, else None."""
+    budget = RATE_LIMITS.get(bucket)
+    if not budget or not app.config.get('RATE_LIMIT_ENABLED', True):
+        return None
+    JANITOR.start()
+    allowed, retry_after = RATE_LIMITER.hit(f"{bucket}:{client or rate_limit_client()}", *budget)
+    return None if allowed else retry_after
+
+
+def login_rate_limit_key(username):
+    # per account and address, so one proxy or campus network doesn't share a single budget
+    return f"login:{username.strip().lower()}|ip:{request.remote_addr}"
+
+
+def login_retry_after(username):
+    """Seconds to wait if username has used up its failed logins from this address, else None."""
+    budget = RATE_LIMITS.get('login')
+    if not budget or not app.config.get('RATE_LIMIT_ENABLED', True):
+        return None
+    return RATE_LIMITER.retry_after(login_rate_limit_key(username), *budget)
+
+
+def record_failed_login(username):
+    """Charge a failed attempt to the login budget; successful logins are free."""
+    budget = RATE_LIMITS.get('login')
+    if not budget or not app.config.get('RATE_LIMIT_ENABLED', True):
+        return
+    JANITOR.start()
+    RATE_LIMITER.hit(login_rate_limit_key(username), *budget)
+
+
+def rate_limited_response(retry_after, message='Too many requests, please slow down'):
+    response = jsonify({'status': 'error', 'message': message, 'code': 'rate_limited', 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def rate_limit(bucket):
+    """Route decorator: answer 429 once the caller has used up RATE_LIMITS[bucket]."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            retry_after = check_rate_limit(bucket)
+            if retry_after is not None:
+                return rate_limited_response(retry_after)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
 
 def _presence_redis_key(room_key):
-    return f"presence:{room_key}"
+    # sorted set per room: member = user id, score = last seen (UTC epoch seconds)
+    return f"presence:room:{room_key}"
+
+
+def _presence_retention_seconds():
+    # never trim entries that are still inside the active window
+    return max(PRESENCE_REDIS_RETENTION_SECONDS, get_active_window_minutes() * 60)
+
 
 def add_presence(room_key, user_id, ts):
     """Record presence for a user in a room. Uses Redis if configured, else in-memory dict."""
+    JANITOR.start()
+    ACTIVITY.touch(room_key, user_id, ts)
     if USE_REDIS_PRESENCE and _redis_client:
-        # Store as timestamp seconds in a hash
+        key = _presence_redis_key(room_key)
+        score = utc_timestamp(ts)
+        retention = _presence_retention_seconds()
         try:
-            _redis_client.hset(_presence_redis_key(room_key), user_id, int(ts.timestamp()))
+            # one round trip: record, trim expired members, and refresh the TTL so idle rooms expire
+            pipe = _redis_client.pipeline(transaction=False)
+            pipe.zadd(key, {str(user_id): score})
+            pipe.zremrangebyscore(key, '-inf', utc_timestamp(datetime.utcnow()) - retention)
+            pipe.expire(key, int(retention))
+            pipe.execute()
         except Exception:
             pass
     else:
@@ -131,12 +317,73 @@ def add_presence(room_key, user_id, ts):
             bucket[user_id] = ts
 
 
-def add_sse_subscriber(room_key):
-    q = queue.Queue()
-    with ROOM_SUBSCRIBERS_LOCK:
-        lst = ROOM_SUBSCRIBERS.setdefault(room_key, [])
-        lst.append(q)
-    return q
+def _sweep_room_presence():
+    # in-memory room presence past the active window is never read again
+    cutoff = datetime.utcnow() - timedelta(minutes=get_active_window_minutes())
+    reclaimed = 0
+    with ROOM_PRESENCE_LOCK:
+        for room_key in list(ROOM_PRESENCE):
+            bucket = ROOM_PRESENCE[room_key]
+            for uid in [uid for uid, ts in bucket.items() if ts < cutoff]:
+                del bucket[uid]
+                reclaimed += 1
+            if not bucket:
+                del ROOM_PRESENCE[room_key]
+        held = sum(len(bucket) for bucket in ROOM_PRESENCE.values())
+    return reclaimed, held
+
+
+# Periodic cleanup of per-process presence and rate-limit state; see /admin/memory_stats
+JANITOR = Janitor(interval=app.config.get('JANITOR_INTERVAL_SECONDS', 60), logger=app.logger)
+JANITOR.add('room_presence', _sweep_room_presence)
+JANITOR.add('activity_windows', ACTIVITY.sweep)
+JANITOR.add('active_count_cache', ACTIVE_COUNT_CACHE.sweep)
+JANITOR.add('rate_limits', RATE_LIMITER.sweep)
+atexit.register(JANITOR.stop)
+
+# Uploaded images are stored as received and resized/re-encoded off the request thread
+IMAGE_PROCESSOR = MediaProcessor(
+    mode=app.config.get('IMAGE_PROCESSING', 'process'),
+    workers=app.config.get('IMAGE_WORKERS', 2),
+    options={
+        'sizes': app.config.get('IMAGE_SIZES', {'full': 1200}),
+        'quality': app.config.get('IMAGE_QUALITY', 85),
+        'webp': app.config.get('IMAGE_WEBP', True),
+    },
+    logger=app.logger,
+)
+atexit.register(IMAGE_PROCESSOR.shutdown)
+
+# Voice notes sent with a voice_type get that effect rendered once, off the request thread
+VOICE_EFFECTS_ENABLED = app.config.get('VOICE_EFFECTS', True) and voice_fx.available()
+if app.config.get('VOICE_EFFECTS', True) and not VOICE_EFFECTS_ENABLED:
+    app.logger.info('Voice effects need numpy and ffmpeg; voice notes are played as uploaded')
+VOICE_PROCESSOR = MediaProcessor(
+    kind='voice',
+    mode=app.config.get('VOICE_PROCESSING', 'process'),
+    workers=app.config.get('VOICE_WORKERS', 1),
+    options={
+        'max_seconds': app.config.get('VOICE_MAX_SECONDS', 120),
+        'bitrate': app.config.get('VOICE_BITRATE', '32k'),
+    },
+    process_fn=voice_fx.render_voice,
+    logger=app.logger,
+)
+atexit.register(VOICE_PROCESSOR.shutdown)
+
+
+def add_sse_subscriber(room_key, last_event_id=None):
+    # Only processes with live subscribers need to listen for broadcasts
+    SSE_BROKER.start()
+    return SSE_HUB.subscribe(room_key, last_event_id=last_event_id)
+
+def get_last_event_id():
+    """Last-Event-ID sent by a reconnecting EventSource (header, or ?last_event_id= for manual reconnects)."""
+    raw = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        return int(raw) if raw else None
+    except (TypeError, ValueError):
+        return None
 
 def user_has_unlocked(room_key):
     try:
@@ -176,52 +423,109 @@ def is_user_allowed(target, t, user):
 
     return False
 
-def remove_sse_subscriber(room_key, q):
-    with ROOM_SUBSCRIBERS_LOCK:
-        lst = ROOM_SUBSCRIBERS.get(room_key)
-        if not lst:
-            return
-        try:
-            lst.remove(q)
-        except ValueError:
-            pass
+def remove_sse_subscriber(room_key, sub):
+    SSE_HUB.unsubscribe(sub)
 
-def publish_to_room(room_key, payload):
-    """Publish payload (dict) to all SSE subscribers for room_key."""
-    data = json.dumps(payload, default=str)
-    with ROOM_SUBSCRIBERS_LOCK:
-        lst = list(ROOM_SUBSCRIBERS.get(room_key, []))
-    for q in lst:
-        try:
-            q.put(data, block=False)
-        except Exception:
-            # if queue is full or closed, ignore
-            continue
-def get_presence_users(room_key, since_dt):
-    """Return a set of user_ids who have presence timestamps >= since_dt."""
-    result = set()
+def publish_to_room(room_key, payload, coalesce_key=None):
+    """Publish payload (dict) to SSE subscribers for room_key in every worker. The payload is serialized once.
+
+    Events sharing a coalesce_key (e.g. reaction updates for one message) replace each
+    other in a slow subscriber's queue instead of piling up.
+    """
+    # multiplexed streams need to know which room an event belongs to
+    data = json.dumps(dict(payload, room=room_key), default=str)
+    try:
+        SSE_BROKER.publish(room_key, data, coalesce_key)
+    except Exception:
+        # Broker unavailable: still reach subscribers in this process
+        app.logger.exception('Broadcast backend publish failed; delivering locally')
+        SSE_HUB.publish_raw(room_key, data, coalesce_key)
+
+def _reaction_events(message_ids):
+    """{message_id: reactions event} with the current counts of each message, from one query."""
+    with app.app_context():
+        counts = {}
+        rows = db.session.query(ReactionCount.message_id, ReactionCount.emoji, ReactionCount.count).filter(
+            ReactionCount.message_id.in_(message_ids), ReactionCount.count > 0)
+        for message_id, emoji, count in rows:
+            counts.setdefault(message_id, {})[emoji] = count
+        db.session.remove()
+    return {mid: {'type': 'reactions', 'message_id': mid, 'counts': counts.get(mid, {})} for mid in message_ids}
+
+
+# Reaction toggles mark their message here; each message's counts are broadcast at most once per
+# REACTION_BROADCAST_WINDOW, so a burst of likes on one post becomes a few events, not one per click
+REACTION_EVENTS = ChangeBatcher(
+    _reaction_events,
+    publish_to_room,
+    window=app.config.get('REACTION_BROADCAST_WINDOW', 0.5),
+    key_prefix='reactions:',
+    logger=app.logger,
+)
+atexit.register(REACTION_EVENTS.stop)
+
+def publish_unread_delta(room_key, delta, chat_id=None):
+    """Tell multiplexed streams listening on room_key to adjust their unread private message badge."""
+    if not delta:
+        return
+    try:
+        publish_to_room(room_key, {'type': 'unread', 'delta': delta, 'chat_id': chat_id})
+    except Exception:
+        app.logger.exception('Failed to publish unread delta')
+
+def get_presence_entries_many(room_keys, since_dt):
+    """Return {room_key: {user_id: last presence timestamp}} for timestamps >= since_dt.
+
+    With Redis all rooms are read in one pipelined round trip.
+    """
+    room_keys = list(room_keys)
+    result = {key: {} for key in room_keys}
     if USE_REDIS_PRESENCE and _redis_client:
+        since = utc_timestamp(since_dt)
         try:
-            raw = _redis_client.hgetall(_presence_redis_key(room_key))
-            for k, v in raw.items():
-                try:
-                    uid = int(k.decode() if isinstance(k, bytes) else k)
-                    ts = int(v.decode() if isinstance(v, bytes) else v)
-                    if datetime.utcfromtimestamp(ts) >= since_dt:
-                        result.add(uid)
-                except Exception:
-                    continue
+            pipe = _redis_client.pipeline(transaction=False)
+            for key in room_keys:
+                # only members inside the window leave Redis
+                pipe.zrangebyscore(_presence_redis_key(key), since, '+inf', withscores=True)
+            replies = pipe.execute()
         except Exception:
-            return set()
+            return result
+        for key, rows in zip(room_keys, replies):
+            for member, score in rows or ():
+                uid = member.decode() if isinstance(member, bytes) else str(member)
+                result[key][uid] = from_utc_timestamp(score)
     else:
         with ROOM_PRESENCE_LOCK:
-            bucket = ROOM_PRESENCE.get(room_key, {})
-            for uid, ts in bucket.items():
-                if ts >= since_dt:
-                    result.add(uid)
+            for key in room_keys:
+                for uid, ts in ROOM_PRESENCE.get(key, {}).items():
+                    if ts >= since_dt:
+                        result[key][uid] = ts
     return result
 
 
+def count_presence_many(room_keys, since_dt):
+    """Return {room_key: users present since since_dt} from Redis with one pipelined ZCOUNT per room.
+
+    Raises if Redis is unavailable; callers fall back to the local activity windows.
+    """
+    room_keys = list(room_keys)
+    since = utc_timestamp(since_dt)
+    pipe = _redis_client.pipeline(transaction=False)
+    for key in room_keys:
+        pipe.zcount(_presence_redis_key(key), since, '+inf')
+    return dict(zip(room_keys, (int(n) for n in pipe.execute())))
+
+
+def get_presence_entries(room_key, since_dt):
+    """Return {user_id: last presence timestamp} for presence timestamps >= since_dt."""
+    return get_presence_entries_many([room_key], since_dt)[room_key]
+
+
+def get_presence_users(room_key, since_dt):
+    """Return a set of user_ids who have presence timestamps >= since_dt."""
+    return set(get_presence_entries(room_key, since_dt))
+
+
 @app.context_processor
 def inject_csrf_token():
     # Make generate_csrf available in all templates as csrf_token()
@@ -294,66 +598,94 @@ def save_user_settings(user_id, data):
 def get_active_window_minutes():
     return int(INSTANCE_SETTINGS.get('active_window_minutes', 5))
 
-def compute_global_active_count():
+def active_since_clause(window):
+    """Filter for users active since window: a flushed last_login or a heartbeat still in PRESENCE."""
+    clause = and_(User.last_login != None, User.last_login >= window)
+    buffered = list(PRESENCE.seen_since(window))
+    if buffered:
+        clause = or_(clause, User.id.in_(buffered))
+    return clause
+
+
+def effective_last_login(user):
+    """user.last_login, or a newer heartbeat that has not been flushed yet."""
+    buffered = PRESENCE.last_seen(user.id)
+    if buffered and (not user.last_login or buffered > user.last_login):
+        return buffered
+    return user.last_login
+
+
+def note_activity(user, room_key=None, ts=None):
+    """Feed the active-user windows: user is active now (globally, and in room_key if given)."""
+    ts = ts or datetime.utcnow()
+    JANITOR.start()
+    # the global count only includes approved users
+    if getattr(user, 'status', None) == 'approved':
+        ACTIVITY.touch(GLOBAL_ACTIVITY_KEY, user.id, ts)
+    if room_key:
+        add_presence(room_key, user.id, ts)
+
+
+def _seed_global_activity():
     # Users with last_login within the window are considered active
     window = datetime.utcnow() - timedelta(minutes=get_active_window_minutes())
     # Only count approved users (and admins) to avoid counting pending/blocked/service accounts
-    return User.query.filter(User.last_login != None, User.last_login >= window, (User.status == 'approved')).count()
+    rows = User.query.with_entities(User.id, User.last_login).filter(
+        active_since_clause(window), (User.status == 'approved')).all()
+    buffered = PRESENCE.seen_since(window)
+    ACTIVITY.merge(GLOBAL_ACTIVITY_KEY, {uid: max(filter(None, (last, buffered.get(uid)))) for uid, last in rows})
 
-def compute_chat_active_count(chat_id):
+
+def _room_active_count(room_key):
+    return compute_room_active_counts([room_key]).get(room_key, 0)
+
+
+def compute_global_active_count():
+    """Approved users active within the window, from memory; cached for a few seconds."""
+    def compute():
+        if ACTIVITY.needs_seed(GLOBAL_ACTIVITY_KEY, ACTIVE_COUNT_RESEED_SECONDS):
+            _seed_global_activity()
+        return ACTIVITY.count(GLOBAL_ACTIVITY_KEY)
+    return ACTIVE_COUNT_CACHE.get(GLOBAL_ACTIVITY_KEY, compute)
+
+def compute_chat_active_counts(chat_ids):
+    """Return {chat_id: active participants} for private chats using two queries in total."""
+    chat_ids = list(chat_ids)
+    counts = {cid: 0 for cid in chat_ids}
+    if not chat_ids:
+        return counts
     # For PrivateChat, active participant is the user and possibly admin
-    chat = PrivateChat.query.get(chat_id)
-    if not chat:
-        return 0
-    user_ids = [chat.user_id]
-    if chat.admin_id:
-        user_ids.append(chat.admin_id)
+    chats = PrivateChat.query.with_entities(PrivateChat.id, PrivateChat.user_id, PrivateChat.admin_id).filter(
+        PrivateChat.id.in_(chat_ids)).all()
+    participants = {uid for c in chats for uid in (c.user_id, c.admin_id) if uid}
+    if not participants:
+        return counts
     window = datetime.utcnow() - timedelta(minutes=get_active_window_minutes())
-    # For private chats, include the chat owner even if their status isn't 'approved'
-    return User.query.filter(User.id.in_(user_ids), User.last_login != None, User.last_login >= window, ((User.status == 'approved') | (User.id == chat.user_id))).count()
+    active = dict(User.query.with_entities(User.id, User.status).filter(
+        User.id.in_(participants), active_since_clause(window)).all())
+    for c in chats:
+        # For private chats, include the chat owner even if their status isn't 'approved'
+        counts[c.id] = sum(1 for uid in {c.user_id, c.admin_id}
+                           if uid in active and (active[uid] == 'approved' or uid == c.user_id))
+    return counts
 
 
-def compute_topic_active_count(topic_id):
-    """Return count of distinct users who have messages in the topic and are active within the window.
+def compute_chat_active_count(chat_id):
+    return compute_chat_active_counts([chat_id]).get(chat_id, 0)
 
-    We count users who have at least one message in the topic and whose last_login is within the active window.
-    This provides a reasonable approximation of "active in this topic" without adding new DB fields.
-    """
+
+def compute_topic_active_count(topic_id):
+    """Return count of distinct users who pinged or posted in the topic within the active window."""
     try:
-        window = datetime.utcnow() - timedelta(minutes=get_active_window_minutes())
-        # Users who have posted in the topic
-        user_rows = db.session.query(Message.user_id).filter(Message.topic_id == topic_id).distinct().all()
-        message_user_ids = {r[0] for r in user_rows}
-
-        # Users who have an active presence ping in this topic
-        presence_key = f"topic:{topic_id}"
-        presence_users = get_presence_users(presence_key, window)
-
-        # Combine and filter by last_login and approved status
-        combined_ids = message_user_ids.union(presence_users)
-        if not combined_ids:
-            return 0
-        return User.query.filter(User.id.in_(combined_ids), User.last_login != None, User.last_login >= window, (User.status == 'approved')).count()
+        return _room_active_count(f"topic:{topic_id}")
     except Exception:
         return 0
 
 
 def compute_relationship_active_count(relationship_id):
-    """Return count of distinct users who have messages in the relationship chat and are active within the window."""
+    """Return count of distinct users who pinged or posted in the relationship chat within the active window."""
     try:
-        window = datetime.utcnow() - timedelta(minutes=get_active_window_minutes())
-        # Users who have posted in the relationship chat
-        user_rows = db.session.query(RelationshipMessage.user_id).filter(RelationshipMessage.relationship_id == relationship_id).distinct().all()
-        message_user_ids = {r[0] for r in user_rows}
-
-        # Presence-based users
-        presence_key = f"relationship:{relationship_id}"
-        presence_users = get_presence_users(presence_key, window)
-
-        combined_ids = message_user_ids.union(presence_users)
-        if not combined_ids:
-            return 0
-        return User.query.filter(User.id.in_(combined_ids), User.last_login != None, User.last_login >= window, (User.status == 'approved')).count()
+        return _room_active_count(f"relationship:{relationship_id}")
     except Exception:
         return 0
 
@@ -363,13 +695,40 @@ def compute_relationship_active_count(relationship_id):
 @admin_required
 def active_users_debug():
     window = datetime.utcnow() - timedelta(minutes=get_active_window_minutes())
-    users = User.query.filter(User.last_login != None, User.last_login >= window).all()
+    users = User.query.filter(active_since_clause(window)).all()
     result = []
     for u in users:
-        result.append({'id': u.id, 'name': u.name, 'username': u.username, 'status': u.status, 'last_login': u.last_login.isoformat() if u.last_login else None})
+        last_login = effective_last_login(u)
+        result.append({'id': u.id, 'name': u.name, 'username': u.username, 'status': u.status, 'last_login': last_login.isoformat() if last_login else None})
     return jsonify({'status': 'success', 'active_window_minutes': get_active_window_minutes(), 'count': len(result), 'users': result})
 
 
+@app.route('/admin/sse_stats')
+@login_required
+@admin_required
+def sse_stats():
+    stats = SSE_HUB.stats()
+    counts = stats['subscribers']
+    return jsonify({
+        'status': 'success',
+        'backend': SSE_BROKER.name,
+        'total_subscribers': sum(counts.values()),
+        'rooms': counts,
+        'dropped_events': stats['dropped'],
+        'evicted_subscribers': stats['evicted'],
+        'reaction_changes': REACTION_EVENTS.marked,
+        'reaction_events': REACTION_EVENTS.published,
+    })
+
+
+@app.route('/admin/memory_stats')
+@login_required
+@admin_required
+def memory_stats():
+    """Entries held and reclaimed by the janitor's periodic sweeps."""
+    return jsonify({'status': 'success', **JANITOR.stats()})
+
+
 @app.route('/admin/active_users_debug_full')
 @login_required
 @admin_required
@@ -381,9 +740,10 @@ def active_users_debug_full():
     counted = 0
     status_counts = {}
     for u in all_users:
-        last_login_iso = u.last_login.isoformat() if u.last_login else None
+        last_login = effective_last_login(u)
+        last_login_iso = last_login.isoformat() if last_login else None
         last_login_recent = False
-        if u.last_login and u.last_login >= window:
+        if last_login and last_login >= window:
             last_login_recent = True
         # counted by global rule: status == 'approved' and last_login within window
         is_counted = (u.status == 'approved') and last_login_recent
@@ -439,6 +799,10 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        retry_after = login_retry_after(username)
+        if retry_after is not None:
+            flash(f'Too many login attempts. Try again in {retry_after} seconds.')
+            return render_template('login.html'), 429
         user = User.query.filter_by(username=username).first()
         
         if user and check_password_hash(user.password, password):
@@ -446,6 +810,7 @@ def login():
             user.last_login = datetime.utcnow()
             db.session.commit()
             login_user(user)
+            note_activity(user, ts=user.last_login)
             
             # Get the next page from query string
             next_page = request.args.get('next')
@@ -463,6 +828,7 @@ def login():
                 flash('Your account is pending approval')
                 return render_template('pending.html')
         
+        record_failed_login(username)
         flash('Invalid credentials')
     return render_template('login.html')
 
@@ -473,6 +839,10 @@ def admin_login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        retry_after = login_retry_after(username)
+        if retry_after is not None:
+            flash(f'Too many login attempts. Try again in {retry_after} seconds.')
+            return render_template('admin_login.html'), 429
         user = User.query.filter_by(username=username).first()
         
         if user and user.is_admin and user.admin_level == 2:  # Check for full admin level
@@ -481,19 +851,29 @@ def admin_login():
                 next_page = request.args.get('next')
                 return redirect(next_page or url_for('admin'))
             else:
+                record_failed_login(username)
                 flash('Invalid admin credentials')
         else:
+            record_failed_login(username)
             flash('Full admin access required')
     return render_template('admin_login.html')
 
 
+def record_heartbeat(room_key=None):
+    """Mark current_user as active now (and present in room_key, if given)."""
+    now = datetime.utcnow()
+    # buffered; PRESENCE writes last_login in batches
+    PRESENCE.touch(current_user.id, now)
+    note_activity(current_user, room_key, now)
+
+
 @app.route('/api/ping', methods=['POST'])
 @login_required
+@rate_limit('ping')
 def api_ping():
     # Update the user's last activity timestamp
     try:
-        current_user.last_login = datetime.utcnow()
-        db.session.commit()
+        record_heartbeat()
         return jsonify({'status': 'success'})
     except Exception:
         return jsonify({'status': 'error'}), 500
@@ -567,56 +947,28 @@ def api_active_counts():
 
         global_count = compute_global_active_count()
 
-        # Support batched ids (comma-separated)
-        topic_ids = request.args.get('topic_ids')
-        relationship_ids = request.args.get('relationship_ids')
-        chat_ids = request.args.get('chat_ids')
-
         response = {'status': 'success', 'global_active': global_count}
 
-        if topic_ids:
-            try:
-                # IDs are stored as string UUIDs in the models; don't cast to int
-                ids = [x.strip() for x in topic_ids.split(',') if x.strip()]
-                response['topic_active'] = {str(i): compute_topic_active_count(i) for i in ids}
-            except Exception:
-                response['topic_active'] = {}
-
-        # single topic_id fallback
-        topic_id = request.args.get('topic_id')
-        if topic_id and 'topic_active' not in response:
-            try:
-                response['topic_active'] = {str(topic_id): compute_topic_active_count(topic_id)}
-            except Exception:
-                response['topic_active'] = {}
-
-        if relationship_ids:
-            try:
-                ids = [x.strip() for x in relationship_ids.split(',') if x.strip()]
-                response['relationship_active'] = {str(i): compute_relationship_active_count(i) for i in ids}
-            except Exception:
-                response['relationship_active'] = {}
-
-        relationship_id = request.args.get('relationship_id')
-        if relationship_id and 'relationship_active' not in response:
-            try:
-                response['relationship_active'] = {str(relationship_id): compute_relationship_active_count(relationship_id)}
-            except Exception:
-                response['relationship_active'] = {}
-
-        if chat_ids:
-            try:
-                ids = [x.strip() for x in chat_ids.split(',') if x.strip()]
-                response['chat_active'] = {str(i): compute_chat_active_count(i) for i in ids}
-            except Exception:
-                response['chat_active'] = {}
+        # Batched ids (comma-separated, e.g. topic_ids=1,2,3) or a single *_id; all rooms are
+        # counted together so the cost doesn't grow with the number of ids
+        room_keys = []
+        requested = {}
+        for kind in ('topic', 'relationship', 'chat'):
+            raw = request.args.get(f'{kind}_ids') or request.args.get(f'{kind}_id')
+            if not raw:
+                continue
+            # IDs are stored as string UUIDs in the models; don't cast to int
+            ids = [x.strip() for x in raw.split(',') if x.strip()][:ACTIVE_COUNTS_MAX_IDS]
+            requested[kind] = ids
+            room_keys.extend(f"{kind}:{i}" for i in ids)
 
-        chat_id = request.args.get('chat_id')
-        if chat_id and 'chat_active' not in response:
-            try:
-                response['chat_active'] = {str(chat_id): compute_chat_active_count(chat_id)}
-            except Exception:
-                response['chat_active'] = {}
+        try:
+            counts = compute_room_active_counts(room_keys)
+        except Exception:
+            app.logger.exception('compute_room_active_counts failed')
+            counts = {}
+        for kind, ids in requested.items():
+            response[f'{kind}_active'] = {i: counts.get(f"{kind}:{i}", 0) for i in ids}
 
         return jsonify(response)
     except Exception:
@@ -625,6 +977,7 @@ def api_active_counts():
 
 @app.route('/api/room_ping', methods=['POST'])
 @login_required
+@rate_limit('ping')
 def api_room_ping():
     # Payload: { type: 'topic'|'relationship'|'chat', id: <id> }
     try:
@@ -643,6 +996,98 @@ def api_room_ping():
         return jsonify({'status': 'error'}), 500
 
 
+# Message history is paged with a keyset cursor on (created_at, id): pages load newest-first and
+# each page hands back a cursor for the next older one, so deep history never needs OFFSET scans.
+MESSAGE_PAGE_SIZE = app.config.get('MESSAGE_PAGE_SIZE', 50)
+MESSAGE_PAGE_MAX = 200
+
+
+def encode_cursor(message):
+    """Opaque cursor pointing at a message's (created_at, id) position."""
+    raw = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (created_at, id) for a cursor, or None if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created, sep, message_id = raw.partition('|')
+        if not sep or not message_id:
+            return None
+        return datetime.fromisoformat(created), message_id
+    except Exception:
+        return None
+
+
+def paginate_messages(query, model, before=None, limit=None):
+    """Return (messages oldest-first, cursor for the next older page or None).
+
+    Loads the newest `limit` rows older than the `before` cursor; raises ValueError for a bad cursor.
+    """
+    try:
+        limit = max(1, min(int(limit or MESSAGE_PAGE_SIZE), MESSAGE_PAGE_MAX))
+    except (TypeError, ValueError):
+        limit = MESSAGE_PAGE_SIZE
+    if before:
+        position = decode_cursor(before)
+        if position is None:
+            raise ValueError('Invalid cursor')
+        created, message_id = position
+        query = query.filter(or_(
+            model.created_at < created,
+            and_(model.created_at == created, model.id < message_id)
+        ))
+    # Authors are joined in so rendering sender names does not issue one SELECT per message
+    rows = (query.options(joinedload(model.user))
+            .order_by(model.created_at.desc(), model.id.desc())
+            .limit(limit + 1).all())
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, next_cursor
+
+
+def users_by_ids(ids):
+    """Return {id: User} for just the given ids, loaded with one IN query."""
+    ids = {i for i in ids if i}
+    if not ids:
+        return {}
+    return {u.id: u for u in User.query.filter(User.id.in_(ids)).all()}
+
+
+def room_message_query(chat_type, chat_id):
+    """Return (query, model, target) for a room's messages, or None for an unknown chat_type."""
+    if chat_type == 'topic':
+        return Message.query.filter(Message.topic_id == chat_id, Message.is_deleted == False), Message, Topic.query.get(chat_id)
+    if chat_type == 'relationship':
+        return RelationshipMessage.query.filter(RelationshipMessage.relationship_id == chat_id), RelationshipMessage, Relationship.query.get(chat_id)
+    if chat_type == 'private':
+        return PrivateMessage.query.filter(PrivateMessage.chat_id == chat_id), PrivateMessage, PrivateChat.query.get(chat_id)
+    return None
+
+
+def history_message(m, chat_type):
+    """Serialize a stored message for client-side rendering, hiding names the page would hide."""
+    user = getattr(m, 'user', None)
+    if not user:
+        sender = 'Unknown'
+    elif chat_type == 'private' or getattr(m, 'identity_revealed', False):
+        sender = user.name
+    else:
+        sender = user.username
+    return {
+        'id': m.id,
+        'content': m.content or '',
+        'sender_name': sender,
+        'is_own': m.user_id == current_user.id,
+        'timestamp': int(m.created_at.timestamp() * 1000) if m.created_at else None,
+        'formatted_time': m.created_at.strftime('%I:%M %p') if m.created_at else '',
+        **image_fields(m),
+        'voice_url': voice_url(m)
+    }
+
+
 @app.route('/api/new_messages', methods=['POST'])
 @login_required
 def api_new_messages():
@@ -668,20 +1113,11 @@ def api_new_messages():
             last_dt = None
 
         # Select query and timestamp field per chat type
-        if chat_type == 'topic':
-            query = Message.query.filter(Message.topic_id == chat_id)
-            time_field = Message.created_at
-            target = Topic.query.get(chat_id)
-        elif chat_type == 'relationship':
-            query = RelationshipMessage.query.filter(RelationshipMessage.relationship_id == chat_id)
-            time_field = RelationshipMessage.created_at
-            target = Relationship.query.get(chat_id)
-        elif chat_type == 'private':
-            query = PrivateMessage.query.filter(PrivateMessage.chat_id == chat_id)
-            time_field = PrivateMessage.created_at
-            target = PrivateChat.query.get(chat_id)
-        else:
+        room = room_message_query(chat_type, chat_id)
+        if room is None:
             return jsonify({'status': 'error', 'message': 'Invalid chat_type'}), 400
+        query, model, target = room
+        time_field = model.created_at
 
         # If the target is locked and the current user is not allowed, deny access
         try:
@@ -694,7 +1130,7 @@ def api_new_messages():
         if last_dt:
             query = query.filter(time_field > last_dt)
 
-        msgs = query.order_by(time_field.asc()).all()
+        msgs = query.options(joinedload(model.user)).order_by(time_field.asc()).all()
 
         formatted = []
         for m in msgs:
@@ -712,6 +1148,144 @@ def api_new_messages():
         app.logger.exception('api_new_messages failed')
         return jsonify({'status': 'error', 'message': 'Server error'}), 500
 
+
+@app.route('/api/older_messages')
+@login_required
+def api_older_messages():
+    """Return one page of history older than a cursor, for infinite scroll.
+
+    Query args: chat_type (topic/relationship/private), chat_id, before (cursor from the page or a
+    previous call; omit for the newest page) and optional limit. Responds with messages oldest-first
+    and next_cursor, which is null once the start of the room is reached.
+    """
+    try:
+        chat_id = request.args.get('chat_id')
+        chat_type = request.args.get('chat_type')
+        if not chat_id or not chat_type:
+            return jsonify({'status': 'error', 'message': 'Missing chat_id or chat_type'}), 400
+
+        room = room_message_query(chat_type, chat_id)
+        if room is None:
+            return jsonify({'status': 'error', 'message': 'Invalid chat_type'}), 400
+        query, model, target = room
+        if target is None:
+            return jsonify({'status': 'error', 'message': 'Chat not found'}), 404
+        room_key = f"{'chat' if chat_type == 'private' else chat_type}:{chat_id}"
+        if not can_subscribe_room(room_key, current_user):
+            return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+
+        try:
+            msgs, next_cursor = paginate_messages(query, model, request.args.get('before'), request.args.get('limit'))
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+
+        return jsonify({
+            'status': 'success',
+            'messages': [history_message(m, chat_type) for m in msgs],
+            'next_cursor': next_cursor
+        })
+    except Exception:
+        app.logger.exception('api_older_messages failed')
+        return jsonify({'status': 'error', 'message': 'Server error'}), 500
+
+SEARCH_KINDS = {'topic': (Message, Topic), 'relationship': (RelationshipMessage, Relationship),
+                'private': (PrivateMessage, PrivateChat)}
+
+
+def denied_room_ids(kind, user):
+    """Ids of locked rooms of a search kind that user has not been let into (see can_subscribe_room)."""
+    if getattr(user, 'is_admin', False):
+        return []
+    room_model = SEARCH_KINDS[kind][1]
+    query = room_model.query.filter(room_model.is_locked == True)
+    if kind == 'private':
+        query = query.filter(room_model.user_id == user.id)
+    return [room.id for room in query.all() if not is_user_allowed(room, kind, user)]
+
+
+def room_url(kind, room_id):
+    """Page of a topic, relationship or private chat, for links from search results."""
+    if kind == 'topic':
+        return url_for('topic', topic_id=room_id)
+    if kind == 'relationship':
+        return url_for('relationship_chat', relationship_id=room_id)
+    if getattr(current_user, 'is_admin', False):
+        return url_for('private_chat', chat_id=room_id)
+    return url_for('my_private_chat', chat_id=room_id)
+
+
+def snippet_html(snippet):
+    """Escape an FTS snippet and turn its match marks into <mark> tags."""
+    start, end = search_index.HIGHLIGHT
+    return html.escape(snippet or '').replace(start, '<mark>').replace(end, '</mark>')
+
+
+@app.route('/api/search')
+@login_required
+@rate_limit('search')
+def api_search():
+    """Search message text, newest first, across the rooms the caller can read.
+
+    Query args: q, optional type (topic/relationship/private; all by default), room_id (with
+    type), limit and cursor (next_cursor from the previous page). Locked rooms the caller has
+    not unlocked are skipped, and private chats are searched only by their owner and admins.
+    """
+    match = search_index.match_query(request.args.get('q'))
+    if not match:
+        return jsonify({'status': 'error', 'message': 'Enter something to search for'}), 400
+    kind = request.args.get('type')
+    if kind and kind not in SEARCH_KINDS:
+        return jsonify({'status': 'error', 'message': 'Invalid type'}), 400
+    kinds = [kind] if kind else list(SEARCH_KINDS)
+    room_id = request.args.get('room_id') if kind else None
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 50)
+    bounds = search_index.parse_cursor(request.args.get('cursor'), kinds)
+    is_admin = getattr(current_user, 'is_admin', False)
+
+    pages = {}
+    try:
+        for k in kinds:
+            if bounds[k] == 0:  # exhausted on an earlier page
+                continue
+            pages[k] = search_index.search(
+                db.session, k, match, before=bounds[k], limit=limit + 1,
+                room_ids=[room_id] if room_id else None,
+                exclude_room_ids=denied_room_ids(k, current_user),
+                owner_id=None if k != 'private' or is_admin else current_user.id)
+    except Exception:
+        app.logger.exception('api_search failed (run migrate_add_search_index.py if the index is missing)')
+        return jsonify({'status': 'error', 'message': 'Search is unavailable'}), 503
+
+    # each kind comes back newest-first by rowid; merge them by time, taking a prefix of each
+    streams = {}
+    for k, rows in pages.items():
+        model = SEARCH_KINDS[k][0]
+        by_id = {m.id: m for m in model.query.options(joinedload(model.user))
+                 .filter(model.id.in_([row[1] for row in rows])).all()}
+        streams[k] = [(by_id[mid], k, rowid, snippet) for rowid, mid, snippet in rows if mid in by_id]
+    merged = heapq.merge(*streams.values(), key=lambda hit: hit[0].created_at or datetime.min, reverse=True)
+
+    results, taken = [], dict.fromkeys(pages, 0)
+    for message, k, rowid, snippet in merged:
+        if len(results) == limit:
+            break
+        room = getattr(message, search_index.INDEXED_TABLES[k][1])
+        results.append({
+            **history_message(message, k),
+            'type': k,
+            'room_id': room,
+            'url': room_url(k, room),
+            'snippet': snippet_html(snippet),
+        })
+        taken[k] += 1
+        bounds[k] = rowid
+    for k, rows in pages.items():
+        if len(rows) <= limit and taken[k] == len(streams[k]):  # used up, and nothing below it
+            bounds[k] = 0
+
+    return jsonify({'status': 'success', 'results': results, 'next_cursor': search_index.format_cursor(bounds)})
+
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -764,7 +1338,8 @@ def chat():
         unread_private_count = 0
 
     # Compute active counts for topics to display in the sidebar
-    topic_active_counts = {t.id: compute_topic_active_count(t.id) for t in topics}
+    room_counts = compute_room_active_counts([f"topic:{t.id}" for t in topics])
+    topic_active_counts = {t.id: room_counts.get(f"topic:{t.id}", 0) for t in topics}
 
     return render_template('chat.html', topics=topics, unread_private_count=unread_private_count, topic_active_counts=topic_active_counts)
 
@@ -795,10 +1370,8 @@ def topic(topic_id):
             topic_id=topic_id
         ).first()
 
-        messages = Message.query.filter_by(
-            topic_id=topic_id,
-            is_deleted=False
-        ).order_by(Message.created_at).all()
+        messages, older_cursor = paginate_messages(
+            Message.query.filter_by(topic_id=topic_id, is_deleted=False), Message)
 
         active_count = compute_topic_active_count(topic_id)
 
@@ -820,10 +1393,13 @@ def topic(topic_id):
         return render_template('topic.html',
                                topic=topic,
                                messages=messages,
+                               reactions=reaction_summaries([m.id for m in messages]),
+                               older_cursor=older_cursor,
                                forced_identity=forced_identity,
                                active_count=active_count,
                                user_saved_settings=user_saved_settings,
                                locked=(not topic_allowed),
+                               use_websocket=(sock is not None),
                                lock_message=(topic.lock_message if getattr(topic, 'lock_message', None) else 'This topic is locked by an administrator.') )
     except Exception:
         # Log error for debugging but show 404 to users
@@ -841,7 +1417,8 @@ def relationships():
     former_crushie = Relationship.query.filter_by(category='former_crushie').all()
     # compute relationship active counts for the listing page
     rels = dating + rejected + crushes + broken_up + cheaters + former_crushie
-    relationship_active_counts = {r.id: compute_relationship_active_count(r.id) for r in rels}
+    room_counts = compute_room_active_counts([f"relationship:{r.id}" for r in rels])
+    relationship_active_counts = {r.id: room_counts.get(f"relationship:{r.id}", 0) for r in rels}
 
     return render_template('relationship.html', 
                          dating=dating, 
@@ -936,8 +1513,7 @@ def admin_private_chats():
         return redirect(url_for('admin_login'))
     # Fetch recent private chats and prepare helper maps for template
     chats = PrivateChat.query.order_by(PrivateChat.created_at.desc()).all()
-    users = User.query.all()
-    users_by_id = {u.id: u for u in users}
+    users_by_id = users_by_ids(c.user_id for c in chats)
 
     # Count unread private messages for badge
     unread_count = PrivateMessage.query.filter_by(is_read=False).count()
@@ -950,18 +1526,22 @@ def admin_private_chats():
 @admin_required
 def private_chat(chat_id):
     chat = PrivateChat.query.get_or_404(chat_id)
-    messages = PrivateMessage.query.filter_by(chat_id=chat_id).order_by(PrivateMessage.created_at.asc()).all()
-    users = User.query.all()
-    users_by_id = {u.id: u for u in users}
-    # Mark all messages as read
-    for message in messages:
-        if not message.is_read:
-            message.is_read = True
+    messages, older_cursor = paginate_messages(PrivateMessage.query.filter_by(chat_id=chat_id), PrivateMessage)
+    users_by_id = users_by_ids(m.user_id for m in messages)
+    # Mark all messages as read, including older pages that are not rendered yet. Replies to the
+    # owner are marked separately: they are also counted on the owner's badge
+    unread = PrivateMessage.query.filter_by(chat_id=chat_id, is_read=False)
+    replies = unread.filter(PrivateMessage.user_id != chat.user_id).update(
+        {'is_read': True}, synchronize_session=False)
+    marked = replies + unread.update({'is_read': True}, synchronize_session=False)
     db.session.commit()
+    publish_unread_delta('admin:unread', -marked, chat_id)
+    publish_unread_delta(f"user:{chat.user_id}", -replies, chat_id)
     # Always return the rendered template
     return render_template('private_chat.html', 
                           chat=chat, 
                           messages=messages, 
+                          older_cursor=older_cursor,
                           users_by_id=users_by_id)
 
 
@@ -974,17 +1554,20 @@ def my_private_chat(chat_id):
     if chat.user_id != current_user.id and not getattr(current_user, 'is_admin', False):
         abort(403)
 
-    messages = PrivateMessage.query.filter_by(chat_id=chat_id).order_by(PrivateMessage.created_at.asc()).all()
-    users = User.query.all()
-    users_by_id = {u.id: u for u in users}
+    messages, older_cursor = paginate_messages(PrivateMessage.query.filter_by(chat_id=chat_id), PrivateMessage)
+    users_by_id = users_by_ids(m.user_id for m in messages)
 
-    # Mark messages as read for the owner
-    for message in messages:
-        if not message.is_read and message.user_id != current_user.id:
-            message.is_read = True
+    # Mark messages as read for the owner, including older pages that are not rendered yet
+    marked = PrivateMessage.query.filter(
+        PrivateMessage.chat_id == chat_id,
+        PrivateMessage.is_read == False,
+        PrivateMessage.user_id != current_user.id
+    ).update({'is_read': True}, synchronize_session=False)
     db.session.commit()
+    publish_unread_delta(f"user:{chat.user_id}", -marked, chat_id)
+    publish_unread_delta('admin:unread', -marked, chat_id)
 
-    return render_template('private_chat.html', chat=chat, messages=messages, users_by_id=users_by_id)
+    return render_template('private_chat.html', chat=chat, messages=messages, older_cursor=older_cursor, users_by_id=users_by_id)
 
 
 # Breaking news page (admins post, everyone can read)
@@ -992,8 +1575,7 @@ def my_private_chat(chat_id):
 @login_required
 def breaking():
     news = BreakingNews.query.order_by(BreakingNews.created_at.desc()).all()
-    users = User.query.all()
-    users_by_id = {u.id: u for u in users}
+    users_by_id = users_by_ids(n.posted_by for n in news)
     return render_template('breaking.html', breaking_news=news, users_by_id=users_by_id)
 
 
@@ -1047,11 +1629,11 @@ def start_admin_chat():
 
     print(f"User authenticated: ID={current_user.id}, status={current_user.status}")
 
-    # Rate limit: max ADMIN_CHAT_LIMIT starts per ADMIN_CHAT_WINDOW per user
-    allowed, retry_after = check_admin_chat_rate_limit(current_user.id)
-    if not allowed:
+    # Rate limit: RATE_LIMITS['admin_chat'] starts per user
+    retry_after = check_rate_limit('admin_chat')
+    if retry_after is not None:
         print(f"Rate limit exceeded for user {current_user.id}")
-        return jsonify({'status': 'error', 'message': 'Rate limit exceeded', 'retry_after': retry_after}), 429
+        return rate_limited_response(retry_after, 'Rate limit exceeded')
 
     # Check if user already has an open chat
     existing_chat = PrivateChat.query.filter_by(user_id=current_user.id, is_open=True).first()
@@ -1219,6 +1801,7 @@ def blocked_chat(chat_id):
 
 @app.route('/api/private_message', methods=['POST'])
 @login_required
+@rate_limit('send')
 def send_private_message():
     chat_id = request.form.get('chat_id')
     content = request.form.get('content')
@@ -1239,6 +1822,7 @@ def send_private_message():
     )
     db.session.add(message)
     db.session.commit()
+    note_activity(current_user)
     
     # Publish to SSE room for this private chat so the other side sees it live
     try:
@@ -1259,6 +1843,11 @@ def send_private_message():
     except Exception:
         app.logger.exception('Failed to publish private message to SSE')
 
+    # Unread badge deltas: the admin inbox counts every unread message, the owner counts replies to them
+    publish_unread_delta('admin:unread', 1, chat_id)
+    if current_user.id != chat.user_id:
+        publish_unread_delta(f"user:{chat.user_id}", 1, chat_id)
+
     return jsonify({'status': 'success'})
 
 # Relationship chat route (correct placement)
@@ -1302,192 +1891,639 @@ def relationship_chat(relationship_id):
             
     # Only load past messages if the user is allowed to view the room
     if rel_allowed:
-        messages = RelationshipMessage.query.filter_by(relationship_id=relationship_id).order_by(RelationshipMessage.created_at).all()
+        messages, older_cursor = paginate_messages(
+            RelationshipMessage.query.filter_by(relationship_id=relationship_id), RelationshipMessage)
     else:
-        messages = []
+        messages, older_cursor = [], None
     active_count = compute_relationship_active_count(relationship_id)
     return render_template('relationship_chat.html', 
                          relationship=relationship, 
                          messages=messages,
+                         reactions=reaction_summaries([m.id for m in messages]),
+                         older_cursor=older_cursor,
                          forced_identity=forced_identity,
                          active_count=active_count,
                          locked=(not rel_allowed),
                          lock_message=(relationship.lock_message if getattr(relationship, 'lock_message', None) else 'This relationship chat is locked.'))
 
+def session_login_required(f):
+    """Like login_required, but a signed session cookie is enough: no database load of the user.
+
+    For hot, read-only routes such as uploads; falls back to the normal check (which honours
+    remember-me cookies) when the session has no user.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not session.get('_user_id') and not current_user.is_authenticated:
+            return login_manager.unauthorized()
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+UPLOAD_CACHE_SECONDS = 365 * 24 * 3600  # content-addressed uploads never change
+
+
 # File serving route
 @app.route('/uploads/<path:filename>')
-@login_required
+@session_login_required
 def serve_upload(filename):
-    try:
-        return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-    except Exception as e:
-        return str(e), 404
+    """Serve an upload; for images, ?size=thumb|medium|full picks a variant and WebP is sent when accepted.
 
-# API Routes
-@app.route('/api/send_message', methods=['POST'])
-@login_required
-def send_message():
+    Without a size an image is served as stored (without its metadata, see utils.store_image).
+    For voice notes, ?voice=<voice_type> picks the render with that voice effect. Variants that
+    were not generated (small originals, uploads still being processed, older messages, voice
+    effects unavailable) fall back to the stored upload. Responses carry ETags and honour
+    If-None-Match and Range requests (audio seeking); content-addressed files are cached as immutable.
+    """
+    wanted, fallbacks = [filename], []
+    size = request.args.get('size')
+    # the upload itself is never rewritten (it must keep matching its hash), so only sized variants vary
+    negotiated = filename.startswith('images/') and size in app.config.get('IMAGE_SIZES', {})
+    if filename.startswith('voice/') and request.args.get('voice') in voice_fx.VOICE_PRESETS:
+        # the voice effect render; the upload itself until it has been rendered
+        wanted, fallbacks = [voice_render_path(filename, request.args['voice'])], [filename]
+    if negotiated:
+        wanted, fallbacks = [image_variant_path(filename, size)], [filename]
+        if 'image/webp' in request.headers.get('Accept', ''):
+            wanted.insert(0, image_variant_path(filename, size, webp=True))
+    candidates = wanted + fallbacks
+    # uploads are written relative to the working directory (see utils.store_image)
+    upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    for candidate in candidates:
+        path = safe_join(upload_folder, candidate)
+        if path and os.path.isfile(path):
+            break
+    else:
+        return 'File not found', 404
+
+    accel_prefix = app.config.get('UPLOADS_ACCEL_REDIRECT')
+    if accel_prefix:
+        # the front proxy streams the file (and handles ranges/conditionals) from an internal location
+        response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{candidate}"
+    else:
+        # conditional: strong ETag, 304 on If-None-Match, 206 for Range
+        response = send_file(path, conditional=True, etag=True)
+    response.cache_control.private = True  # uploads are only for logged-in users
+    if is_content_addressed(filename) and candidate in wanted:
+        response.cache_control.no_cache = None  # send_file's default when no max_age is given
+        response.cache_control.max_age = UPLOAD_CACHE_SECONDS
+        response.cache_control.immutable = True
+    else:
+        # a fallback (variant not ready yet) or an older upload: revalidate with the ETag
+        response.cache_control.no_cache = True
+    if negotiated:
+        # the same URL returns WebP or the original format depending on Accept
+        response.vary.add('Accept')
+    return response
+
+
+IMAGE_SIZES_ATTR = '(max-width: 600px) 90vw, 480px'  # rendered width of .message-image, for srcset
+
+
+def image_size_urls(image_path):
+    """{size: URL} for each of IMAGE_SIZES of a stored image; needs a request (url_for)."""
+    return {name: url_for('serve_upload', filename=image_path, size=name) for name in app.config.get('IMAGE_SIZES', {})}
+
+
+def image_srcset(size_urls, variants):
+    """srcset for the variants {size: width} that were written, or None."""
+    return ', '.join(f"{size_urls[name]} {width}w" for name, width in sorted(variants.items(), key=lambda kv: kv[1])
+                     if name in size_urls) or None
+
+
+def image_fields(message):
+    """image_url (medium variant), image_full_url and image_srcset for a message's image, or Nones."""
+    image_path = getattr(message, 'image_path', None)
+    if not image_path:
+        return {'image_url': None, 'image_full_url': None, 'image_srcset': None}
     try:
-        topic_id = request.form['topic_id']
-        content = request.form.get('content', '')
-        identity_revealed = request.form.get('identity_revealed', 'false') == 'true'
-        voice_type = request.form.get('voice_type', 'normal')
-        
-        # Check if user is forced to reveal identity
-        forced_identity = ForcedIdentity.query.filter_by(
-            user_id=current_user.id, 
-            topic_id=topic_id
-        ).first()
+        variants = json.loads(message.image_variants or '{}')
+    except (TypeError, ValueError, AttributeError):
+        variants = {}
+    return {
+        'image_url': url_for('serve_upload', filename=image_path, size='medium'),
+        'image_full_url': url_for('serve_upload', filename=image_path, size='full'),
+        'image_srcset': image_srcset(image_size_urls(image_path), variants),
+    }
 
-        # Enforce topic lock server-side
-        topic_obj = Topic.query.get(topic_id)
-        if topic_obj and getattr(topic_obj, 'is_locked', False):
-            if not is_user_allowed(topic_obj, 'topic', current_user):
-                return jsonify({'status': 'error', 'message': 'Topic is locked'}), 403
-        
-        if forced_identity and forced_identity.must_reveal_identity:
-            identity_revealed = True
-        
-        message = Message(
+
+@app.context_processor
+def inject_media_helpers():
+    return {'image_fields': image_fields, 'image_sizes_attr': IMAGE_SIZES_ATTR, 'voice_url': voice_url}
+
+# Message posting helpers shared by the HTTP API and the WebSocket transport.
+# They act as current_user and return (result, error) where error is (message, http_status) or None.
+
+def add_media_ref(path, kind):
+    """Count one more message using the stored upload at path, in the caller's transaction."""
+    media = db.session.get(MediaObject, path)
+    if media is None:
+        media = MediaObject(path=path, kind=kind, ref_count=1,
+                            sha256=os.path.splitext(os.path.basename(path))[0],
+                            size=os.path.getsize(os.path.join(app.config['UPLOAD_FOLDER'], path)))
+        db.session.add(media)
+    else:
+        media.ref_count = MediaObject.ref_count + 1
+    return media
+
+
+def release_media_refs(paths):
+    """Drop one reference per entry in paths (None entries are ignored), in the caller's transaction.
+
+    Returns the distinct paths released; pass them to collect_media() after committing.
+    """
+    counts = Counter(p for p in paths if p)
+    for path, n in counts.items():
+        db.session.execute(update(MediaObject).where(MediaObject.path == path).values(
+            ref_count=case((MediaObject.ref_count > n, MediaObject.ref_count - n), else_=0)))
+    return list(counts)
+
+
+def collect_media(paths=None):
+    """Delete unreferenced media objects and their files (only among paths, if given); returns the paths removed.
+
+    Files go before the commit. This runs under BEGIN IMMEDIATE, and uploads move their file
+    into place inside their own IMMEDIATE transaction (after begin_write(), in _attach_uploads),
+    so an upload reusing the same content cannot slip in between: it re-creates the file if it
+    finds none. Only the parsing of its body, into an .incoming spool, happens outside the lock.
+    """
+    query = MediaObject.query.with_entities(MediaObject.path).filter(MediaObject.ref_count <= 0)
+    if paths is not None:
+        if not paths:
+            return []
+        query = query.filter(MediaObject.path.in_(list(paths)))
+    removed = []
+    for (path,) in query.all():
+        deleted = db.session.execute(delete(MediaObject).where(
+            MediaObject.path == path, MediaObject.ref_count <= 0)).rowcount
+        if deleted:
+            try:
+                remove_media(app.config['UPLOAD_FOLDER'], path)
+            except OSError:
+                app.logger.exception('Failed to remove media file %s', path)
+            removed.append(path)
+    db.session.commit()
+    return removed
+
+
+def reconcile_media_refs(commit=True):
+    """Recount MediaObject.ref_count from the message tables; returns the number of objects changed.
+
+    Files referenced by messages from before the media store (that still exist) are registered
+    too, so they are collected like any other upload once unused.
+    """
+    counts = Counter()
+    live_message = or_(Message.is_deleted == False, Message.is_deleted == None)  # noqa: E712
+    for model, live in ((Message, live_message), (RelationshipMessage, None), (PrivateMessage, None)):
+        for column in (model.image_path, model.voice_path):
+            query = db.session.query(column, func.count()).filter(column != None)  # noqa: E711
+            if live is not None:
+                query = query.filter(live)
+            counts.update(dict(query.group_by(column).all()))
+    changed = 0
+    known = set()
+    for media in MediaObject.query.all():
+        known.add(media.path)
+        if media.ref_count != counts.get(media.path, 0):
+            media.ref_count = counts.get(media.path, 0)
+            changed += 1
+    for path, n in counts.items():
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
+        if path in known or not os.path.isfile(file_path):
+            continue
+        db.session.add(MediaObject(path=path, kind='image' if path.startswith('images/') else 'voice',
+                                   size=os.path.getsize(file_path), ref_count=n))
+        changed += 1
+    if commit:
+        db.session.commit()
+    return changed
+
+
+@app.errorhandler(RequestEntityTooLarge)
+@app.errorhandler(UnsupportedMediaType)
+def upload_rejected(error):
+    """Oversized or wrong-type uploads (see uploads.UploadRequest); JSON for the API."""
+    if request.path.startswith('/api/'):
+        return jsonify({'status': 'error', 'message': error.description}), error.code
+    return error
+
+
+def checked_image(image_file):
+    """image_file if it holds an image (see utils.is_image), else None; run before begin_write()."""
+    if image_file and image_file.filename and is_image(image_file):
+        image_file.verified = True
+        return image_file
+    return None
+
+
+def _attach_uploads(message, image_file=None, voice_file=None):
+    """Store uploads on message and count their references.
+
+    Returns the processing still needed before the message is published: a list of
+    ('image', path) and ('voice', path) jobs.
+    """
+    pending = []
+    if image_file and image_file.filename:
+        image_path = store_image(image_file, verified=getattr(image_file, 'verified', False))
+        if image_path:
+            message.image_path = image_path
+            media = add_media_ref(image_path, 'image')
+            if media.variants:
+                # the same picture was posted before and has already been processed
+                message.image_variants = media.variants
+            else:
+                pending.append(('image', image_path))
+    if voice_file and voice_file.filename:
+        voice_path = save_voice(voice_file)
+        if voice_path:
+            message.voice_path = voice_path
+            add_media_ref(voice_path, 'voice')
+            if VOICE_EFFECTS_ENABLED and message.voice_type in voice_fx.VOICE_PRESETS and not os.path.exists(
+                    os.path.join(app.config['UPLOAD_FOLDER'], voice_render_path(voice_path, message.voice_type))):
+                # rendered once per clip and voice type; reposts reuse the file
+                pending.append(('voice', voice_path))
+    return pending
+
+
+def _record_image_variants(model, message_id, image_path, variants):
+    def record():
+        data = json.dumps(variants)
+        db.session.execute(update(model).where(model.id == message_id).values(image_variants=data))
+        db.session.execute(update(MediaObject).where(MediaObject.path == image_path).values(variants=data))
+        db.session.commit()
+
+    if has_app_context():  # inline processing, still inside the request
+        record()
+        return
+    with app.app_context():
+        record()
+
+
+def publish_message_event(room_key, payload, message=None, pending=()):
+    """Publish a new message to room_key now, or once its image is processed.
+
+    pending holds _attach_uploads' jobs: image variants (IMAGE_PROCESSOR) hold the event back
+    so it can carry the srcset; voice effects (VOICE_PROCESSOR) are only started, since
+    serve_upload plays the upload until the render exists.
+    """
+    def publish():
+        try:
+            publish_to_room(room_key, payload)
+        except Exception:
+            app.logger.exception('Failed to publish new message to SSE')
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    images = [path for kind, path in pending if kind == 'image']
+    for kind, path in pending:
+        if kind == 'voice':
+            VOICE_PROCESSOR.submit(os.path.join(upload_folder, path),
+                                   dst_path=os.path.join(upload_folder, voice_render_path(path, message.voice_type)),
+                                   voice_type=message.voice_type)
+    if not images:
+        publish()
+        return
+    model, message_id = type(message), message.id
+    remaining = [len(images)]
+    lock = threading.Lock()
+
+    def job_done():
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        # published even if processing failed: the original upload is still there to show
+        publish()
+
+    for path in images:
+        # URLs need the request; the srcset is filled in from the variants once they exist
+        size_urls = image_size_urls(path)
+
+        def processed(ok, variants, image_path=path, size_urls=size_urls):
+            if ok and variants:
+                try:
+                    _record_image_variants(model, message_id, image_path, variants)
+                except Exception:
+                    app.logger.exception('Failed to record image variants')
+                if isinstance(payload.get('message'), dict):
+                    payload['message']['image_srcset'] = image_srcset(size_urls, variants)
+            job_done()
+
+        IMAGE_PROCESSOR.submit(os.path.join(upload_folder, path), processed)
+
+
+def voice_url(message):
+    """URL of a message's voice note, asking for its voice effect when it has one."""
+    voice_path = getattr(message, 'voice_path', None)
+    if not voice_path:
+        return None
+    voice_type = getattr(message, 'voice_type', None)
+    if voice_type in voice_fx.VOICE_PRESETS:
+        return url_for('serve_upload', filename=voice_path, voice=voice_type)
+    return url_for('serve_upload', filename=voice_path)
+
+
+def _message_event(message, identity_revealed):
+    return {
+        'id': message.id,
+        'sender_name': current_user.name if identity_revealed else current_user.username,
+        'content': message.content,
+        'timestamp': int(message.created_at.timestamp() * 1000),
+        'formatted_time': format_timestamp(message.created_at),
+        'has_image': bool(message.image_path),
+        'has_voice': bool(message.voice_path),
+        **image_fields(message),
+        'voice_url': voice_url(message),
+        'is_own': False
+    }
+
+
+def message_response(message):
+    """JSON body returned to the sender of a topic/relationship message."""
+    return {
+        'status': 'success',
+        'message_id': message.id,
+        'user_name': current_user.name if message.identity_revealed else current_user.username,
+        'timestamp': format_timestamp(message.created_at),
+        'content': message.content,
+        'has_image': bool(message.image_path),
+        'has_voice': bool(message.voice_path)
+    }
+
+
+def create_topic_message(topic_id, content, identity_revealed=False, voice_type='normal', image_file=None, voice_file=None):
+    # Check if user is forced to reveal identity
+    forced_identity = ForcedIdentity.query.filter_by(
+        user_id=current_user.id,
+        topic_id=topic_id
+    ).first()
+
+    # Enforce topic lock server-side
+    topic_obj = Topic.query.get(topic_id)
+    if topic_obj and getattr(topic_obj, 'is_locked', False):
+        if not is_user_allowed(topic_obj, 'topic', current_user):
+            return None, ('Topic is locked', 403)
+
+    if forced_identity and forced_identity.must_reveal_identity:
+        identity_revealed = True
+
+    message = Message(
+        content=content,
+        topic_id=topic_id,
+        user_id=current_user.id,
+        identity_revealed=identity_revealed,
+        voice_type=voice_type
+    )
+    pending = _attach_uploads(message, image_file, voice_file)
+
+    db.session.add(message)
+    db.session.commit()
+    note_activity(current_user, f"topic:{topic_id}")
+
+    # Publish to SSE room for topic (after its image/voice note, if any, is processed)
+    publish_message_event(f"topic:{topic_id}", {'type': 'message', 'message': _message_event(message, identity_revealed)},
+                          message, pending)
+    return message, None
+
+
+def create_relationship_message(relationship_id, content, identity_revealed=False, voice_type='normal', image_file=None, voice_file=None):
+    # Check if user is forced to reveal identity in this relationship
+    forced_identity = RelationshipForcedIdentity.query.filter_by(
+        user_id=current_user.id,
+        relationship_id=relationship_id
+    ).first()
+
+    # Override user's choice if they are forced to reveal identity
+    if forced_identity and forced_identity.must_reveal_identity:
+        identity_revealed = True
+
+    # Enforce relationship lock server-side
+    rel_obj = Relationship.query.get(relationship_id)
+    if rel_obj and getattr(rel_obj, 'is_locked', False):
+        if not is_user_allowed(rel_obj, 'relationship', current_user):
+            return None, ('Relationship chat is locked', 403)
+
+    message = RelationshipMessage(
+        content=content,
+        relationship_id=relationship_id,
+        user_id=current_user.id,
+        identity_revealed=identity_revealed,
+        voice_type=voice_type
+    )
+    pending = _attach_uploads(message, image_file, voice_file)
+
+    db.session.add(message)
+    db.session.commit()
+    note_activity(current_user, f"relationship:{relationship_id}")
+
+    # Publish to SSE room for relationship (after its image/voice note, if any, is processed)
+    publish_message_event(f"relationship:{relationship_id}", {'type': 'message', 'message': _message_event(message, identity_revealed)},
+                          message, pending)
+    return message, None
+
+
+def create_reply(parent_id, content):
+    """Reply to a topic or relationship message; returns (response dict, error)."""
+    parent = Message.query.get(parent_id)
+    if not parent:
+        # try relationship messages
+        parent_rel = RelationshipMessage.query.get(parent_id)
+        if not parent_rel:
+            return None, ('Parent message not found', 404)
+        # create a RelationshipMessage reply
+        reply = RelationshipMessage(
+            relationship_id=parent_rel.relationship_id,
+            user_id=current_user.id,
             content=content,
-            topic_id=topic_id,
+            identity_revealed=False,
+            voice_type='normal'
+        )
+        room_key = f"relationship:{parent_rel.relationship_id}"
+    else:
+        # create a topic Message reply
+        reply = Message(
+            topic_id=parent.topic_id,
             user_id=current_user.id,
-            identity_revealed=identity_revealed,
-            voice_type=voice_type
+            content=content,
+            parent_id=parent.id,
+            identity_revealed=False,
+            voice_type='normal'
         )
-        
-        # Handle image upload
-        if 'image' in request.files:
-            image_file = request.files['image']
-            if image_file and image_file.filename:
-                image_path = save_image(image_file)
-                if image_path:
-                    message.image_path = image_path
-        
-        # Handle voice upload
-        if 'voice' in request.files:
-            voice_file = request.files['voice']
-            if voice_file and voice_file.filename:
-                voice_path = save_voice(voice_file)
-                if voice_path:
-                    message.voice_path = voice_path
-        
-        db.session.add(message)
-        db.session.commit()
+        room_key = f"topic:{parent.topic_id}"
+    db.session.add(reply)
+    db.session.commit()
+    note_activity(current_user, room_key)
 
-        # Publish to SSE room for topic
+    try:
+        publish_to_room(room_key, {
+            'type': 'reply',
+            'message': {
+                'id': reply.id,
+                'sender_name': current_user.username,
+                'content': reply.content,
+                'timestamp': int(reply.created_at.timestamp() * 1000),
+                'formatted_time': format_timestamp(reply.created_at),
+                'is_own': False,
+                'parent_id': parent_id
+            }
+        })
+    except Exception:
+        app.logger.exception('Failed to publish reply to SSE')
+
+    return {
+        'status': 'success',
+        'message_id': reply.id,
+        'user_name': current_user.username,
+        'timestamp': format_timestamp(reply.created_at),
+        'content': reply.content
+    }, None
+
+
+MAX_EMOJI_LENGTH = 16  # MessageReaction.emoji; enough for ZWJ sequences like 👩‍❤️‍👨
+
+
+def reaction_summaries(message_ids, user_id=None):
+    """{message_id: {'counts': {emoji: n}, 'mine': [emoji]}} for messages with reactions, in one query.
+
+    mine lists the emojis user_id (default: current_user) reacted with.
+    """
+    ids = list({i for i in message_ids if i})
+    if not ids:
+        return {}
+    user_id = user_id or current_user.id
+    mine = select(MessageReaction.user_id).where(
+        MessageReaction.message_id == ReactionCount.message_id,
+        MessageReaction.emoji == ReactionCount.emoji,
+        MessageReaction.user_id == user_id,
+    ).exists()
+    rows = db.session.execute(
+        select(ReactionCount.message_id, ReactionCount.emoji, ReactionCount.count, mine)
+        .where(ReactionCount.message_id.in_(ids), ReactionCount.count > 0)
+        .order_by(ReactionCount.message_id, ReactionCount.emoji)
+    )
+    summaries = {}
+    for message_id, emoji, count, is_mine in rows:
+        summary = summaries.setdefault(message_id, {'counts': {}, 'mine': []})
+        summary['counts'][emoji] = count
+        if is_mine:
+            summary['mine'].append(emoji)
+    return summaries
+
+
+def message_rooms(message_ids):
+    """{message_id: room_key} for the topic and relationship messages among message_ids."""
+    message_ids = list(message_ids)
+    rooms = {mid: f'topic:{tid}' for mid, tid in
+             db.session.query(Message.id, Message.topic_id).filter(Message.id.in_(message_ids))}
+    rest = [mid for mid in message_ids if mid not in rooms]
+    if rest:
+        rooms.update({mid: f'relationship:{rid}' for mid, rid in db.session.query(
+            RelationshipMessage.id, RelationshipMessage.relationship_id).filter(RelationshipMessage.id.in_(rest))})
+    return rooms
+
+
+def readable_rooms(room_keys, user):
+    """The room_keys user may read (see can_subscribe_room), each checked once."""
+    readable = set()
+    for room in set(room_keys):
         try:
-            room_key = f"topic:{topic_id}"
-            publish_to_room(room_key, {
-                'type': 'message',
-                'message': {
-                    'id': message.id,
-                    'sender_name': current_user.name if identity_revealed else current_user.username,
-                    'content': content,
-                    'timestamp': int(message.created_at.timestamp() * 1000),
-                    'formatted_time': format_timestamp(message.created_at),
-                    'has_image': bool(message.image_path),
-                    'has_voice': bool(message.voice_path),
-                    'is_own': False
-                }
-            })
+            if can_subscribe_room(room, user):
+                readable.add(room)
         except Exception:
-            app.logger.exception('Failed to publish new topic message to SSE')
+            pass
+    return readable
 
-        return jsonify({
-            'status': 'success',
-            'message_id': message.id,
-            'user_name': current_user.name if identity_revealed else current_user.username,
-            'timestamp': format_timestamp(message.created_at),
-            'content': content,
-            'has_image': bool(message.image_path),
-            'has_voice': bool(message.voice_path)
-        })
-    
+
+def toggle_reaction(message_id, emoji):
+    """Toggle current_user's emoji reaction on a message; returns (summary, error).
+
+    The reaction row is deleted, or inserted if there was none, and the message's count is
+    moved by one in the same transaction. Each step is a single statement, so concurrent
+    toggles on a busy message never overwrite each other.
+    """
+    if not emoji or len(emoji) > MAX_EMOJI_LENGTH:
+        return None, ('Invalid emoji', 400)
+    room_key = message_rooms([message_id]).get(message_id)
+    if room_key is None:
+        return None, ('Message not found', 404)
+    if not readable_rooms([room_key], current_user):
+        return None, ('Access denied', 403)
+
+    removed = db.session.execute(delete(MessageReaction).where(
+        MessageReaction.message_id == message_id,
+        MessageReaction.user_id == current_user.id,
+        MessageReaction.emoji == emoji,
+    )).rowcount
+    counted = and_(ReactionCount.message_id == message_id, ReactionCount.emoji == emoji)
+    if removed:
+        db.session.execute(update(ReactionCount).where(counted).values(count=ReactionCount.count - 1))
+        db.session.execute(delete(ReactionCount).where(counted, ReactionCount.count <= 0))
+    else:
+        db.session.add(MessageReaction(message_id=message_id, user_id=current_user.id, emoji=emoji))
+        db.session.execute(sqlite_insert(ReactionCount).values(message_id=message_id, emoji=emoji, count=1)
+                           .on_conflict_do_update(index_elements=['message_id', 'emoji'],
+                                                  set_={'count': ReactionCount.count + 1}))
+    db.session.commit()
+    REACTION_EVENTS.mark(message_id, room_key)
+    return reaction_summaries([message_id]).get(message_id, {'counts': {}, 'mine': []}), None
+
+
+def delete_reactions(message_ids):
+    """Delete the reactions and counts of message_ids (a list or a select of ids), e.g. before a bulk delete."""
+    db.session.execute(delete(MessageReaction).where(MessageReaction.message_id.in_(message_ids)))
+    db.session.execute(delete(ReactionCount).where(ReactionCount.message_id.in_(message_ids)))
+
+
+# API Routes
+@app.route('/api/send_message', methods=['POST'])
+@login_required
+@rate_limit('send')
+def send_message():
+    try:
+        # reading form/files streams the uploads to disk (uploads.UploadSpool), before the write lock
+        form, files = request.form, request.files
+        image_file = checked_image(files.get('image'))
+        begin_write()
+        message, error = create_topic_message(
+            form['topic_id'],
+            form.get('content', ''),
+            identity_revealed=form.get('identity_revealed', 'false') == 'true',
+            voice_type=form.get('voice_type', 'normal'),
+            image_file=image_file,
+            voice_file=files.get('voice'),
+        )
+        if error:
+            return jsonify({'status': 'error', 'message': error[0]}), error[1]
+        return jsonify(message_response(message))
+
+    except HTTPException:
+        raise  # rejected upload (413/415), see upload_rejected
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
 @app.route('/api/send_relationship_message', methods=['POST'])
 @login_required
+@rate_limit('send')
 def send_relationship_message():
     try:
-        relationship_id = request.form['relationship_id']
-        content = request.form.get('content', '')
-        identity_revealed = request.form.get('identity_revealed', 'false') == 'true'
-        voice_type = request.form.get('voice_type', 'normal')
-        
-        # Check if user is forced to reveal identity in this relationship
-        forced_identity = RelationshipForcedIdentity.query.filter_by(
-            user_id=current_user.id,
-            relationship_id=relationship_id
-        ).first()
-        
-        # Override user's choice if they are forced to reveal identity
-        if forced_identity and forced_identity.must_reveal_identity:
-            identity_revealed = True
-
-        # Enforce relationship lock server-side
-        rel_obj = Relationship.query.get(relationship_id)
-        if rel_obj and getattr(rel_obj, 'is_locked', False):
-            if not is_user_allowed(rel_obj, 'relationship', current_user):
-                return jsonify({'status': 'error', 'message': 'Relationship chat is locked'}), 403
-        
-        message = RelationshipMessage(
-            content=content,
-            relationship_id=relationship_id,
-            user_id=current_user.id,
-            identity_revealed=identity_revealed,
-            voice_type=voice_type
+        # reading form/files streams the uploads to disk (uploads.UploadSpool), before the write lock
+        form, files = request.form, request.files
+        image_file = checked_image(files.get('image'))
+        begin_write()
+        message, error = create_relationship_message(
+            form['relationship_id'],
+            form.get('content', ''),
+            identity_revealed=form.get('identity_revealed', 'false') == 'true',
+            voice_type=form.get('voice_type', 'normal'),
+            image_file=image_file,
+            voice_file=files.get('voice'),
         )
-        
-        # Handle image upload
-        if 'image' in request.files:
-            image_file = request.files['image']
-            if image_file and image_file.filename:
-                image_path = save_image(image_file)
-                if image_path:
-                    message.image_path = image_path
-        
-        # Handle voice upload
-        if 'voice' in request.files:
-            voice_file = request.files['voice']
-            if voice_file and voice_file.filename:
-                voice_path = save_voice(voice_file)
-                if voice_path:
-                    message.voice_path = voice_path
-        
-        db.session.add(message)
-        db.session.commit()
+        if error:
+            return jsonify({'status': 'error', 'message': error[0]}), error[1]
+        return jsonify(message_response(message))
 
-        # Publish to SSE room for relationship
-        try:
-            room_key = f"relationship:{relationship_id}"
-            publish_to_room(room_key, {
-                'type': 'message',
-                'message': {
-                    'id': message.id,
-                    'sender_name': current_user.name if identity_revealed else current_user.username,
-                    'content': content,
-                    'timestamp': int(message.created_at.timestamp() * 1000),
-                    'formatted_time': format_timestamp(message.created_at),
-                    'has_image': bool(message.image_path),
-                    'has_voice': bool(message.voice_path),
-                    'is_own': False
-                }
-            })
-        except Exception:
-            app.logger.exception('Failed to publish new relationship message to SSE')
-
-        return jsonify({
-            'status': 'success',
-            'message_id': message.id,
-            'user_name': current_user.name if identity_revealed else current_user.username,
-            'timestamp': format_timestamp(message.created_at),
-            'content': content,
-            'has_image': bool(message.image_path),
-            'has_voice': bool(message.voice_path)
-        })
-    
+    except HTTPException:
+        raise  # rejected upload (413/415), see upload_rejected
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
@@ -1495,6 +2531,7 @@ def send_relationship_message():
 # Reply to a message (topic-level and relationship-level replies)
 @app.route('/api/reply_message', methods=['POST'])
 @login_required
+@rate_limit('reply')
 def reply_message_api():
     try:
         data = request.get_json(force=True)
@@ -1503,86 +2540,10 @@ def reply_message_api():
         if not parent_id or not content:
             return jsonify({'status': 'error', 'message': 'Missing parent or content'}), 400
 
-        parent = Message.query.get(parent_id)
-        if not parent:
-            # try relationship messages
-            parent_rel = RelationshipMessage.query.get(parent_id)
-            if not parent_rel:
-                return jsonify({'status': 'error', 'message': 'Parent message not found'}), 404
-            # create a RelationshipMessage reply
-            reply = RelationshipMessage(
-                relationship_id=parent_rel.relationship_id,
-                user_id=current_user.id,
-                content=content,
-                identity_revealed=False,
-                voice_type='normal'
-            )
-            db.session.add(reply)
-            db.session.commit()
-
-            # Publish to relationship room
-            try:
-                room_key = f"relationship:{parent_rel.relationship_id}"
-                publish_to_room(room_key, {
-                    'type': 'reply',
-                    'message': {
-                        'id': reply.id,
-                        'sender_name': current_user.username,
-                        'content': reply.content,
-                        'timestamp': int(reply.created_at.timestamp() * 1000),
-                        'formatted_time': format_timestamp(reply.created_at),
-                        'is_own': False,
-                        'parent_id': parent_id
-                    }
-                })
-            except Exception:
-                app.logger.exception('Failed to publish relationship reply to SSE')
-
-            return jsonify({
-                'status': 'success',
-                'message_id': reply.id,
-                'user_name': current_user.username,
-                'timestamp': format_timestamp(reply.created_at),
-                'content': reply.content
-            })
-
-        # create a topic Message reply
-        reply = Message(
-            topic_id=parent.topic_id,
-            user_id=current_user.id,
-            content=content,
-            parent_id=parent.id,
-            identity_revealed=False,
-            voice_type='normal'
-        )
-        db.session.add(reply)
-        db.session.commit()
-
-        # Publish to topic room
-        try:
-            room_key = f"topic:{parent.topic_id}"
-            publish_to_room(room_key, {
-                'type': 'reply',
-                'message': {
-                    'id': reply.id,
-                    'sender_name': current_user.username,
-                    'content': reply.content,
-                    'timestamp': int(reply.created_at.timestamp() * 1000),
-                    'formatted_time': format_timestamp(reply.created_at),
-                    'is_own': False,
-                    'parent_id': parent_id
-                }
-            })
-        except Exception:
-            app.logger.exception('Failed to publish topic reply to SSE')
-
-        return jsonify({
-            'status': 'success',
-            'message_id': reply.id,
-            'user_name': current_user.username,
-            'timestamp': format_timestamp(reply.created_at),
-            'content': reply.content
-        })
+        result, error = create_reply(parent_id, content)
+        if error:
+            return jsonify({'status': 'error', 'message': error[0]}), error[1]
+        return jsonify(result)
     except Exception:
         app.logger.exception('Failed to post reply')
         return jsonify({'status': 'error', 'message': 'Server error'}), 500
@@ -1591,6 +2552,7 @@ def reply_message_api():
 # React to a message (toggle reaction for the current user)
 @app.route('/api/react_message', methods=['POST'])
 @login_required
+@rate_limit('react')
 def react_message_api():
     try:
         data = request.get_json(force=True)
@@ -1599,37 +2561,29 @@ def react_message_api():
         if not message_id or not emoji:
             return jsonify({'status': 'error', 'message': 'Missing message id or emoji'}), 400
 
-        # try both models
-        msg = Message.query.get(message_id)
-        if not msg:
-            msg = RelationshipMessage.query.get(message_id)
-
-        if not msg:
-            return jsonify({'status': 'error', 'message': 'Message not found'}), 404
-
-        # reactions stored as JSON string mapping emoji -> list of user_ids
-        reactions = {}
-        if getattr(msg, 'reactions', None):
-            try:
-                reactions = json.loads(msg.reactions)
-            except Exception:
-                reactions = {}
-
-        user_list = reactions.get(emoji, [])
-        # toggle
-        if current_user.id in user_list:
-            user_list = [uid for uid in user_list if uid != current_user.id]
-        else:
-            user_list.append(current_user.id)
-
-        reactions[emoji] = user_list
-        msg.reactions = json.dumps(reactions)
-        db.session.commit()
+        reactions, error = toggle_reaction(message_id, emoji)
+        if error:
+            return jsonify({'status': 'error', 'message': error[0]}), error[1]
         return jsonify({'status': 'success', 'reactions': reactions})
     except Exception:
         app.logger.exception('Failed to react to message')
         return jsonify({'status': 'error', 'message': 'Server error'}), 500
 
+@app.route('/api/reactions')
+@login_required
+def api_reactions():
+    """Reaction summaries for a page of messages: ?ids=<id>,<id>,... (at most 200).
+
+    Responds with {message_id: {counts: {emoji: n}, mine: [emoji]}}; messages without
+    reactions, and messages in rooms the caller can't read (locked rooms), are left out.
+    """
+    ids = [i for i in request.args.get('ids', '').split(',') if i][:200]
+    rooms = message_rooms(ids)
+    readable = readable_rooms(rooms.values(), current_user)
+    ids = [i for i in ids if rooms.get(i) in readable]
+    return jsonify({'status': 'success', 'reactions': reaction_summaries(ids)})
+
+
 @app.route('/api/create_topic', methods=['POST'])
 @login_required
 def create_topic():
@@ -1650,46 +2604,386 @@ def create_topic():
     return jsonify({'status': 'success', 'topic_id': topic.id, 'name': topic.name, 'description': topic.description})
 
 
+def can_subscribe_room(room, user):
+    """Return True if user may receive events for room_key.
+
+    Locked topics/relationships/chats require is_user_allowed; private chats are limited to their
+    owner and admins; per-user and admin rooms to their recipients. Stream control rooms are internal.
+    """
+    t, _, rid = room.partition(':')
+    if t == 'stream':
+        return False
+    if t == 'user':
+        return rid == str(user.id)
+    if t == 'admin':
+        return bool(getattr(user, 'is_admin', False))
+    target = None
+    lock_type = t
+    if t == 'topic':
+        target = Topic.query.get(rid)
+    elif t == 'relationship':
+        target = Relationship.query.get(rid)
+    elif t in ('private', 'chat'):
+        target = PrivateChat.query.get(rid)
+        lock_type = 'private'
+        if target and target.user_id != user.id and not getattr(user, 'is_admin', False):
+            return False
+
+    if target and getattr(target, 'is_locked', False):
+        if not is_user_allowed(target, lock_type, user):
+            return False
+    return True
+
+
+def parse_room_keys(raw):
+    """Split a comma-separated room list, dropping blanks and duplicates (order kept)."""
+    keys = []
+    for key in (raw or '').split(','):
+        key = key.strip()
+        if key and key not in keys:
+            keys.append(key)
+    return keys[:SSE_MAX_ROOMS]
+
+
+def compute_room_active_counts(room_keys):
+    """Active user counts for 'topic:', 'relationship:' and 'chat:' room keys; other keys are skipped.
+
+    Costs a fixed number of lookups however many rooms are asked for: with Redis presence,
+    topic/relationship counts are one pipelined ZCOUNT per room; otherwise they come from
+    ACTIVITY (rooms due a re-seed are read from the presence store together). Chat counts
+    come from compute_chat_active_counts.
+    """
+    counts = {}
+    window = datetime.utcnow() - timedelta(minutes=get_active_window_minutes())
+    window_rooms = [k for k in room_keys if k.partition(':')[0] in ('topic', 'relationship')]
+    if window_rooms and USE_REDIS_PRESENCE and _redis_client:
+        # Redis sees every worker's pings and posts, so its counts need no re-seeding
+        try:
+            counts.update(count_presence_many(window_rooms, window))
+            window_rooms = []
+        except Exception:
+            app.logger.warning('Redis presence count failed; using local activity windows')
+    stale = [k for k in window_rooms if ACTIVITY.needs_seed(k, ACTIVE_COUNT_RESEED_SECONDS)]
+    if stale:
+        # pick up pings/posts recorded by other workers (shared only when Redis presence is on)
+        for key, entries in get_presence_entries_many(stale, window).items():
+            ACTIVITY.merge(key, entries)
+    for key in window_rooms:
+        counts[key] = ACTIVITY.count(key)
+
+    chat_ids = [k.partition(':')[2] for k in room_keys if k.startswith('chat:')]
+    for cid, n in compute_chat_active_counts(chat_ids).items():
+        counts[f"chat:{cid}"] = n
+    return counts
+
+
+def sse_stream_response(gen):
+    # X-Accel-Buffering stops nginx from holding back frames
+    return Response(gen, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/stream')
 @login_required
 def stream():
-    """SSE stream endpoint. Clients must connect with ?room=<room_key> where room_key is like 'topic:123' or 'relationship:456'."""
+    """SSE stream endpoint. Clients must connect with ?room=<room_key> where room_key is like 'topic:123' or 'relationship:456'.
+
+    Events carry ids; a reconnecting client sending Last-Event-ID is replayed the events it missed,
+    or sent a {"type": "resync"} event when they are no longer buffered.
+    """
     room = request.args.get('room')
     if not room:
         return "Missing room parameter", 400
     # Basic permission check: if the room is locked and the user is not allowed, deny subscription
     try:
-        if ':' in room:
-            t, _, rid = room.partition(':')
-            target = None
-            if t == 'topic':
-                target = Topic.query.get(rid)
-            elif t == 'relationship':
-                target = Relationship.query.get(rid)
-            elif t == 'private':
-                target = PrivateChat.query.get(rid)
-
-            if target and getattr(target, 'is_locked', False):
-                if not is_user_allowed(target, t, current_user):
-                    return "Forbidden", 403
+        if not can_subscribe_room(room, current_user):
+            return "Forbidden", 403
     except Exception:
         # If anything goes wrong during permission check, be conservative and deny
         return "Forbidden", 403
 
-    q = add_sse_subscriber(room)
+    sub = add_sse_subscriber(room, last_event_id=get_last_event_id())
+    # the stream outlives the request's queries; don't keep its transaction open
+    db.session.remove()
 
     def gen():
+        try:
+            # ask the browser to reconnect quickly if the connection drops
+            yield "retry: 3000\n\n"
+            while not sub.closed:
+                frame = sub.get(timeout=SSE_HEARTBEAT_SECONDS)
+                if frame is None:
+                    if not sub.closed:
+                        yield ": keepalive\n\n"
+                    continue
+                yield frame
+        finally:
+            # client disconnected (GeneratorExit) or the hub closed us
+            remove_sse_subscriber(room, sub)
+
+    return sse_stream_response(gen())
+
+
+@app.route('/stream/multi')
+@login_required
+def stream_multi():
+    """Multiplexed SSE stream: one connection for several rooms plus presence and unread updates.
+
+    Connect with ?rooms=topic:1,relationship:2,chat:3. The first event is
+    {"type": "hello", "stream_id": ...}; POST that id to /api/stream/subscribe to add or
+    remove rooms without reconnecting. Room events carry a "room" field. The stream also
+    delivers {"type": "presence"} active counts every SSE_PRESENCE_SECONDS and
+    {"type": "unread", "delta": n} changes to the user's unread private message badge.
+    """
+    rooms = []
+    denied = []
+    for room in parse_room_keys(request.args.get('rooms')):
+        try:
+            allowed = can_subscribe_room(room, current_user)
+        except Exception:
+            allowed = False
+        (rooms if allowed else denied).append(room)
+
+    # Unread deltas are published to per-user rooms (and to admins for the support inbox)
+    inbox_rooms = [f"user:{current_user.id}"]
+    if getattr(current_user, 'is_admin', False):
+        inbox_rooms.append('admin:unread')
+
+    stream_id = f"{current_user.id}.{uuid.uuid4().hex}"
+    SSE_BROKER.start()
+    sub = SSE_HUB.subscribe(rooms + inbox_rooms, last_event_id=get_last_event_id(), control_room=f"stream:{stream_id}")
+    show_presence = bool(INSTANCE_SETTINGS.get('show_active_users', True))
+    db.session.remove()
+
+    def presence_frame():
+        try:
+            payload = {
+                'type': 'presence',
+                'global_active': compute_global_active_count(),
+                'active': compute_room_active_counts(list(sub.rooms)),
+            }
+        finally:
+            # don't hold a pooled DB connection for the life of the stream
+            db.session.remove()
+        return f"data: {json.dumps(payload)}\n\n"
+
+    def apply_control(frame):
+        try:
+            payload = json.loads(frame.split('data: ', 1)[1])
+        except Exception:
+            return None
+        added = [r for r in payload.get('subscribe', []) if r not in sub.rooms]
+        removed = [r for r in payload.get('unsubscribe', []) if r in sub.rooms and r not in inbox_rooms]
+        SSE_HUB.add_rooms(sub, added)
+        SSE_HUB.remove_rooms(sub, removed)
+        hidden = set(inbox_rooms) | sub.control_rooms
+        ack = {'type': 'subscribed', 'rooms': sorted(r for r in sub.rooms if r not in hidden)}
+        return f"data: {json.dumps(ack)}\n\n"
+
+    def gen():
+        try:
+            yield "retry: 3000\n\n"
+            hello = {'type': 'hello', 'stream_id': stream_id, 'rooms': rooms, 'denied': denied}
+            yield f"data: {json.dumps(hello)}\n\n"
+            last_sent = next_presence = time.monotonic()
+            while not sub.closed:
+                now = time.monotonic()
+                if show_presence and now >= next_presence:
+                    yield presence_frame()
+                    last_sent = now
+                    next_presence = now + SSE_PRESENCE_SECONDS
+                wait = SSE_HEARTBEAT_SECONDS
+                if show_presence:
+                    wait = max(0, min(wait, next_presence - now))
+                frame = sub.get(timeout=wait)
+                for control in sub.pop_control():
+                    ack = apply_control(control)
+                    if ack:
+                        yield ack
+                        last_sent = time.monotonic()
+                if frame is not None:
+                    yield frame
+                    last_sent = time.monotonic()
+                elif not sub.closed and time.monotonic() - last_sent >= SSE_HEARTBEAT_SECONDS:
+                    yield ": keepalive\n\n"
+                    last_sent = time.monotonic()
+        finally:
+            SSE_HUB.unsubscribe(sub)
+
+    return sse_stream_response(stream_with_context(gen()))
+
+
+@app.route('/api/stream/subscribe', methods=['POST'])
+@login_required
+def stream_subscribe():
+    """Add/remove rooms on an open multiplexed stream.
+
+    Expects JSON: { stream_id, subscribe: [room_key, ...], unsubscribe: [room_key, ...] }.
+    The change is broadcast to the stream's control room, so it reaches whichever worker holds it.
+    """
+    try:
+        data = request.get_json(force=True) or {}
+        stream_id = str(data.get('stream_id') or '')
+        if not stream_id.startswith(f"{current_user.id}."):
+            return jsonify({'status': 'error', 'message': 'Unknown stream'}), 404
+
+        subscribe, denied = [], []
+        for room in parse_room_keys(','.join(data.get('subscribe') or [])):
+            try:
+                allowed = can_subscribe_room(room, current_user)
+            except Exception:
+                allowed = False
+            (subscribe if allowed else denied).append(room)
+        unsubscribe = parse_room_keys(','.join(data.get('unsubscribe') or []))
+
+        publish_to_room(f"stream:{stream_id}", {'type': 'control', 'subscribe': subscribe, 'unsubscribe': unsubscribe})
+        return jsonify({'status': 'success', 'subscribed': subscribe, 'denied': denied})
+    except Exception:
+        app.logger.exception('stream_subscribe failed')
+        return jsonify({'status': 'error', 'message': 'Server error'}), 500
+
+def socket_origin_allowed():
+    """True when a /ws handshake comes from this site or WEBSOCKET_ALLOWED_ORIGINS.
+
+    The socket is authenticated by the session cookie alone, which browsers also send on
+    cross-site WebSocket handshakes, so another site's page could otherwise act as the
+    visitor. Browsers always send Origin there; clients that send none carry no visitor's
+    cookies and are let through.
+    """
+    origin = request.headers.get('Origin')
+    if not origin:
+        return True
+    origin = origin.rstrip('/')
+    if origin in app.config.get('WEBSOCKET_ALLOWED_ORIGINS', ()):
+        return True
+    return urlsplit(origin).netloc.lower() == request.host.lower()
+
+
+@app.before_request
+def check_socket_origin():
+    # refuse the upgrade itself; chat_socket would only run after the handshake is accepted
+    if request.endpoint == 'chat_socket' and not socket_origin_allowed():
+        app.logger.warning('Refused /ws handshake from origin %s', request.headers.get('Origin'))
+        abort(403)
+
+
+# WebSocket ops draw on the same budgets as their HTTP endpoints
+SOCKET_OP_RATE_LIMITS = {'send': 'send', 'reply': 'reply', 'react': 'react', 'ping': 'ping'}
+
+
+def handle_socket_op(msg, sub):
+    """Run one client operation received over /ws; returns the reply dict."""
+    op = msg.get('op')
+    if op in SOCKET_OP_RATE_LIMITS:
+        retry_after = check_rate_limit(SOCKET_OP_RATE_LIMITS[op])
+        if retry_after is not None:
+            return {'status': 'error', 'message': 'Too many requests, please slow down',
+                    'code': 'rate_limited', 'retry_after': retry_after}
+    if op in ('subscribe', 'unsubscribe'):
+        rooms = parse_room_keys(','.join(msg.get('rooms') or []))
+        if op == 'unsubscribe':
+            SSE_HUB.remove_rooms(sub, [r for r in rooms if not r.startswith('user:')])
+            return {'status': 'success', 'rooms': sorted(sub.rooms)}
+        allowed = [r for r in rooms if can_subscribe_room(r, current_user)]
+        SSE_HUB.add_rooms(sub, allowed)
+        return {'status': 'success', 'rooms': sorted(sub.rooms), 'denied': [r for r in rooms if r not in allowed]}
+
+    if op == 'send':
+        identity_revealed = bool(msg.get('identity_revealed'))
+        voice_type = msg.get('voice_type') or 'normal'
+        content = msg.get('content') or ''
+        if msg.get('relationship_id'):
+            message, error = create_relationship_message(msg['relationship_id'], content, identity_revealed, voice_type)
+        elif msg.get('topic_id'):
+            message, error = create_topic_message(msg['topic_id'], content, identity_revealed, voice_type)
+        else:
+            return {'status': 'error', 'message': 'topic_id or relationship_id required'}
+        if error:
+            return {'status': 'error', 'message': error[0]}
+        return message_response(message)
+
+    if op == 'reply':
+        if not msg.get('parent_id') or not msg.get('content'):
+            return {'status': 'error', 'message': 'Missing parent or content'}
+        result, error = create_reply(msg['parent_id'], msg['content'])
+        return {'status': 'error', 'message': error[0]} if error else result
+
+    if op == 'react':
+        if not msg.get('message_id') or not msg.get('emoji'):
+            return {'status': 'error', 'message': 'Missing message id or emoji'}
+        reactions, error = toggle_reaction(msg['message_id'], msg['emoji'])
+        return {'status': 'error', 'message': error[0]} if error else {'status': 'success', 'reactions': reactions}
+
+    if op == 'ping':
+        room = msg.get('room')
+        record_heartbeat(room if room and can_subscribe_room(room, current_user) else None)
+        return {'status': 'success'}
+
+    return {'status': 'error', 'message': f'Unknown op: {op}'}
+
+
+if sock is not None:
+    @sock.route('/ws')
+    def chat_socket(ws):
+        """WebSocket transport: one authenticated connection for sends, replies, reactions, pings and room events.
+
+        Client frames are JSON {op, ref, ...} with op in subscribe/unsubscribe/send/reply/react/ping; each
+        gets a {"type": "ack", "op", "ref", ...} reply shaped like the matching HTTP endpoint's response.
+        Room events arrive as {"type": "event", "id": <event id>, "event": <same payload as SSE>}.
+        """
+        if not current_user.is_authenticated:
+            ws.close(reason=1008, message='Login required')
+            return
+
+        SSE_BROKER.start()
+        sub = SSE_HUB.subscribe([f"user:{current_user.id}"])
+        # end the login query's transaction; current_user stays attached for the ops below
+        db.session.rollback()
+        send_lock = threading.Lock()
+
+        def send(text):
+            with send_lock:
+                ws.send(text)
+
+        def forward_events():
+            while not sub.closed:
+                frame = sub.get(timeout=SSE_HEARTBEAT_SECONDS)
+                if frame is None:
+                    continue
+                event_id, data = parse_frame(frame)
+                try:
+                    # data is already serialized JSON; splice it in rather than re-encoding
+                    send(f'{{"type": "event", "id": {json.dumps(event_id)}, "event": {data}}}')
+                except Exception:
+                    break
+
+        threading.Thread(target=forward_events, name='ws-forward', daemon=True).start()
         try:
             while True:
-                data = q.get()
-                yield f"data: {data}\n\n"
-        except GeneratorExit:
-            # client disconnected
-            remove_sse_subscriber(room, q)
+                raw = ws.receive()
+                try:
+                    msg = json.loads(raw)
+                    if not isinstance(msg, dict):
+                        raise ValueError('expected an object')
+                except Exception:
+                    send(json.dumps({'type': 'ack', 'status': 'error', 'message': 'Invalid JSON'}))
+                    continue
+                try:
+                    reply = handle_socket_op(msg, sub)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('WebSocket op failed')
+                    reply = {'status': 'error', 'message': 'Server error'}
+                finally:
+                    # each op is its own transaction; don't hold the write lock between frames
+                    db.session.rollback()
+                reply.update({'type': 'ack', 'op': msg.get('op'), 'ref': msg.get('ref')})
+                send(json.dumps(reply, default=str))
+        except ConnectionClosed:
+            pass
         finally:
-            remove_sse_subscriber(room, q)
+            SSE_HUB.unsubscribe(sub)
+            db.session.remove()
 
-    return Response(gen(), mimetype='text/event-stream')
 
 @app.route('/api/block_user/<user_id>', methods=['POST'])
 def block_user(user_id):
@@ -1936,8 +3230,10 @@ def delete_message(message_id):
     message = Message.query.get(message_id)
     # Only allow admins (both full and limited) to delete messages
     if message and current_user.is_admin and (current_user.admin_level in [1, 2]):
+        released = [] if message.is_deleted else release_media_refs([message.image_path, message.voice_path])
         message.is_deleted = True
         db.session.commit()
+        collect_media(released)
         return jsonify({'status': 'success'})
     return jsonify({'status': 'error', 'message': 'Not authorized'})
 
@@ -1962,13 +3258,18 @@ def delete_topic(topic_id):
     # Handle POST for actual deletion
     topic = Topic.query.get(topic_id)
     if topic:
-        # Delete associated messages
+        # Release the media of messages not already deleted, then delete the messages
+        media = Message.query.with_entities(Message.image_path, Message.voice_path).filter(
+            Message.topic_id == topic_id, or_(Message.is_deleted == False, Message.is_deleted == None)).all()  # noqa: E712
+        released = release_media_refs(p for row in media for p in row)
+        delete_reactions(select(Message.id).where(Message.topic_id == topic_id))
         Message.query.filter_by(topic_id=topic_id).delete()
         # Delete forced identities
         ForcedIdentity.query.filter_by(topic_id=topic_id).delete()
         # Delete the topic
         db.session.delete(topic)
         db.session.commit()
+        collect_media(released)
         return jsonify({'status': 'success'})
     return jsonify({'status': 'error', 'message': 'Topic not found'})
 
@@ -1978,11 +3279,16 @@ def delete_topic(topic_id):
 def delete_relationship(relationship_id):
     relationship = Relationship.query.get(relationship_id)
     if relationship:
-        # Delete associated messages
+        # Release their media, then delete associated messages
+        media = RelationshipMessage.query.with_entities(RelationshipMessage.image_path, RelationshipMessage.voice_path).filter(
+            RelationshipMessage.relationship_id == relationship_id).all()
+        released = release_media_refs(p for row in media for p in row)
+        delete_reactions(select(RelationshipMessage.id).where(RelationshipMessage.relationship_id == relationship_id))
         RelationshipMessage.query.filter_by(relationship_id=relationship_id).delete()
         # Delete the relationship
         db.session.delete(relationship)
         db.session.commit()
+        collect_media(released)
         return jsonify({'status': 'success'})
     return jsonify({'status': 'error', 'message': 'Relationship not found'})
 
@@ -2173,10 +3479,13 @@ def user_points():
 @login_required
 def get_topic_messages(topic_id):
     try:
-        messages = Message.query.filter_by(
-            topic_id=topic_id, 
-            is_deleted=False
-        ).order_by(Message.created_at).all()
+        # Newest page by default; pass ?before=<next_cursor> for older pages
+        try:
+            messages, next_cursor = paginate_messages(
+                Message.query.filter_by(topic_id=topic_id, is_deleted=False), Message,
+                request.args.get('before'), request.args.get('limit'))
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
         
         messages_data = []
         for message in messages:
@@ -2195,7 +3504,8 @@ def get_topic_messages(topic_id):
         
         return jsonify({
             'status': 'success',
-            'messages': messages_data
+            'messages': messages_data,
+            'next_cursor': next_cursor
         })
     
     except Exception as e:
@@ -2,11 +2,106 @@ import os
 
 class Config:
     SECRET_KEY = 'athi-river-gossip-secret-key-2024'
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///gossip.db'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///gossip.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Connection pool; pool_timeout is how long a request waits for a free connection
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', '30')),
+        'pool_pre_ping': True,
+    }
+
+    # SQLite tuning applied to every connection (see sqlite_tuning.py)
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+    SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', '20000'))
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+    # 'auto' takes the write lock at BEGIN except for read-only (GET) requests; or DEFERRED/IMMEDIATE
+    SQLITE_BEGIN_MODE = os.environ.get('SQLITE_BEGIN_MODE', 'auto')
     UPLOAD_FOLDER = 'static/uploads'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     
     # Allowed extensions
     ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-    ALLOWED_VOICE_EXTENSIONS = {'mp3', 'wav', 'ogg'}
\ No newline at end of file
+    ALLOWED_VOICE_EXTENSIONS = {'mp3', 'wav', 'ogg'}
+    # Per-type upload limits, enforced while the upload streams in (see uploads.py)
+    UPLOAD_LIMITS = {
+        'image': int(os.environ.get('MAX_IMAGE_UPLOAD_MB', '8')) * 1024 * 1024,
+        'voice': int(os.environ.get('MAX_VOICE_UPLOAD_MB', '16')) * 1024 * 1024,
+    }
+    # Uploaded images are resized/re-encoded in the background: 'process' (worker pool), 'thread' or 'inline'
+    IMAGE_PROCESSING = os.environ.get('IMAGE_PROCESSING', 'process')
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2'))
+    IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', '85'))
+    # Widths of the image variants written next to the stored upload; each also gets a WebP copy
+    IMAGE_SIZES = {
+        'thumb': int(os.environ.get('IMAGE_THUMB_WIDTH', '320')),
+        'medium': int(os.environ.get('IMAGE_MEDIUM_WIDTH', '800')),
+        'full': int(os.environ.get('IMAGE_MAX_WIDTH', '1200')),
+    }
+    IMAGE_WEBP = os.environ.get('IMAGE_WEBP', '1') not in ('0', 'false', 'False')
+    # Voice effects for voice_type (needs numpy and ffmpeg, see voice.py); renders are Ogg/Opus
+    # capped at VOICE_MAX_SECONDS and VOICE_BITRATE
+    VOICE_EFFECTS = os.environ.get('VOICE_EFFECTS', '1') not in ('0', 'false', 'False')
+    VOICE_PROCESSING = os.environ.get('VOICE_PROCESSING', 'process')
+    VOICE_WORKERS = int(os.environ.get('VOICE_WORKERS', '1'))
+    VOICE_MAX_SECONDS = int(os.environ.get('VOICE_MAX_SECONDS', '120'))
+    VOICE_BITRATE = os.environ.get('VOICE_BITRATE', '32k')
+    # Let the front proxy send upload bytes: an nginx 'internal' location prefix mapped to UPLOAD_FOLDER
+    # (e.g. /protected-uploads/), or USE_X_SENDFILE=1 for Apache/lighttpd X-Sendfile
+    UPLOADS_ACCEL_REDIRECT = os.environ.get('UPLOADS_ACCEL_REDIRECT') or None
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '0') in ('1', 'true', 'True')
+
+    # Cross-worker broadcast for SSE: 'auto' (redis when REDIS_URL is set, else sqlite), 'redis', 'sqlite' or 'memory'
+    BROADCAST_BACKEND = os.environ.get('BROADCAST_BACKEND', 'auto')
+    BROADCAST_POLL_INTERVAL = float(os.environ.get('BROADCAST_POLL_INTERVAL', '0.2'))  # sqlite backend only
+
+    # Per-subscriber SSE queue: high-water mark, overflow policy ('coalesce' or 'drop_oldest')
+    # and how long a subscriber may stay full before it is disconnected
+    SSE_QUEUE_MAX = int(os.environ.get('SSE_QUEUE_MAX', '256'))
+    SSE_OVERFLOW_POLICY = os.environ.get('SSE_OVERFLOW_POLICY', 'coalesce')
+    SSE_SLOW_CONSUMER_GRACE = float(os.environ.get('SSE_SLOW_CONSUMER_GRACE', '30'))
+    SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+    SSE_REPLAY_SIZE = int(os.environ.get('SSE_REPLAY_SIZE', '200'))  # recent events kept per room for Last-Event-ID resume
+    SSE_PRESENCE_SECONDS = float(os.environ.get('SSE_PRESENCE_SECONDS', '30'))  # active counts pushed on /stream/multi
+    # Reaction count updates are batched per message and broadcast at most once per window (0 = every toggle)
+    REACTION_BROADCAST_WINDOW = float(os.environ.get('REACTION_BROADCAST_WINDOW', '0.5'))
+
+    # WebSocket transport at /ws (requires flask-sock); HTTP endpoints stay available either way
+    WEBSOCKET_ENABLED = os.environ.get('WEBSOCKET_ENABLED', '1') not in ('0', 'false', 'False')
+    # Extra origins (e.g. https://chat.example.com) allowed to open /ws besides the site itself
+    WEBSOCKET_ALLOWED_ORIGINS = [o.strip().rstrip('/') for o in os.environ.get('WEBSOCKET_ALLOWED_ORIGINS', '').split(',') if o.strip()]
+
+    # Messages rendered per page of room history; older pages load on scroll via /api/older_messages
+    MESSAGE_PAGE_SIZE = int(os.environ.get('MESSAGE_PAGE_SIZE', '50'))
+
+    # Heartbeats are buffered in memory (and Redis when configured) and last_login is written in batches
+    PRESENCE_FLUSH_SECONDS = float(os.environ.get('PRESENCE_FLUSH_SECONDS', '15'))
+    # Active-user counts: how long a rendered count may be reused, and how often the in-memory
+    # windows are re-seeded from the database/presence store (picks up other workers' activity)
+    ACTIVE_COUNT_CACHE_SECONDS = float(os.environ.get('ACTIVE_COUNT_CACHE_SECONDS', '5'))
+    ACTIVE_COUNT_RESEED_SECONDS = float(os.environ.get('ACTIVE_COUNT_RESEED_SECONDS', '60'))
+    # Room presence in Redis (sorted sets): entries older than this are trimmed, and an idle room's
+    # key expires after it (never less than the active window)
+    PRESENCE_REDIS_RETENTION_SECONDS = int(os.environ.get('PRESENCE_REDIS_RETENTION_SECONDS', '3600'))
+    # How often stale in-memory presence, activity and rate-limit entries are swept
+    JANITOR_INTERVAL_SECONDS = float(os.environ.get('JANITOR_INTERVAL_SECONDS', '60'))
+
+    # Number of reverse proxies in front of the app (Render: 1); their X-Forwarded-For/-Proto are
+    # trusted for the client address and scheme. Leave at 0 when clients connect directly.
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', '0'))
+
+    # Rate limits per user (failed logins: per username and client address): bucket -> (requests, window seconds).
+    # Shared between workers through Redis when REDIS_URL is set.
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') not in ('0', 'false', 'False')
+    RATE_LIMITS = {
+        'send': (20, 10),        # topic, relationship and private messages
+        'reply': (20, 10),
+        'react': (60, 10),
+        'ping': (60, 60),        # /api/ping and /api/room_ping together
+        'login': (10, 300),      # failed attempts only
+        'admin_chat': (3, 600),  # starting a private chat with the admins
+        'search': (30, 60),
+    }
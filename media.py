@@ -0,0 +1,92 @@
+"""Background processing for uploads.
+
+Requests store the upload as received (utils.store_image / save_voice) and hand the file to a
+MediaProcessor, which runs process_fn in a worker pool so resizing a large photo
+(utils.make_image_variants) or rendering a voice effect (voice.render_voice) does not hold up
+the request or its worker. on_done(ok, result)
+is called from the pool's callback thread once the file has been processed, with the job's
+return value (ok=False and result None if it failed; the original upload is left in place
+and is still served).
+
+Modes: 'process' (default; a spawn-based process pool, so CPU-heavy work escapes the GIL and
+nothing is forked from a threaded server), 'thread', or 'inline' (process synchronously;
+handy for tests and scripts).
+"""
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from utils import make_image_variants
+
+
+class MediaProcessor:
+    def __init__(self, mode='process', workers=2, options=None, process_fn=None, logger=None, kind='image'):
+        self.kind = kind  # for thread names and log messages
+        self.mode = mode
+        self.workers = workers
+        self.options = options or {}  # keyword arguments for process_fn
+        self.process_fn = process_fn or make_image_variants  # must be picklable in 'process' mode
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._executor = None
+        self.pending = 0    # jobs submitted and not finished
+        self.processed = 0
+        self.failed = 0
+
+    def _get_executor(self):
+        # created on first use so each server worker starts its own pool after forking
+        with self._lock:
+            if self._executor is None:
+                if self.mode == 'process':
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.kind)
+            return self._executor
+
+    def submit(self, file_path, on_done=None, **kwargs):
+        """Queue file_path for processing; kwargs add to options for this job. Returns a Future."""
+        kwargs = {**self.options, **kwargs}
+        with self._lock:
+            self.pending += 1
+        if self.mode == 'inline':
+            future = Future()
+            try:
+                future.set_result(self.process_fn(file_path, **kwargs))
+            except Exception as exc:
+                future.set_exception(exc)
+            self._finished(future, file_path, on_done)
+            return future
+        try:
+            future = self._get_executor().submit(self.process_fn, file_path, **kwargs)
+        except Exception as exc:
+            # pool broken or shut down: report the failure instead of losing the message
+            future = Future()
+            future.set_exception(exc)
+            self._finished(future, file_path, on_done)
+            return future
+        future.add_done_callback(lambda f: self._finished(f, file_path, on_done))
+        return future
+
+    def _finished(self, future, file_path, on_done):
+        ok = future.exception() is None
+        with self._lock:
+            self.pending -= 1
+            if ok:
+                self.processed += 1
+            else:
+                self.failed += 1
+        if not ok and self.logger:
+            self.logger.error('%s processing failed for %s: %r', self.kind.capitalize(), file_path, future.exception())
+        if on_done is not None:
+            try:
+                on_done(ok, future.result() if ok else None)
+            except Exception:
+                if self.logger:
+                    self.logger.exception('%s processing callback failed', self.kind.capitalize())
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
@@ -0,0 +1,26 @@
+"""
+Migration script to add the image_variants column to message and relationship_message.
+Safe to run repeatedly: tables that already have the column are skipped. Images uploaded
+before this migration have no variants and keep being served as stored.
+"""
+from app import app
+from models import db
+from sqlalchemy import inspect
+
+
+def add_image_variants_column():
+    with app.app_context():
+        engine = db.engine
+        insp = inspect(engine)
+        for table in ('message', 'relationship_message'):
+            if any(col['name'] == 'image_variants' for col in insp.get_columns(table)):
+                print(f'{table}.image_variants already exists.')
+                continue
+            with engine.begin() as conn:
+                conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN image_variants TEXT')
+            print(f'{table}.image_variants added.')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    add_image_variants_column()
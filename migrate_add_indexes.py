@@ -0,0 +1,34 @@
+"""
+Migration script to create the composite indexes declared in models.py
+(message history, presence and unread-count queries).
+Safe to run repeatedly: indexes that already exist are skipped.
+"""
+from app import app
+from models import db
+from sqlalchemy import inspect
+
+
+def add_indexes():
+    with app.app_context():
+        engine = db.engine
+        insp = inspect(engine)
+        existing_tables = set(insp.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                print(f'{table.name}: table missing, skipped (run ensure_db first).')
+                continue
+            existing = {ix['name'] for ix in insp.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    print(f'{index.name} already exists.')
+                    continue
+                index.create(bind=engine)
+                print(f'{index.name} created on {table.name}.')
+        # Refresh planner statistics so SQLite picks up the new indexes
+        if engine.dialect.name == 'sqlite':
+            with engine.begin() as conn:
+                conn.exec_driver_sql('ANALYZE')
+
+
+if __name__ == '__main__':
+    add_indexes()
@@ -0,0 +1,19 @@
+"""
+Migration script to create the media_object table (content-addressed upload store) and
+register the uploads already referenced by messages, with their reference counts.
+Safe to run repeatedly: counts are recomputed from the message tables each time.
+Existing files keep their paths; only new uploads are stored by content hash.
+"""
+from app import app, reconcile_media_refs
+from models import db, MediaObject
+
+
+def add_media_store():
+    with app.app_context():
+        MediaObject.__table__.create(bind=db.engine, checkfirst=True)
+        changed = reconcile_media_refs()
+        print(f'media_object ready; {changed} objects registered or recounted.')
+
+
+if __name__ == '__main__':
+    add_media_store()
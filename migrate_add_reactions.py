@@ -0,0 +1,51 @@
+"""
+Migration script to create the message_reaction and reaction_count tables and copy in the
+reactions stored as JSON on message.reactions ({emoji: [user ids]}).
+Safe to run repeatedly: existing reaction rows are kept and the counts are recomputed from
+message_reaction each time. The legacy column is left in place but no longer read.
+"""
+import json
+
+from sqlalchemy import func, insert, select
+
+from app import app
+from models import db, Message, MessageReaction, ReactionCount, User
+
+
+def add_reactions():
+    with app.app_context():
+        MessageReaction.__table__.create(bind=db.engine, checkfirst=True)
+        ReactionCount.__table__.create(bind=db.engine, checkfirst=True)
+
+        user_ids = {row[0] for row in db.session.query(User.id)}
+        existing = set(db.session.query(MessageReaction.message_id, MessageReaction.user_id, MessageReaction.emoji))
+        rows = []
+        legacy = db.session.query(Message.id, Message.reactions).filter(Message.reactions.isnot(None))
+        for message_id, raw in legacy:
+            try:
+                reactions = json.loads(raw) if raw else {}
+            except ValueError:
+                continue
+            if not isinstance(reactions, dict):
+                continue
+            for emoji, users in reactions.items():
+                if not emoji or len(emoji) > 16 or not isinstance(users, list):
+                    continue
+                for user_id in set(map(str, users)) & user_ids:
+                    if (message_id, user_id, emoji) not in existing:
+                        existing.add((message_id, user_id, emoji))
+                        rows.append({'message_id': message_id, 'user_id': user_id, 'emoji': emoji})
+        if rows:
+            db.session.execute(insert(MessageReaction), rows)
+
+        db.session.query(ReactionCount).delete()
+        db.session.execute(insert(ReactionCount).from_select(
+            ['message_id', 'emoji', 'count'],
+            select(MessageReaction.message_id, MessageReaction.emoji, func.count())
+            .group_by(MessageReaction.message_id, MessageReaction.emoji)))
+        db.session.commit()
+        print(f'message_reaction ready; {len(rows)} legacy reactions copied, counts recomputed.')
+
+
+if __name__ == '__main__':
+    add_reactions()
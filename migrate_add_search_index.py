@@ -0,0 +1,32 @@
+"""
+Migration script to create the FTS5 message search indexes and their triggers (see search.py)
+and fill them from the existing topic, relationship and private messages.
+Safe to run repeatedly: existing indexes are kept. Pass --rebuild to re-read every message,
+e.g. after a VACUUM.
+"""
+import sys
+
+from app import app
+from models import db
+import search as search_index
+
+
+def add_search_index(rebuild=False):
+    with app.app_context():
+        with db.engine.begin() as conn:
+            created = search_index.install(conn)
+            if created is None:
+                print('Search needs SQLite with FTS5; nothing done.')
+                return
+            for kind in search_index.INDEXED_TABLES:
+                if kind in created:
+                    print(f'{search_index.fts_table(kind)} created and filled.')
+                elif rebuild:
+                    search_index.rebuild(conn, kind)
+                    print(f'{search_index.fts_table(kind)} rebuilt.')
+                else:
+                    print(f'{search_index.fts_table(kind)} already exists.')
+
+
+if __name__ == '__main__':
+    add_search_index(rebuild='--rebuild' in sys.argv[1:])
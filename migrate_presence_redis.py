@@ -0,0 +1,24 @@
+"""
+Migration script to delete the old per-room presence hashes (presence:topic:<id>,
+presence:relationship:<id>) left in Redis by the hash-based presence store.
+Room presence now lives in sorted sets under presence:room:<room_key>, which expire on
+their own; the old hashes had no TTL. Safe to run repeatedly.
+"""
+from app import _redis_client
+
+
+def drop_legacy_presence_hashes():
+    if _redis_client is None:
+        print('REDIS_URL not set; nothing to do.')
+        return
+    removed = 0
+    for pattern in ('presence:topic:*', 'presence:relationship:*', 'presence:chat:*'):
+        for key in _redis_client.scan_iter(match=pattern, count=500):
+            if _redis_client.type(key) in (b'hash', 'hash'):
+                _redis_client.delete(key)
+                removed += 1
+    print(f'Removed {removed} legacy presence hashes.')
+
+
+if __name__ == '__main__':
+    drop_legacy_presence_hashes()
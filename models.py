@@ -34,6 +34,11 @@ class User(UserMixin, db.Model):
     def get_id(self):
         return self.id
 
+    __table_args__ = (
+        # Active-user counts filter approved users by a recent last_login
+        db.Index('ix_user_status_last_login', 'status', 'last_login'),
+    )
+
 class Topic(db.Model):
     is_locked = db.Column(db.Boolean, default=False)
     lock_password = db.Column(db.String(128))  # hashed password
@@ -50,19 +55,26 @@ class Message(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     content = db.Column(db.Text)
     image_path = db.Column(db.String(200))
+    image_variants = db.Column(db.Text)  # JSON {size: width} of the resized copies next to image_path
     voice_path = db.Column(db.String(200))
     topic_id = db.Column(db.String(36), db.ForeignKey('topic.id'))
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'))
     identity_revealed = db.Column(db.Boolean, default=False)
     voice_type = db.Column(db.String(20), default='normal')  # normal, cartoon, deep, female
     parent_id = db.Column(db.String(36), db.ForeignKey('message.id'))  # For replies
-    reactions = db.Column(db.Text)  # JSON string of reactions
+    reactions = db.Column(db.Text)  # legacy JSON {emoji: [user ids]}; reactions now live in MessageReaction
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_deleted = db.Column(db.Boolean, default=False)
     
     user = db.relationship('User', backref='messages')
     replies = db.relationship('Message', backref=db.backref('parent', remote_side=[id]))
 
+    __table_args__ = (
+        # Room history pages on (created_at, id) within a topic; active counts read distinct authors
+        db.Index('ix_message_topic_deleted_created', 'topic_id', 'is_deleted', 'created_at', 'id'),
+        db.Index('ix_message_topic_user', 'topic_id', 'user_id'),
+    )
+
 class Relationship(db.Model):
     is_locked = db.Column(db.Boolean, default=False)
     lock_password = db.Column(db.String(128))  # hashed password
@@ -109,6 +121,7 @@ class RelationshipMessage(db.Model):
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'))
     content = db.Column(db.Text, nullable=False)
     image_path = db.Column(db.String(200))
+    image_variants = db.Column(db.Text)  # JSON {size: width}, as on Message
     voice_path = db.Column(db.String(200))
     identity_revealed = db.Column(db.Boolean, default=False)
     voice_type = db.Column(db.String(20), default='normal')  # normal, cartoon, deep, female
@@ -116,6 +129,11 @@ class RelationshipMessage(db.Model):
     user = db.relationship('User')
     relationship = db.relationship('Relationship', backref='messages')
 
+    __table_args__ = (
+        db.Index('ix_relationship_message_rel_created', 'relationship_id', 'created_at', 'id'),
+        db.Index('ix_relationship_message_rel_user', 'relationship_id', 'user_id'),
+    )
+
 class RelationshipForcedIdentity(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'))
@@ -154,6 +172,11 @@ class PrivateMessage(db.Model):
     user = db.relationship('User')
     chat = db.relationship('PrivateChat', backref='messages')
 
+    __table_args__ = (
+        db.Index('ix_private_message_chat_created', 'chat_id', 'created_at', 'id'),
+        db.Index('ix_private_message_chat_read', 'chat_id', 'is_read'),
+    )
+
 
 class BreakingNews(db.Model):
     """Simple model for site-wide breaking news messages posted by admins."""
@@ -164,3 +187,33 @@ class BreakingNews(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     
     admin = db.relationship('User')
+
+
+class MediaObject(db.Model):
+    """An uploaded file in the content-addressed store, shared by every message that posted the same bytes."""
+    path = db.Column(db.String(200), primary_key=True)  # under UPLOAD_FOLDER, e.g. images/ab/cd/<sha256>.png
+    kind = db.Column(db.String(10), nullable=False)  # image or voice
+    sha256 = db.Column(db.String(64))  # of the upload as received
+    size = db.Column(db.Integer)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # messages using it; collected at 0
+    variants = db.Column(db.Text)  # JSON {size: width} once the image workers have processed it
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_media_object_ref_count', 'ref_count'),
+    )
+
+
+class MessageReaction(db.Model):
+    """One user's emoji reaction on a topic or relationship message; toggling inserts or deletes the row."""
+    message_id = db.Column(db.String(36), primary_key=True)  # Message or RelationshipMessage id
+    user_id = db.Column(db.String(36), db.ForeignKey('user.id'), primary_key=True)
+    emoji = db.Column(db.String(16), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ReactionCount(db.Model):
+    """Number of MessageReaction rows per (message, emoji), moved by one on every toggle."""
+    message_id = db.Column(db.String(36), primary_key=True)
+    emoji = db.Column(db.String(16), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
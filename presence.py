@@ -0,0 +1,321 @@
+"""Presence tracking: write-behind last_login buffer and in-memory active-user windows.
+
+Heartbeats land here instead of committing a row update each time. The buffer remembers
+when each user was last seen, answers "who was seen since X" for active counts, and a
+background thread writes the pending timestamps to the database in one batched UPDATE
+every flush interval.
+
+With a Redis client the last-seen times are also kept in a shared sorted set, so every
+worker sees heartbeats received by the others; without Redis each process only knows
+its own heartbeats plus whatever has already been flushed to the database.
+
+ActivityWindow answers "how many users are active in room X" from memory; it is fed by pings
+and posts and periodically re-seeded from the shared store.
+
+Janitor runs periodic sweeps over this per-process state so rooms and users that are never seen
+again do not stay in memory for the life of the worker.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def utc_timestamp(dt):
+    """Epoch seconds for a naive UTC datetime (datetime.timestamp() would assume local time)."""
+    return (dt - _EPOCH).total_seconds()
+
+
+def from_utc_timestamp(seconds):
+    return _EPOCH + timedelta(seconds=float(seconds))
+
+
+class PresenceBuffer:
+    def __init__(self, flush_fn, interval=15, redis_client=None, redis_key='presence:last_seen',
+                 retention=3600, logger=None):
+        """flush_fn(rows) persists [{'id': user_id, 'last_login': datetime}, ...] in one batch."""
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.redis = redis_client
+        self.redis_key = redis_key
+        self.retention = retention  # seconds of history kept for seen_since()
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._seen = {}     # user_id -> last heartbeat (datetime, UTC)
+        self._pending = {}  # user_id -> heartbeat not yet written to the database
+        self._thread = None
+        self._stop = threading.Event()
+        self.flushed = 0    # rows written since start, for diagnostics
+
+    def start(self):
+        """Start the flush thread (idempotent)."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='presence-flush', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def touch(self, user_id, ts=None):
+        """Record a heartbeat for user_id; cheap enough to call on every ping."""
+        ts = ts or datetime.utcnow()
+        user_id = str(user_id)
+        with self._lock:
+            self._seen[user_id] = ts
+            self._pending[user_id] = ts
+        if self.redis is not None:
+            try:
+                score = utc_timestamp(ts)
+                pipe = self.redis.pipeline()
+                pipe.zadd(self.redis_key, {user_id: score})
+                pipe.zremrangebyscore(self.redis_key, '-inf', score - self.retention)
+                pipe.execute()
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Presence heartbeat to Redis failed; keeping it local')
+        self.start()
+
+    def seen_since(self, since_dt):
+        """Return {user_id: last_seen} for users with a heartbeat at or after since_dt."""
+        result = {}
+        if self.redis is not None:
+            try:
+                rows = self.redis.zrangebyscore(self.redis_key, utc_timestamp(since_dt), '+inf', withscores=True)
+                for member, score in rows:
+                    uid = member.decode() if isinstance(member, bytes) else str(member)
+                    result[uid] = from_utc_timestamp(score)
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Presence read from Redis failed; using local heartbeats')
+        with self._lock:
+            for uid, ts in self._seen.items():
+                if ts >= since_dt and (uid not in result or result[uid] < ts):
+                    result[uid] = ts
+        return result
+
+    def last_seen(self, user_id):
+        return self._seen.get(str(user_id))
+
+    def flush(self):
+        """Write pending heartbeats to the database; returns the number of rows written."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # forget local entries too old to matter for any active window
+            if self._seen:
+                cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+                self._seen = {uid: ts for uid, ts in self._seen.items() if ts >= cutoff}
+        if not pending:
+            return 0
+        rows = [{'id': uid, 'last_login': ts} for uid, ts in pending.items()]
+        try:
+            self.flush_fn(rows)
+        except Exception:
+            # put them back (unless a newer heartbeat arrived meanwhile) and retry next round
+            with self._lock:
+                for uid, ts in pending.items():
+                    if uid not in self._pending:
+                        self._pending[uid] = ts
+            if self.logger:
+                self.logger.exception('Presence flush failed; will retry')
+            return 0
+        self.flushed += len(rows)
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+
+class ActivityWindow:
+    """Sliding-window record of who was active in each room key, answered from memory.
+
+    Each key holds an OrderedDict of user_id -> last activity, oldest first. touch() moves the
+    user to the end and count() pops expired entries off the front, so both are O(1) amortized
+    instead of a COUNT/DISTINCT query per call. window_fn returns the window length in seconds
+    (read on every call, so admin changes apply immediately).
+    """
+
+    def __init__(self, window_fn):
+        self.window_fn = window_fn
+        self._lock = threading.Lock()
+        self._rooms = {}   # key -> OrderedDict(user_id -> datetime)
+        self._seeded = {}  # key -> time.monotonic() of the last merge from the store
+
+    def touch(self, key, user_id, ts=None):
+        ts = ts or datetime.utcnow()
+        user_id = str(user_id)
+        with self._lock:
+            room = self._rooms.setdefault(key, OrderedDict())
+            prev = room.get(user_id)
+            if prev is not None and prev >= ts:
+                return
+            room[user_id] = ts
+            room.move_to_end(user_id)
+
+    def merge(self, key, entries):
+        """Fold {user_id: last_seen} from a shared store (DB/Redis) into key, keeping the newest times."""
+        with self._lock:
+            room = self._rooms.setdefault(key, OrderedDict())
+            for uid, ts in entries.items():
+                uid = str(uid)
+                if ts is not None and (uid not in room or room[uid] < ts):
+                    room[uid] = ts
+            # merged entries can arrive out of order; restore oldest-first
+            self._rooms[key] = OrderedDict(sorted(room.items(), key=lambda kv: kv[1]))
+            self._seeded[key] = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._seeded.clear()
+
+    def needs_seed(self, key, interval):
+        last = self._seeded.get(key)
+        return last is None or time.monotonic() - last >= interval
+
+    def _prune(self, key, now):
+        room = self._rooms.get(key)
+        if not room:
+            return room
+        cutoff = now - timedelta(seconds=self.window_fn())
+        while room:
+            uid, ts = next(iter(room.items()))
+            if ts >= cutoff:
+                break
+            room.popitem(last=False)
+        return room
+
+    def sweep(self, now=None):
+        """Expire entries in every key and drop empty keys; returns (reclaimed, held) entry counts."""
+        now = now or datetime.utcnow()
+        reclaimed = 0
+        with self._lock:
+            for key in list(self._rooms):
+                before = len(self._rooms[key])
+                room = self._prune(key, now)
+                reclaimed += before - len(room)
+                if not room:
+                    del self._rooms[key]
+                    self._seeded.pop(key, None)
+            held = sum(len(room) for room in self._rooms.values())
+        return reclaimed, held
+
+    def count(self, key, now=None):
+        with self._lock:
+            room = self._prune(key, now or datetime.utcnow())
+            return len(room) if room else 0
+
+    def users(self, key, now=None):
+        with self._lock:
+            room = self._prune(key, now or datetime.utcnow())
+            return set(room) if room else set()
+
+
+class TTLCache:
+    """Tiny memo for values that may be a few seconds stale (e.g. rendered active counts)."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._values = {}  # key -> (expires_at, value)
+
+    def get(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            hit = self._values.get(key)
+            if hit and hit[0] > now:
+                return hit[1]
+        value = compute()
+        with self._lock:
+            self._values[key] = (now + self.ttl, value)
+        return value
+
+    def sweep(self):
+        """Drop expired values; returns (reclaimed, held)."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (expires_at, _) in self._values.items() if expires_at <= now]
+            for key in expired:
+                del self._values[key]
+            return len(expired), len(self._values)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Janitor:
+    """Runs registered sweeps every interval seconds on a daemon thread and keeps their metrics.
+
+    A sweep is a callable returning (reclaimed, held): entries removed this round and entries
+    still held afterwards.
+    """
+
+    def __init__(self, interval=60, logger=None):
+        self.interval = interval
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._sweeps = {}  # name -> callable
+        self._stats = {}   # name -> {'held', 'reclaimed', 'reclaimed_total'}
+        self._thread = None
+        self._stop = threading.Event()
+        self.runs = 0
+        self.last_run = None
+
+    def add(self, name, sweep):
+        with self._lock:
+            self._sweeps[name] = sweep
+            self._stats[name] = {'held': 0, 'reclaimed': 0, 'reclaimed_total': 0}
+
+    def start(self):
+        """Start the sweep thread (idempotent)."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='janitor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        """Run every sweep now; returns {name: reclaimed}. A failing sweep does not stop the others."""
+        with self._lock:
+            sweeps = list(self._sweeps.items())
+        result = {}
+        for name, sweep in sweeps:
+            try:
+                reclaimed, held = sweep()
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Janitor sweep %s failed', name)
+                continue
+            with self._lock:
+                stats = self._stats[name]
+                stats['held'] = held
+                stats['reclaimed'] = reclaimed
+                stats['reclaimed_total'] += reclaimed
+            result[name] = reclaimed
+        self.runs += 1
+        self.last_run = datetime.utcnow()
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval': self.interval,
+                'runs': self.runs,
+                'last_run': self.last_run.isoformat() if self.last_run else None,
+                'sweeps': {name: dict(stats) for name, stats in self._stats.items()},
+            }
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
@@ -0,0 +1,130 @@
+"""Sliding-window rate limiting for chat endpoints.
+
+Each (bucket, client) pair keeps a log of recent hit times. A hit is allowed while fewer than
+`limit` hits fall inside the last `window` seconds. Without Redis the log is a deque per key
+(expired hits pop off the left in O(1)) and only covers this process. With a Redis client the
+log is a sorted set shared by every worker, trimmed and counted in one pipelined round trip.
+If Redis fails, the local deques take over so that a Redis outage doesn't block chat.
+"""
+import threading
+import time
+import uuid
+from collections import deque
+
+
+class SlidingWindowLimiter:
+    def __init__(self, redis_client=None, prefix='ratelimit:', logger=None):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._hits = {}  # key -> deque of hit times (time.time()), oldest first
+        self._windows = {}  # key -> window seconds, used by sweep()
+        self.denied = 0  # hits refused since start, for diagnostics
+
+    def hit(self, key, limit, window):
+        """Count one hit for key; returns (allowed, retry_after_seconds)."""
+        now = time.time()
+        result = None
+        if self.redis is not None:
+            try:
+                result = self._hit_redis(key, limit, window, now)
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Redis rate limit failed; using the local limiter')
+        if result is None:
+            result = self._hit_local(key, limit, window, now)
+        if not result[0]:
+            self.denied += 1
+        return result
+
+    def _hit_local(self, key, limit, window, now):
+        cutoff = now - window
+        with self._lock:
+            hits = self._hits.get(key)
+            if hits is None:
+                hits = self._hits[key] = deque()
+                self._windows[key] = window
+            while hits and hits[0] <= cutoff:
+                hits.popleft()
+            if len(hits) >= limit:
+                return False, max(1, int(hits[0] + window - now + 0.999))
+            hits.append(now)
+            return True, None
+
+    def _hit_redis(self, key, limit, window, now):
+        rkey = self.prefix + key
+        member = f'{now:.6f}:{uuid.uuid4().hex[:8]}'
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zremrangebyscore(rkey, '-inf', now - window)
+        pipe.zadd(rkey, {member: now})
+        pipe.zcard(rkey)
+        pipe.zrange(rkey, 0, 0, withscores=True)
+        pipe.expire(rkey, int(window) + 1)
+        _, _, count, oldest, _ = pipe.execute()
+        if count <= limit:
+            return True, None
+        # over budget: this hit doesn't count against the client
+        self.redis.zrem(rkey, member)
+        oldest_ts = oldest[0][1] if oldest else now
+        return False, max(1, int(oldest_ts + window - now + 0.999))
+
+    def retry_after(self, key, limit, window):
+        """Seconds until key may hit again if it has used up its budget, else None; counts nothing.
+
+        For budgets that only charge some outcomes (failed logins): check first, hit() on failure.
+        """
+        now = time.time()
+        if self.redis is not None:
+            try:
+                result = self._retry_after_redis(key, limit, window, now)
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Redis rate limit failed; using the local limiter')
+                result = self._retry_after_local(key, limit, window, now)
+        else:
+            result = self._retry_after_local(key, limit, window, now)
+        if result is not None:
+            self.denied += 1
+        return result
+
+    def _retry_after_local(self, key, limit, window, now):
+        cutoff = now - window
+        with self._lock:
+            hits = self._hits.get(key)
+            while hits and hits[0] <= cutoff:
+                hits.popleft()
+            if not hits or len(hits) < limit:
+                return None
+            return max(1, int(hits[-limit] + window - now + 0.999))
+
+    def _retry_after_redis(self, key, limit, window, now):
+        rkey = self.prefix + key
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zremrangebyscore(rkey, '-inf', now - window)
+        pipe.zrange(rkey, -limit, -limit, withscores=True)
+        _, oldest = pipe.execute()
+        if not oldest:
+            return None
+        return max(1, int(oldest[0][1] + window - now + 0.999))
+
+    def reset(self):
+        with self._lock:
+            self._hits.clear()
+            self._windows.clear()
+
+    def sweep(self):
+        """Drop keys whose hits have all expired; returns (reclaimed, held) for the janitor."""
+        now = time.time()
+        reclaimed = 0
+        with self._lock:
+            for key in list(self._hits):
+                hits = self._hits[key]
+                cutoff = now - self._windows.get(key, 0)
+                while hits and hits[0] <= cutoff:
+                    hits.popleft()
+                if not hits:
+                    del self._hits[key]
+                    self._windows.pop(key, None)
+                    reclaimed += 1
+            return reclaimed, len(self._hits)
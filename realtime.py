@@ -0,0 +1,590 @@
+"""Real-time broadcast hub used by the SSE endpoints.
+
+Each open ``/stream`` connection owns a lightweight ``Subscriber``. Publishing
+serializes the payload once and hands the same pre-built frame to every
+subscriber of the room, so fan-out cost does not depend on the payload size.
+
+The hub only uses ``threading`` primitives, so when gunicorn runs with the
+gevent worker class (``gunicorn -k gevent``) they are monkey-patched into
+greenlet-friendly versions and an idle subscriber costs one parked greenlet
+instead of a whole worker thread.
+
+Publishing goes through a broker so that events reach subscribers parked in
+other gunicorn workers or on other nodes (see ``make_broker``). The broker
+also assigns each event a monotonically increasing id; the hub keeps a small
+ring buffer of recent frames per room so a client reconnecting with
+``Last-Event-ID`` is replayed only what it missed. A subscriber may listen on
+several rooms at once, which the multiplexed stream uses.
+"""
+import json
+import sqlite3
+import threading
+import time
+import itertools
+from collections import OrderedDict, deque
+from contextlib import closing
+
+
+RESYNC_FRAME = 'data: {"type": "resync"}\n\n'
+
+
+def format_frame(data, event_id=None):
+    """Build the SSE wire frame for one serialized event."""
+    if event_id is None:
+        return f"data: {data}\n\n"
+    return f"id: {event_id}\ndata: {data}\n\n"
+
+
+def parse_frame(frame):
+    """Split an SSE frame built by ``format_frame`` into (event_id or None, data)."""
+    event_id = None
+    if frame.startswith('id: '):
+        head, _, frame = frame.partition('\n')
+        event_id = int(head[4:])
+    return event_id, frame[len('data: '):].rstrip('\n')
+
+
+# Subscriber.push outcomes
+DELIVERED = 'delivered'
+COALESCED = 'coalesced'
+DROPPED = 'dropped'
+EVICTED = 'evicted'
+
+
+class Subscriber:
+    """A single SSE connection waiting for events on one or more rooms.
+
+    The pending queue is bounded by ``max_pending``. Events published with a
+    ``coalesce_key`` replace a still-pending event with the same key (e.g. many
+    reaction updates for one message collapse into the latest one); otherwise
+    the oldest event is dropped once the queue is full. A subscriber that stays
+    full for longer than ``grace`` seconds is evicted so its client reconnects.
+    """
+
+    def __init__(self, max_pending=256, coalesce=True, grace=30):
+        self.rooms = set()
+        # frames from control rooms are handed to the stream itself instead of the client
+        self.control_rooms = set()
+        self._control = deque()
+        self.max_pending = max_pending
+        self.coalesce = coalesce
+        self.grace = grace
+        self._pending = deque()  # [coalesce_key, data] entries
+        self._by_key = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._full_since = None
+        self.dropped = 0
+        self.closed = False
+
+    def push(self, frame, coalesce_key=None, room_key=None):
+        with self._lock:
+            if self.closed:
+                return EVICTED
+            if room_key is not None and room_key in self.control_rooms:
+                self._control.append(frame)
+                self._wakeup.set()
+                return DELIVERED
+            if coalesce_key is not None and self.coalesce:
+                entry = self._by_key.get(coalesce_key)
+                if entry is not None:
+                    entry[1] = frame
+                    return COALESCED
+            outcome = DELIVERED
+            if len(self._pending) >= self.max_pending:
+                now = time.monotonic()
+                if self._full_since is None:
+                    self._full_since = now
+                elif now - self._full_since > self.grace:
+                    self.closed = True
+                    self._pending.clear()
+                    self._by_key.clear()
+                    self._wakeup.set()
+                    return EVICTED
+                old = self._pending.popleft()
+                if old[0] is not None and self._by_key.get(old[0]) is old:
+                    del self._by_key[old[0]]
+                self.dropped += 1
+                outcome = DROPPED
+            entry = [coalesce_key, frame]
+            self._pending.append(entry)
+            if coalesce_key is not None and self.coalesce:
+                self._by_key[coalesce_key] = entry
+        self._wakeup.set()
+        return outcome
+
+    def _pop(self):
+        with self._lock:
+            if not self._pending:
+                return None
+            entry = self._pending.popleft()
+            key, frame = entry
+            if key is not None and self._by_key.get(key) is entry:
+                del self._by_key[key]
+            if len(self._pending) < self.max_pending:
+                self._full_since = None
+            return frame
+
+    def get(self, timeout=None):
+        """Return the next pending SSE frame.
+
+        Returns None if ``timeout`` expires, the subscriber is closed, or control
+        frames are waiting (see ``pop_control``).
+        """
+        while True:
+            frame = self._pop()
+            if frame is not None:
+                return frame
+            if self.closed or self._control:
+                return None
+            self._wakeup.clear()
+            # re-check after clearing so a push between _pop and clear is not lost
+            if self._pending or self._control:
+                continue
+            if not self._wakeup.wait(timeout):
+                return None
+
+    def pop_control(self):
+        with self._lock:
+            frames = list(self._control)
+            self._control.clear()
+        return frames
+
+    def close(self):
+        self.closed = True
+        self._wakeup.set()
+
+
+class BroadcastHub:
+    """Room key -> subscribers registry with serialize-once fan-out.
+
+    ``max_pending``, ``coalesce`` and ``grace`` configure each subscriber's
+    queue (see ``Subscriber``). Dropped events and evicted subscribers are
+    counted per room.
+
+    The last ``replay_size`` frames of each room (for at most ``replay_rooms``
+    rooms, least recently published first out) are kept for ``Last-Event-ID``
+    resume; rooms starting with a ``replay_exclude`` prefix are not buffered. Events with ids at or below ``replay_floor`` were never seen by this
+    process, so a resume from before the floor gets a resync event instead.
+    """
+
+    def __init__(self, max_pending=256, coalesce=True, grace=30, replay_size=200, replay_rooms=1000, replay_exclude=()):
+        self.max_pending = max_pending
+        self.coalesce = coalesce
+        self.grace = grace
+        self.replay_size = replay_size
+        self.replay_rooms = replay_rooms
+        self.replay_exclude = tuple(replay_exclude)
+        self._rooms = {}
+        self._history = OrderedDict()  # room_key -> deque of (event_id, frame)
+        self._room_floor = {}
+        self.replay_floor = 0
+        self.last_event_id = 0
+        self._lock = threading.Lock()
+        self.dropped = {}
+        self.evicted = {}
+
+    def set_replay_floor(self, event_id):
+        with self._lock:
+            self.replay_floor = max(self.replay_floor, event_id)
+            self.last_event_id = max(self.last_event_id, event_id)
+
+    def subscribe(self, room_keys, last_event_id=None, control_room=None):
+        """Register a subscriber on one room key or a list of them.
+
+        With ``last_event_id`` the queue is pre-filled with the frames missed in
+        those rooms, in event id order. Replay and registration happen under the
+        hub lock, so every event is either replayed or delivered live, never both.
+        ``control_room`` is an extra room whose frames go to ``pop_control``.
+        """
+        if isinstance(room_keys, str):
+            room_keys = [room_keys]
+        sub = Subscriber(max_pending=self.max_pending, coalesce=self.coalesce, grace=self.grace)
+        with self._lock:
+            if last_event_id is not None:
+                for frame in self._replay(room_keys, last_event_id):
+                    sub.push(frame)
+            for room_key in room_keys:
+                self._add(sub, room_key)
+            if control_room is not None:
+                sub.control_rooms.add(control_room)
+                self._add(sub, control_room)
+        return sub
+
+    def add_rooms(self, sub, room_keys):
+        with self._lock:
+            if sub.closed:
+                return
+            for room_key in room_keys:
+                self._add(sub, room_key)
+
+    def remove_rooms(self, sub, room_keys):
+        with self._lock:
+            for room_key in room_keys:
+                self._discard(sub, room_key)
+
+    def _add(self, sub, room_key):
+        self._rooms.setdefault(room_key, set()).add(sub)
+        sub.rooms.add(room_key)
+
+    def _discard(self, sub, room_key):
+        sub.rooms.discard(room_key)
+        subs = self._rooms.get(room_key)
+        if not subs:
+            return
+        subs.discard(sub)
+        if not subs:
+            # drop empty rooms so the registry does not grow with every room ever opened
+            self._rooms.pop(room_key, None)
+
+    def _replay(self, room_keys, last_event_id):
+        if last_event_id > self.last_event_id:
+            # ids were reset by a restart
+            return [RESYNC_FRAME]
+        missed = []
+        for room_key in room_keys:
+            floor = max(self.replay_floor, self._room_floor.get(room_key, 0))
+            if last_event_id < floor:
+                # missed events fell out of the buffer
+                return [RESYNC_FRAME]
+            history = self._history.get(room_key, ())
+            missed.extend(item for item in history if item[0] > last_event_id)
+        missed.sort(key=lambda item: item[0])
+        return [frame for _, frame in missed]
+
+    def _remember(self, room_key, event_id, frame):
+        self.last_event_id = max(self.last_event_id, event_id)
+        history = self._history.get(room_key)
+        if history is None:
+            history = self._history[room_key] = deque(maxlen=self.replay_size)
+            if len(self._history) > self.replay_rooms:
+                _, old = self._history.popitem(last=False)
+                if old:
+                    # history for that room is gone: nothing up to its newest id can be replayed
+                    self.replay_floor = max(self.replay_floor, old[-1][0])
+        else:
+            self._history.move_to_end(room_key)
+        if len(history) == history.maxlen:
+            self._room_floor[room_key] = history[0][0]
+        history.append((event_id, frame))
+
+    def unsubscribe(self, sub):
+        sub.close()
+        with self._lock:
+            for room_key in list(sub.rooms):
+                self._discard(sub, room_key)
+
+    def publish(self, room_key, payload, coalesce_key=None, event_id=None):
+        """Serialize payload (dict) once and deliver it to every subscriber of room_key."""
+        return self.publish_raw(room_key, json.dumps(payload, default=str), coalesce_key, event_id)
+
+    def publish_raw(self, room_key, data, coalesce_key=None, event_id=None):
+        """Deliver an already-serialized event. Returns the number of subscribers reached."""
+        frame = format_frame(data, event_id)
+        with self._lock:
+            if event_id is not None and not room_key.startswith(self.replay_exclude):
+                self._remember(room_key, event_id, frame)
+            subs = tuple(self._rooms.get(room_key, ()))
+        dropped = 0
+        evicted = []
+        for sub in subs:
+            outcome = sub.push(frame, coalesce_key, room_key)
+            if outcome == DROPPED:
+                dropped += 1
+            elif outcome == EVICTED:
+                evicted.append(sub)
+        if dropped or evicted:
+            with self._lock:
+                if dropped:
+                    self.dropped[room_key] = self.dropped.get(room_key, 0) + dropped
+                if evicted:
+                    self.evicted[room_key] = self.evicted.get(room_key, 0) + len(evicted)
+        for sub in evicted:
+            self.unsubscribe(sub)
+        return len(subs) - len(evicted)
+
+    def subscriber_count(self, room_key):
+        with self._lock:
+            return len(self._rooms.get(room_key, ()))
+
+    def subscriber_counts(self):
+        with self._lock:
+            return {key: len(subs) for key, subs in self._rooms.items()}
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': {key: len(subs) for key, subs in self._rooms.items()},
+                'dropped': dict(self.dropped),
+                'evicted': dict(self.evicted),
+                'replay_rooms': len(self._history),
+                'last_event_id': self.last_event_id,
+            }
+
+
+# Events travel between workers as "<SEP><event id><SEP><coalesce key><SEP><json>".
+# Serialized JSON never contains this control character unescaped.
+_ENVELOPE_SEP = '\x1f'
+
+
+def _encode_envelope(data, coalesce_key, event_id=None):
+    return f"{_ENVELOPE_SEP}{event_id or ''}{_ENVELOPE_SEP}{coalesce_key or ''}{_ENVELOPE_SEP}{data}"
+
+
+def _decode_envelope(raw):
+    """Return (data, coalesce_key, event_id) from an encoded event."""
+    event_id, coalesce_key, data = raw[1:].split(_ENVELOPE_SEP, 2)
+    return data, (coalesce_key or None), (int(event_id) if event_id else None)
+
+
+class LocalBroker:
+    """Single-process backend: publishes straight into the local hub."""
+
+    name = 'memory'
+
+    def __init__(self, hub):
+        self.hub = hub
+        self._ids = itertools.count(1)
+
+    def start(self):
+        pass
+
+    def publish(self, room_key, data, coalesce_key=None):
+        self.hub.publish_raw(room_key, data, coalesce_key, next(self._ids))
+
+
+class RedisBroker:
+    """Fans events out to every worker and node through Redis pub/sub.
+
+    Publishing only talks to Redis; each process that has local subscribers runs
+    one listener thread that pattern-subscribes to all room channels and feeds
+    the local hub.
+    """
+
+    name = 'redis'
+    CHANNEL_PREFIX = 'room:'
+    SEQUENCE_KEY = 'sse:event_seq'
+    # Assign the event id and publish in one round trip
+    PUBLISH_SCRIPT = """
+local id = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', ARGV[1], ARGV[2] .. id .. ARGV[3])
+return id
+"""
+
+    def __init__(self, hub, client, logger=None):
+        self.hub = hub
+        self.client = client
+        self.logger = logger
+        self._publish_script = client.register_script(self.PUBLISH_SCRIPT)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            try:
+                self.hub.set_replay_floor(int(self.client.get(self.SEQUENCE_KEY) or 0))
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Could not read Redis event sequence')
+            self._thread = threading.Thread(target=self._listen, name='redis-broadcast', daemon=True)
+            self._thread.start()
+
+    def publish(self, room_key, data, coalesce_key=None):
+        # the script splices the new id between the leading separator and the rest of the envelope
+        tail = _encode_envelope(data, coalesce_key)[1:]
+        self._publish_script(keys=[self.SEQUENCE_KEY], args=[self.CHANNEL_PREFIX + room_key, _ENVELOPE_SEP, tail])
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.CHANNEL_PREFIX + '*')
+                backoff = 1
+                for msg in pubsub.listen():
+                    if msg.get('type') != 'pmessage':
+                        continue
+                    channel = msg['channel']
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    raw = msg['data']
+                    if isinstance(raw, bytes):
+                        raw = raw.decode()
+                    data, coalesce_key, event_id = _decode_envelope(raw)
+                    self.hub.publish_raw(channel[len(self.CHANNEL_PREFIX):], data, coalesce_key, event_id)
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Redis broadcast listener failed; reconnecting')
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+
+class SQLiteBroker:
+    """Single-host stand-in for Redis: workers share events through a small SQLite log.
+
+    Publishers append rows to ``room_event``; each process with local subscribers
+    tails the table from the last id it has seen. The row id doubles as the event
+    id. Rows older than ``retention`` seconds are pruned by publishers.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, hub, path, poll_interval=0.2, retention=60, logger=None):
+        self.hub = hub
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.logger = logger
+        self._local = threading.local()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._publish_count = 0
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS room_event ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, room_key TEXT NOT NULL, '
+                'data TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def start(self):
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            with closing(self._connect()) as conn:
+                last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM room_event').fetchone()[0]
+            self.hub.set_replay_floor(last_id)
+            self._thread = threading.Thread(target=self._listen, args=(last_id,), name='sqlite-broadcast', daemon=True)
+            self._thread.start()
+
+    def publish(self, room_key, data, coalesce_key=None):
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute('INSERT INTO room_event (room_key, data, created_at) VALUES (?, ?, ?)',
+                         (room_key, _encode_envelope(data, coalesce_key), now))
+            self._publish_count += 1
+            if self._publish_count % 100 == 0:
+                conn.execute('DELETE FROM room_event WHERE created_at < ?', (now - self.retention,))
+
+    def _listen(self, last_id):
+        conn = self._connect()
+        while True:
+            try:
+                rows = conn.execute(
+                    'SELECT id, room_key, data FROM room_event WHERE id > ? ORDER BY id', (last_id,)
+                ).fetchall()
+                for row_id, room_key, raw in rows:
+                    last_id = row_id
+                    data, coalesce_key, _ = _decode_envelope(raw)
+                    self.hub.publish_raw(room_key, data, coalesce_key, row_id)
+            except Exception:
+                if self.logger:
+                    self.logger.exception('SQLite broadcast listener failed')
+            time.sleep(self.poll_interval)
+
+
+def make_broker(hub, backend='auto', redis_client=None, sqlite_path=None, poll_interval=0.2, logger=None):
+    """Build the broadcast backend named by ``backend`` ('auto', 'redis', 'sqlite' or 'memory').
+
+    'auto' picks Redis when a client is available, otherwise the SQLite log when a
+    path is given, otherwise the in-process broker.
+    """
+    backend = (backend or 'auto').lower()
+    if backend == 'auto':
+        backend = 'redis' if redis_client is not None else ('sqlite' if sqlite_path else 'memory')
+    if backend == 'redis':
+        if redis_client is None:
+            raise ValueError('Redis broadcast backend requires REDIS_URL')
+        return RedisBroker(hub, redis_client, logger=logger)
+    if backend == 'sqlite':
+        return SQLiteBroker(hub, sqlite_path, poll_interval=poll_interval, logger=logger)
+    if backend == 'memory':
+        return LocalBroker(hub)
+    raise ValueError(f'Unknown broadcast backend: {backend}')
+
+
+class ChangeBatcher:
+    """Turns bursts of changes to the same object into one broadcast per window.
+
+    ``mark(key, room_key)`` records that ``key`` (e.g. a message id) changed in a
+    room. The first mark after a quiet period starts a ``window``-second timer;
+    marks arriving before it fires only join the batch. When it fires,
+    ``build_fn(keys)`` returns ``{key: payload}`` for the whole batch at once,
+    typically the current state from one query, and each payload is handed to
+    ``publish_fn(room_key, payload, coalesce_key)``. A burst of N changes to one
+    message therefore costs about ``burst length / window`` broadcasts, not N.
+    Payloads should carry the absolute state, not increments, so any event can
+    replace an earlier one for the same key.
+    """
+
+    def __init__(self, build_fn, publish_fn, window=0.5, key_prefix='', logger=None):
+        self.build_fn = build_fn
+        self.publish_fn = publish_fn
+        self.window = window
+        self.key_prefix = key_prefix  # coalesce key namespace, e.g. 'reactions:'
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._dirty = {}  # key -> room_key
+        self._timer = None
+        self.marked = 0     # changes recorded, for diagnostics
+        self.published = 0  # events published
+
+    def mark(self, key, room_key):
+        with self._lock:
+            self._dirty[key] = room_key
+            self.marked += 1
+            if self.window > 0 and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if self.window <= 0:  # batching disabled
+            self.flush()
+
+    def flush(self):
+        """Publish the pending batch now; returns the number of events published."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._timer = None
+        if not dirty:
+            return 0
+        try:
+            payloads = self.build_fn(list(dirty))
+        except Exception:
+            if self.logger:
+                self.logger.exception('Building batched change events failed; dropping %d', len(dirty))
+            return 0
+        published = 0
+        for key, room_key in dirty.items():
+            payload = payloads.get(key)
+            if payload is None:
+                continue
+            try:
+                self.publish_fn(room_key, payload, f'{self.key_prefix}{key}')
+                published += 1
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Publishing batched change event failed')
+        self.published += published
+        return published
+
+    def stop(self):
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        self.flush()
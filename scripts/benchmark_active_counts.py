@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark /api/active_counts for many rooms against the previous per-id implementation.
+
+Runs the app against a throwaway SQLite database, seeds topics, relationships and private chats
+with messages and presence, then compares:
+  - legacy: the old per-id loop (DISTINCT authors + a User COUNT per topic/relationship,
+    a chat lookup + COUNT per private chat)
+  - batched: one /api/active_counts request for all ids
+printing SQL statements issued and average latency for each.
+
+Usage:
+  python scripts/benchmark_active_counts.py --rooms 100 --runs 20
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_fd, DB_PATH = tempfile.mkstemp(suffix='.db')
+os.close(_fd)
+
+import config  # noqa: E402
+config.Config.SQLALCHEMY_DATABASE_URI = f'sqlite:///{DB_PATH}'
+
+from sqlalchemy import event  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+from app import app, db, add_presence, get_active_window_minutes, INSTANCE_SETTINGS  # noqa: E402
+from models import User, Topic, Relationship, PrivateChat, Message, RelationshipMessage  # noqa: E402
+
+
+def seed(n_rooms, n_users):
+    now = datetime.utcnow()
+    users = []
+    for i in range(n_users):
+        users.append(User(name=f'u{i}', class_name='x', username=f'bench{i}', password='x',
+                          email=f'u{i}@example.com', status='approved',
+                          last_login=now - timedelta(minutes=random.randint(0, 30))))
+    viewer = User(name='viewer', class_name='x', username='viewer', password=generate_password_hash('pass'),
+                  email='v@example.com', status='approved', last_login=now)
+    db.session.add_all(users + [viewer])
+    db.session.commit()
+    topics = [Topic(name=f't{i}') for i in range(n_rooms)]
+    rels = [Relationship(category='dating', person1=f'p{i}') for i in range(n_rooms)]
+    chats = [PrivateChat(user_id=random.choice(users).id, admin_id=viewer.id) for _ in range(n_rooms)]
+    db.session.add_all(topics + rels + chats)
+    db.session.commit()
+    for t, r in zip(topics, rels):
+        for _ in range(20):
+            db.session.add(Message(topic_id=t.id, user_id=random.choice(users).id, content='hi'))
+            db.session.add(RelationshipMessage(relationship_id=r.id, user_id=random.choice(users).id, content='hi'))
+        for u in random.sample(users, 5):
+            add_presence(f'topic:{t.id}', u.id, now)
+            add_presence(f'relationship:{r.id}', u.id, now)
+    db.session.commit()
+    return [t.id for t in topics], [r.id for r in rels], [c.id for c in chats]
+
+
+def legacy_counts(topic_ids, relationship_ids, chat_ids):
+    """The pre-batching implementation: separate queries per room id."""
+    window = datetime.utcnow() - timedelta(minutes=get_active_window_minutes())
+    active = (User.last_login != None) & (User.last_login >= window)  # noqa: E711
+    out = {}
+    for tid in topic_ids:
+        ids = {r[0] for r in db.session.query(Message.user_id).filter(Message.topic_id == tid).distinct()}
+        out[f'topic:{tid}'] = User.query.filter(User.id.in_(ids), active, User.status == 'approved').count()
+    for rid in relationship_ids:
+        ids = {r[0] for r in db.session.query(RelationshipMessage.user_id)
+               .filter(RelationshipMessage.relationship_id == rid).distinct()}
+        out[f'relationship:{rid}'] = User.query.filter(User.id.in_(ids), active, User.status == 'approved').count()
+    for cid in chat_ids:
+        chat = db.session.get(PrivateChat, cid)
+        ids = [chat.user_id] + ([chat.admin_id] if chat.admin_id else [])
+        out[f'chat:{cid}'] = User.query.filter(User.id.in_(ids), active).count()
+    return out
+
+
+def timed(fn, runs):
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        start = time.perf_counter()
+        for _ in range(runs):
+            fn()
+        elapsed_ms = (time.perf_counter() - start) * 1000 / runs
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    return statements[0] / runs, elapsed_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=100, help='ids of each kind to request')
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+    INSTANCE_SETTINGS['show_active_users'] = True  # in memory only; settings.json is untouched
+    try:
+        with app.app_context():
+            db.create_all()
+            topic_ids, rel_ids, chat_ids = seed(args.rooms, args.users)
+            client = app.test_client()
+            client.post('/login', data={'username': 'viewer', 'password': 'pass'})
+            url = ('/api/active_counts?topic_ids=' + ','.join(topic_ids)
+                   + '&relationship_ids=' + ','.join(rel_ids) + '&chat_ids=' + ','.join(chat_ids))
+
+            def batched():
+                data = client.get(url).get_json()
+                assert len(data['topic_active']) + len(data['relationship_active']) + len(data['chat_active']) == 3 * args.rooms
+
+            legacy_q, legacy_ms = timed(lambda: legacy_counts(topic_ids, rel_ids, chat_ids), args.runs)
+            batched_q, batched_ms = timed(batched, args.runs)
+
+        total = 3 * args.rooms
+        print(f'{total} rooms ({args.rooms} topics, {args.rooms} relationships, {args.rooms} chats)')
+        print(f'  legacy per-id loop: {legacy_q:6.0f} statements  {legacy_ms:8.2f} ms')
+        print(f'  batched endpoint:   {batched_q:6.0f} statements  {batched_ms:8.2f} ms  (includes request/login overhead)')
+    finally:
+        os.remove(DB_PATH)
+
+
+if __name__ == '__main__':
+    main()
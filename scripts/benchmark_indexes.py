@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Benchmark the hot message and presence queries with and without the composite indexes.
+
+Builds a throwaway SQLite database from the models, fills it with synthetic rows, then prints
+EXPLAIN QUERY PLAN and average latency for each query before and after creating the indexes
+declared in models.py. Nothing touches the app database.
+
+Usage:
+  python scripts/benchmark_indexes.py --messages 200000 --runs 50
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine  # noqa: E402
+from models import db  # noqa: E402
+
+
+# Mirrors the queries issued by room pages, /api/new_messages, active counts and unread badges
+QUERIES = {
+    'topic page (newest 50)': (
+        "SELECT * FROM message WHERE topic_id = :topic AND is_deleted = 0 "
+        "ORDER BY created_at DESC, id DESC LIMIT 51"
+    ),
+    'topic poll (new since)': (
+        "SELECT * FROM message WHERE topic_id = :topic AND is_deleted = 0 AND created_at > :since "
+        "ORDER BY created_at"
+    ),
+    'topic authors (active count)': "SELECT DISTINCT user_id FROM message WHERE topic_id = :topic",
+    'relationship page (newest 50)': (
+        "SELECT * FROM relationship_message WHERE relationship_id = :rel "
+        "ORDER BY created_at DESC, id DESC LIMIT 51"
+    ),
+    'private page (newest 50)': (
+        "SELECT * FROM private_message WHERE chat_id = :chat ORDER BY created_at DESC, id DESC LIMIT 51"
+    ),
+    'private unread count': "SELECT count(*) FROM private_message WHERE chat_id = :chat AND is_read = 0",
+    'active users (global)': (
+        "SELECT count(*) FROM user WHERE status = 'approved' AND last_login IS NOT NULL AND last_login >= :window"
+    ),
+}
+
+
+def seed(conn, n_messages, n_users, n_rooms):
+    now = datetime.utcnow()
+    users = [str(uuid.uuid4()) for _ in range(n_users)]
+    conn.exec_driver_sql(
+        "INSERT INTO user (id, name, class_name, stream, username, password, email, email_password, "
+        "instagram_username, instagram_password, phone_number, status, last_login) "
+        "VALUES (?, 'n', '', '', ?, 'x', 'e', '', '', '', '', ?, ?)",
+        [(u, u, random.choice(['approved', 'approved', 'pending', 'blocked']),
+          now - timedelta(minutes=random.randint(0, 60 * 24 * 30))) for u in users]
+    )
+    topics = [str(uuid.uuid4()) for _ in range(n_rooms)]
+    rels = [str(uuid.uuid4()) for _ in range(n_rooms)]
+    chats = [str(uuid.uuid4()) for _ in range(n_rooms)]
+
+    def rows(rooms):
+        for i in range(n_messages):
+            yield (str(uuid.uuid4()), random.choice(rooms), random.choice(users), 'hello',
+                   now - timedelta(seconds=n_messages - i))
+
+    conn.exec_driver_sql(
+        "INSERT INTO message (id, topic_id, user_id, content, created_at, is_deleted) VALUES (?, ?, ?, ?, ?, 0)",
+        list(rows(topics))
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO relationship_message (id, relationship_id, user_id, content, created_at) VALUES (?, ?, ?, ?, ?)",
+        list(rows(rels))
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO private_message (id, chat_id, user_id, content, created_at, is_read) VALUES (?, ?, ?, ?, ?, 0)",
+        list(rows(chats))
+    )
+    return {
+        'topic': topics[0],
+        'rel': rels[0],
+        'chat': chats[0],
+        'since': now - timedelta(minutes=5),
+        'window': now - timedelta(minutes=5),
+    }
+
+
+def measure(conn, params, runs):
+    results = {}
+    for name, sql in QUERIES.items():
+        plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + _positional(sql), _args(sql, params)).fetchall()
+        start = time.perf_counter()
+        for _ in range(runs):
+            conn.exec_driver_sql(_positional(sql), _args(sql, params)).fetchall()
+        elapsed_ms = (time.perf_counter() - start) * 1000 / runs
+        results[name] = (' | '.join(row[-1] for row in plan), elapsed_ms)
+    return results
+
+
+def _positional(sql):
+    # exec_driver_sql takes qmark parameters for sqlite3
+    for key in ('topic', 'rel', 'chat', 'since', 'window'):
+        sql = sql.replace(':' + key, '?')
+    return sql
+
+
+def _args(sql, params):
+    order = sorted((sql.index(':' + k), k) for k in params if ':' + k in sql)
+    return tuple(params[k] for _, k in order)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100000, help='rows per message table')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=20, help='executions per query')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        engine = create_engine(f'sqlite:///{path}')
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            # Start from the pre-migration schema
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    conn.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+            print(f'Seeding {args.messages} rows per message table...')
+            params = seed(conn, args.messages, args.users, args.rooms)
+            conn.exec_driver_sql('ANALYZE')
+            before = measure(conn, params, args.runs)
+
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(bind=conn)
+            conn.exec_driver_sql('ANALYZE')
+            after = measure(conn, params, args.runs)
+
+        for name in QUERIES:
+            (plan_before, ms_before), (plan_after, ms_after) = before[name], after[name]
+            print(f'\n{name}')
+            print(f'  before: {ms_before:8.3f} ms  {plan_before}')
+            print(f'  after:  {ms_after:8.3f} ms  {plan_after}')
+        engine.dispose()
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
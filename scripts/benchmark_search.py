@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark /api/search against a LIKE scan over topic messages.
+
+Runs the app against a throwaway SQLite database, bulk-inserts --messages topic messages
+(random words from a small vocabulary, so some terms are common and some rare; the FTS
+triggers index them as they go), then times one page of results for each query:
+  - like: Message.content LIKE '%word%' ORDER BY created_at DESC LIMIT 20 (the no-index way)
+  - fts:  GET /api/search?q=word&type=topic (includes request/login overhead)
+
+Usage:
+  python scripts/benchmark_search.py --messages 1000000 --runs 20
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_fd, DB_PATH = tempfile.mkstemp(suffix='.db')
+os.close(_fd)
+
+import config  # noqa: E402
+config.Config.SQLALCHEMY_DATABASE_URI = f'sqlite:///{DB_PATH}'
+config.Config.RATE_LIMIT_ENABLED = False
+
+from sqlalchemy import insert  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+from app import app, db  # noqa: E402
+from models import Message, Topic, User  # noqa: E402
+
+COMMON = ['exam', 'party', 'canteen', 'hostel', 'lecturer', 'library', 'weekend', 'chapati']
+RARE = ['quokka', 'zanzibar', 'xylophone']
+FILLER = [f'word{i}' for i in range(5000)]
+
+
+def seed(n_messages, batch=20000):
+    user = User(name='viewer', class_name='x', username='viewer', password=generate_password_hash('pass'),
+                email='v@example.com', status='approved')
+    topics = [Topic(name=f't{i}') for i in range(50)]
+    db.session.add_all([user] + topics)
+    db.session.commit()
+    topic_ids = [t.id for t in topics]
+    start = datetime.utcnow() - timedelta(days=365)
+    for offset in range(0, n_messages, batch):
+        rows = []
+        for i in range(offset, min(offset + batch, n_messages)):
+            words = random.sample(FILLER, 8) + random.sample(COMMON, 2)
+            if random.random() < 0.0005:
+                words.append(random.choice(RARE))
+            random.shuffle(words)
+            rows.append({'id': f'{i:036d}', 'topic_id': random.choice(topic_ids), 'user_id': user.id,
+                         'content': ' '.join(words), 'created_at': start + timedelta(seconds=i * 30)})
+        db.session.execute(insert(Message), rows)
+        db.session.commit()
+        print(f'  {min(offset + batch, n_messages)} messages', end='\r', flush=True)
+    print()
+
+
+def timed(fn, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - start) * 1000 / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    app.config['TESTING'] = True
+    try:
+        with app.app_context():
+            db.create_all()
+            seed(args.messages)
+            client = app.test_client()
+            client.post('/login', data={'username': 'viewer', 'password': 'pass'})
+
+            print(f'{args.messages} messages')
+            for word in ('exam', 'quokka', 'chap', 'exam party'):
+                def like():
+                    query = Message.query
+                    for w in word.split():
+                        query = query.filter(Message.content.like(f'%{w}%'))
+                    return query.order_by(Message.created_at.desc()).limit(20).all()
+
+                def fts():
+                    data = client.get('/api/search', query_string={'q': word, 'type': 'topic'}).get_json()
+                    assert data['status'] == 'success'
+
+                print(f'  {word!r:14} like: {timed(like, args.runs):8.2f} ms   fts: {timed(fts, args.runs):8.2f} ms')
+    finally:
+        os.remove(DB_PATH)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Garbage-collect uploaded media.
+
+Deleting messages, topics or relationships already frees media whose reference count drops
+to zero. This script is the safety net, run from cron or by hand:
+  1. recount MediaObject.ref_count from the message tables (fixes drift, registers old uploads)
+  2. delete objects nobody references, with their image variants
+  3. delete files under the upload folder that no media object knows about (e.g. left behind
+     by a crash between storing an upload and committing its message, or upload spools of a
+     killed worker), once older than --grace
+
+Usage:
+  python scripts/gc_media.py [--dry-run] [--grace 60]
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import app, db, reconcile_media_refs, collect_media  # noqa: E402
+from models import MediaObject  # noqa: E402
+
+MEDIA_DIRS = ('images', 'voice', '.incoming')  # .incoming: upload spools (see uploads.py)
+
+
+def _stem(path):
+    # images/ab/cd/<hash>_thumb.webp -> images/ab/cd/<hash>
+    directory, name = os.path.split(path)
+    return os.path.join(directory, name.split('.', 1)[0].split('_', 1)[0])
+
+
+def orphan_files(upload_folder, known_paths, grace_seconds):
+    """Files under the media dirs that belong to no known path, older than grace_seconds."""
+    known = {_stem(p) for p in known_paths}
+    cutoff = time.time() - grace_seconds
+    for media_dir in MEDIA_DIRS:
+        for dirpath, _, filenames in os.walk(os.path.join(upload_folder, media_dir)):
+            for filename in filenames:
+                full = os.path.join(dirpath, filename)
+                rel = os.path.relpath(full, upload_folder).replace(os.sep, '/')
+                if _stem(rel) not in known and os.path.getmtime(full) < cutoff:
+                    yield rel
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='report what would be removed without changing anything')
+    parser.add_argument('--grace', type=int, default=60, help='minutes before an unknown file counts as orphaned')
+    args = parser.parse_args()
+
+    with app.app_context():
+        upload_folder = app.config['UPLOAD_FOLDER']
+        changed = reconcile_media_refs(commit=not args.dry_run)
+        print(f'{changed} media objects registered or recounted.')
+
+        if args.dry_run:
+            unused = [p for (p,) in MediaObject.query.with_entities(MediaObject.path).filter(MediaObject.ref_count <= 0)]
+        else:
+            unused = collect_media()
+        print(f'{len(unused)} unreferenced media objects {"would be " if args.dry_run else ""}removed.')
+
+        known = [p for (p,) in MediaObject.query.with_entities(MediaObject.path)]
+        if args.dry_run:
+            known = [p for p in known if p not in set(unused)]
+        orphans = list(orphan_files(upload_folder, known, args.grace * 60))
+        for rel in orphans:
+            print(f'  orphan: {rel}')
+            if not args.dry_run:
+                os.remove(os.path.join(upload_folder, rel))
+        print(f'{len(orphans)} orphaned files {"would be " if args.dry_run else ""}removed.')
+        if args.dry_run:
+            db.session.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Full-text search over topic, relationship and private messages (SQLite FTS5).
+
+Each message table has an external-content FTS5 index on its content column (message_fts,
+relationship_message_fts, private_message_fts) keyed on the table's rowid, so the text is not
+stored twice. Triggers keep the indexes in step with inserts, edits and deletes, including
+bulk deletes that bypass the ORM. register(db.metadata) makes create_all/drop_all create and
+drop them; migrate_add_search_index.py adds them to an existing database.
+
+Matches are read newest first (descending rowid, which follows insert order) with a LIMIT,
+so FTS5 stops after one page instead of ranking every match; pages continue below the last
+rowid seen. VACUUM may renumber the rowids of tables without an INTEGER PRIMARY KEY, so run
+rebuild() (or the migration script) after one.
+"""
+import re
+
+from sqlalchemy import bindparam, event, text
+
+# search kind -> (message table, room id column)
+INDEXED_TABLES = {
+    'topic': ('message', 'topic_id'),
+    'relationship': ('relationship_message', 'relationship_id'),
+    'private': ('private_message', 'chat_id'),
+}
+MAX_TERMS = 8
+HIGHLIGHT = ('\ue000', '\ue001')  # private-use marks around matched words in snippets
+
+_WORD = re.compile(r'\w+')
+
+
+def fts_table(kind):
+    return f'{INDEXED_TABLES[kind][0]}_fts'
+
+
+def _ddl(table):
+    fts = f'{table}_fts'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        f"content, content='{table}', tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, content) VALUES (new.rowid, new.content); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.rowid, old.content); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF content ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.rowid, old.content); "
+        f"INSERT INTO {fts}(rowid, content) VALUES (new.rowid, new.content); END",
+    ]
+
+
+def install(connection):
+    """Create the indexes and triggers that are missing; new indexes are filled from their table.
+
+    Returns the kinds whose index was created, or None when the database isn't SQLite.
+    """
+    if connection.dialect.name != 'sqlite':
+        return None
+    created = []
+    for kind, (table, _) in INDEXED_TABLES.items():
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (f'{table}_fts',)).first()
+        for statement in _ddl(table):
+            connection.exec_driver_sql(statement)
+        if not exists:
+            rebuild(connection, kind)
+            created.append(kind)
+    return created
+
+
+def rebuild(connection, kind):
+    """Re-read a kind's whole message table into its index."""
+    fts = fts_table(kind)
+    connection.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def drop(connection):
+    if connection.dialect.name != 'sqlite':
+        return
+    for table, _ in INDEXED_TABLES.values():
+        for suffix in ('ai', 'ad', 'au'):
+            connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {table}_fts_{suffix}')
+        connection.exec_driver_sql(f'DROP TABLE IF EXISTS {table}_fts')
+
+
+def register(metadata):
+    """Create the indexes after create_all and drop them before drop_all."""
+    event.listen(metadata, 'after_create', lambda target, connection, **kw: install(connection))
+    event.listen(metadata, 'before_drop', lambda target, connection, **kw: drop(connection))
+
+
+def match_query(q):
+    """FTS5 query for free text: every word must appear, the last one as a prefix.
+
+    Words are quoted, so FTS5 operators and punctuation typed by users are just text.
+    Returns None when q has no words.
+    """
+    words = _WORD.findall(q or '')[:MAX_TERMS]
+    if not words:
+        return None
+    return ' '.join(f'"{w}"' for w in words) + '*'
+
+
+def search(session, kind, match, before=None, limit=20, room_ids=None, exclude_room_ids=(), owner_id=None):
+    """Newest messages of one kind matching match (from match_query).
+
+    before: only rowids below it (the cursor); room_ids: only these rooms; exclude_room_ids:
+    rooms the caller may not read; owner_id: private chats owned by this user only.
+    Returns [(rowid, message id, snippet)], the snippet marked with HIGHLIGHT.
+    """
+    table, room_column = INDEXED_TABLES[kind]
+    fts = fts_table(kind)
+    conditions = [f'{fts} MATCH :match']
+    params = {'match': match, 'limit': limit}
+    binds = []
+    if before is not None:
+        conditions.append(f'{fts}.rowid < :before')
+        params['before'] = before
+    if kind == 'topic':
+        conditions.append('(m.is_deleted = 0 OR m.is_deleted IS NULL)')
+    if room_ids:
+        conditions.append(f'm.{room_column} IN :room_ids')
+        params['room_ids'] = list(room_ids)
+        binds.append(bindparam('room_ids', expanding=True))
+    if exclude_room_ids:
+        conditions.append(f'(m.{room_column} IS NULL OR m.{room_column} NOT IN :exclude_room_ids)')
+        params['exclude_room_ids'] = list(exclude_room_ids)
+        binds.append(bindparam('exclude_room_ids', expanding=True))
+    join = ''
+    if owner_id is not None:
+        join = 'JOIN private_chat AS c ON c.id = m.chat_id'
+        conditions.append('c.user_id = :owner_id')
+        params['owner_id'] = owner_id
+    statement = text(
+        f"SELECT {fts}.rowid, m.id, snippet({fts}, 0, :hl_open, :hl_close, '…', 16) "
+        f"FROM {fts} JOIN {table} AS m ON m.rowid = {fts}.rowid {join} "
+        f"WHERE {' AND '.join(conditions)} ORDER BY {fts}.rowid DESC LIMIT :limit"
+    )
+    if binds:
+        statement = statement.bindparams(*binds)
+    params['hl_open'], params['hl_close'] = HIGHLIGHT
+    return [tuple(row) for row in session.execute(statement, params)]
+
+
+def parse_cursor(value, kinds):
+    """{kind: rowid bound or None} from 'topic:123,private:0' (0 = that kind is exhausted)."""
+    bounds = dict.fromkeys(kinds)
+    for part in (value or '').split(','):
+        kind, _, rowid = part.partition(':')
+        if kind in bounds and rowid.isdigit():
+            bounds[kind] = int(rowid)
+    return bounds
+
+
+def format_cursor(bounds):
+    """Inverse of parse_cursor; None once every kind is exhausted."""
+    if all(bound == 0 for bound in bounds.values()):
+        return None
+    return ','.join(f'{kind}:{bound}' for kind, bound in bounds.items() if bound is not None)
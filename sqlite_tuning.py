@@ -0,0 +1,59 @@
+"""SQLite production settings for the SQLAlchemy engine.
+
+Applies journal/sync/cache pragmas to every new connection and takes control of how
+transactions begin. With the default deferred BEGIN, a request that reads (e.g. loads the
+current user) and then writes can fail with "database is locked" straight away if another
+worker committed in between, whatever the busy timeout. Starting write transactions with
+BEGIN IMMEDIATE takes the write lock up front, so concurrent writers queue on the busy
+timeout instead of failing.
+"""
+from sqlalchemy import event
+
+BEGIN_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+def sqlite_pragmas(config):
+    """Build the per-connection PRAGMA settings from app config."""
+    return {
+        'journal_mode': config.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': config.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': int(config.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        # negative cache_size is in KiB rather than pages
+        'cache_size': -abs(int(config.get('SQLITE_CACHE_SIZE_KB', 20000))),
+        'mmap_size': int(config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+        'temp_store': 'MEMORY',
+    }
+
+
+def configure_sqlite_engine(engine, pragmas, begin_mode='IMMEDIATE'):
+    """Attach pragma and BEGIN handling to a SQLite engine; other dialects are left alone.
+
+    begin_mode is one of BEGIN_MODES or a callable returning one, evaluated as each
+    transaction starts (so callers can keep read-only requests on DEFERRED).
+    Returns True if the engine was configured.
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+
+    def _mode():
+        mode = begin_mode() if callable(begin_mode) else begin_mode
+        mode = (mode or 'DEFERRED').upper()
+        return mode if mode in BEGIN_MODES else 'DEFERRED'
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_conn, connection_record):
+        # Stop pysqlite issuing its own BEGIN so the 'begin' hook below decides the lock mode
+        dbapi_conn.isolation_level = None
+        cursor = dbapi_conn.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def _on_begin(conn):
+        conn.exec_driver_sql(f'BEGIN {_mode()}')
+
+    return True
+
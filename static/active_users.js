@@ -9,6 +9,8 @@
   }
 
   async function refreshCount(){
+    // script.js's multiplexed stream pushes the global count while connected
+    if(typeof ssePresenceActive === 'function' && ssePresenceActive()) return;
     try{
       const res = await fetch('/api/active_counts', {headers: {'X-Requested-With':'XMLHttpRequest'}, credentials: 'same-origin'});
       if(res.ok){
@@ -339,25 +339,41 @@ document.addEventListener('DOMContentLoaded', function() {
 
         // Start polling for new messages
         pollForNewMessages();
-        // Try to open SSE for real-time updates (preferred)
-        startSSE();
+        initOlderMessages();
     }
+    // Pages that opt in use the WebSocket transport; otherwise (or if it is unavailable) SSE
+    if (!startChatSocket()) startSSE();
 });
 
-// Start Server-Sent Events connection for the current room
+// Room keys this page wants live updates for: the open room plus any rooms with active-count badges
+function collectStreamRooms(){
+    const rooms = [];
+    const roomEl = document.querySelector('[data-current-room]');
+    if (roomEl && roomEl.getAttribute('data-current-room')) rooms.push(roomEl.getAttribute('data-current-room'));
+    document.querySelectorAll('[data-active-target]').forEach(el => {
+        const key = el.getAttribute('data-active-target');
+        if (key && rooms.indexOf(key) === -1) rooms.push(key);
+    });
+    return rooms;
+}
+
+// Start one multiplexed Server-Sent Events connection carrying every room on the page,
+// active-user counts and unread badge updates
 function startSSE(){
     if (!('EventSource' in window)) return;
+    const rooms = collectStreamRooms();
+    if (!rooms.length) return;
     const roomEl = document.querySelector('[data-current-room]');
-    if(!roomEl) return;
-    const room = roomEl.getAttribute('data-current-room');
-    if(!room) return;
+    const room = roomEl ? roomEl.getAttribute('data-current-room') : null;
 
     // If an EventSource already exists for this page, don't recreate immediately
-    if (window._es && window._esRoom === room) return;
+    if (window._es && window._es.readyState !== 2) return;
 
     // Exponential backoff for reconnect attempts
     window._sseBackoff = window._sseBackoff || 1000; // start at 1s
-    const url = '/stream?room=' + encodeURIComponent(room);
+    let url = '/stream/multi?rooms=' + encodeURIComponent(rooms.join(','));
+    // A fresh EventSource does not resend Last-Event-ID, so pass it explicitly to get only the missed events replayed
+    if (window._sseLastEventId) url += '&last_event_id=' + encodeURIComponent(window._sseLastEventId);
     try{
         // Use withCredentials where supported so same-origin cookies are sent
         const es = (typeof EventSource !== 'undefined') ? new EventSource(url, { withCredentials: true }) : new EventSource(url);
@@ -371,9 +387,19 @@ function startSSE(){
         };
 
         es.onmessage = function(e){
+            if (e.lastEventId) window._sseLastEventId = e.lastEventId;
             try{
                 const payload = JSON.parse(e.data);
-                handleSSEPayload(payload);
+                if (payload.type === 'hello') {
+                    window._sseStreamId = payload.stream_id;
+                } else if (payload.type === 'presence') {
+                    window._ssePresence = true;
+                    applyActiveCounts(payload.global_active, payload.active || {});
+                } else if (payload.type === 'unread') {
+                    applyUnreadDelta(payload.delta);
+                } else if (!payload.room || payload.room === window._esRoom) {
+                    handleSSEPayload(payload);
+                }
             }catch(err){
                 console.error('Invalid SSE payload', err, e.data);
             }
@@ -382,6 +408,7 @@ function startSSE(){
         es.onerror = function(e){
             console.warn('SSE connection error, falling back to polling', e);
             try{ es.close(); }catch(_){}
+            window._ssePresence = false;
             // Exponential backoff capped at 60s
             const delay = Math.min(window._sseBackoff, 60000);
             window._sseBackoff = Math.min(60000, window._sseBackoff * 2);
@@ -396,7 +423,136 @@ function startSSE(){
     }
 }
 
+// Optional WebSocket transport: pages opt in with data-transport="websocket" on the room marker.
+// It carries room events plus sends, replies, reactions and pings; HTTP endpoints remain the fallback.
+let _chatSocket = null;
+let _socketRef = 0;
+const _socketPending = {};
+
+function startChatSocket(){
+    const roomEl = document.querySelector('[data-current-room][data-transport="websocket"]');
+    if (!roomEl || !('WebSocket' in window)) return false;
+    const room = roomEl.getAttribute('data-current-room');
+    const proto = location.protocol === 'https:' ? 'wss:' : 'ws:';
+    let ws;
+    try{
+        ws = new WebSocket(`${proto}//${location.host}/ws`);
+    }catch(err){
+        return false;
+    }
+    let opened = false;
+
+    ws.onopen = function(){
+        opened = true;
+        _chatSocket = ws;
+        ws.send(JSON.stringify({op: 'subscribe', rooms: collectStreamRooms()}));
+    };
+
+    ws.onmessage = function(e){
+        let msg;
+        try{ msg = JSON.parse(e.data); }catch(err){ return; }
+        if (msg.type === 'ack'){
+            const pending = _socketPending[msg.ref];
+            if (pending){
+                delete _socketPending[msg.ref];
+                pending.resolve(msg);
+            }
+        } else if (msg.type === 'event' && msg.event){
+            const payload = msg.event;
+            if (payload.type === 'unread') applyUnreadDelta(payload.delta);
+            else if (!payload.room || payload.room === room) handleSSEPayload(payload);
+        }
+    };
+
+    ws.onclose = function(){
+        _chatSocket = null;
+        for (const ref of Object.keys(_socketPending)){
+            _socketPending[ref].reject(new Error('WebSocket closed'));
+            delete _socketPending[ref];
+        }
+        // Fall back to SSE for receiving; sends fall back to HTTP automatically
+        startSSE();
+        if (opened) console.warn('WebSocket closed, using SSE/HTTP');
+    };
+    return true;
+}
+
+function chatSocketOpen(){
+    return !!(_chatSocket && _chatSocket.readyState === 1);
+}
+
+// Send one op over the WebSocket; resolves with the server's ack (same shape as the HTTP response)
+function socketRequest(op, body){
+    return new Promise((resolve, reject) => {
+        if (!chatSocketOpen()) return reject(new Error('WebSocket not open'));
+        const ref = ++_socketRef;
+        _socketPending[ref] = {resolve, reject};
+        _chatSocket.send(JSON.stringify(Object.assign({op: op, ref: ref}, body)));
+    });
+}
+
+// Use the WebSocket when it is open, else POST JSON to the HTTP endpoint
+function postChatAction(op, url, body){
+    if (chatSocketOpen()) return socketRequest(op, body);
+    return fetchWithCSRF(url, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(body)
+    }).then(response => response.json());
+}
+
+// True while the multiplexed stream is connected and pushing active counts
+function ssePresenceActive(){
+    return !!(window._es && window._es.readyState === 1 && window._ssePresence);
+}
+
+// Add/remove rooms on the open stream without reconnecting
+async function updateStreamRooms(subscribe, unsubscribe){
+    if (!window._sseStreamId) return;
+    try{
+        await fetchWithCSRF('/api/stream/subscribe', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({stream_id: window._sseStreamId, subscribe: subscribe || [], unsubscribe: unsubscribe || []})
+        });
+    }catch(e){ /* ignore */ }
+}
+
+// Update badges from a presence event: {"topic:<id>": count, ...}
+function applyActiveCounts(globalActive, active){
+    const globalEl = document.getElementById('global-active-count');
+    if (globalEl && globalActive !== undefined && globalActive !== null) globalEl.textContent = `Active now: ${globalActive} users`;
+    for (const [key, count] of Object.entries(active)){
+        document.querySelectorAll(`[data-active-target="${key}"]`).forEach(el => {
+            el.textContent = `Active now: ${count} users`;
+            el.dataset.activeCount = count;
+        });
+    }
+}
+
+// Adjust the unread private message badge by delta
+function applyUnreadDelta(delta){
+    ['user-support-badge', 'support-badge'].forEach(id => {
+        const badge = document.getElementById(id);
+        if (!badge) return;
+        const count = Math.max(0, (parseInt(badge.textContent, 10) || 0) + (delta || 0));
+        badge.textContent = count > 0 ? count : '';
+        badge.style.display = count > 0 ? 'inline-block' : 'none';
+        badge.classList.toggle('hidden', count === 0);
+    });
+}
+
 function handleSSEPayload(payload){
+    // Server could not replay everything we missed: catch up once over HTTP
+    if(payload && payload.type === 'resync'){
+        fetchNewMessages();
+        return;
+    }
+    // Batched reaction counts for one message
+    if(payload && payload.type === 'reactions'){
+        updateReactionCounts(payload.message_id, {counts: payload.counts});
+        return;
+    }
     if(!payload || !payload.type || !payload.message) return;
     const message = payload.message;
     // Defensive duplicate detection: skip if a matching message already exists
@@ -409,19 +565,80 @@ function handleSSEPayload(payload){
 
     const wasAtBottom = isUserNearBottom(container);
 
-    const safeSender = escapeHtml(message.sender_name || '');
-    const safeContent = escapeHtml(message.content || '');
-    const msgHtml = `\n                        <div class="message ${message.is_own ? 'sent' : 'received'}" data-message-id="${message.id}">\n                            <div class="message-header">\n                                <span class="sender">${safeSender}</span>\n                                <span class="timestamp" data-timestamp="${message.timestamp}">${escapeHtml(message.formatted_time || '')}</span>\n                            </div>\n                            <div class="message-content">${safeContent}</div>\n                        </div>\n                    `;
+    // same markup as history pages, so images and voice notes show up live too
+    const msgHtml = renderHistoryMessage(message);
     container.insertAdjacentHTML('beforeend', msgHtml);
     if (wasAtBottom) scrollToLatestMessages();
     // update lastMessageTimestamp
     if(message.timestamp) lastMessageTimestamp = new Date(message.timestamp).getTime();
 }
 
-// Poll for new messages
+// Markup for a history message returned by /api/older_messages
+function renderHistoryMessage(message){
+    const srcset = message.image_srcset ? ` srcset="${escapeHtml(message.image_srcset)}" sizes="(max-width: 600px) 90vw, 480px"` : '';
+    const image = message.image_url
+        ? `<img src="${escapeHtml(message.image_url)}"${srcset} loading="lazy" class="message-image" data-full="${escapeHtml(message.image_full_url || message.image_url)}" onclick="openImageModal(this.dataset.full)" alt="Uploaded image">`
+        : '';
+    const voice = message.voice_url
+        ? `<audio controls style="width: 100%; margin: 8px 0;"><source src="${escapeHtml(message.voice_url)}"></audio>`
+        : '';
+    return `
+                        <div class="message ${message.is_own ? 'sent' : 'received'}" data-message-id="${message.id}">
+                            <div class="message-header">
+                                <span class="sender">${escapeHtml(message.sender_name || '')}</span>
+                                <span class="timestamp" data-timestamp="${message.timestamp}">${escapeHtml(message.formatted_time || '')}</span>
+                            </div>
+                            ${message.content ? `<div class="message-content">${escapeHtml(message.content)}</div>` : ''}
+                            ${image}${voice}
+                            <div class="message-actions"><span class="reaction-counts" id="reactions-${message.id}" role="status" aria-live="polite"></span></div>
+                        </div>
+                    `;
+}
+
+// Infinite scroll: pages only render the newest messages, older ones load when scrolled near the top
+function initOlderMessages(){
+    const container = document.getElementById('messagesContainer');
+    if (!container || !container.hasAttribute('data-older-cursor')) return;
+    let loading = false;
+
+    async function loadOlder(){
+        const cursor = container.getAttribute('data-older-cursor');
+        if (loading || !cursor || container.scrollTop > 80) return;
+        loading = true;
+        try{
+            const params = new URLSearchParams({chat_type: currentChatType, chat_id: currentChatId, before: cursor});
+            const response = await fetch(`/api/older_messages?${params}`);
+            const data = await response.json();
+            if (data.status !== 'success') return;
+            const previousHeight = container.scrollHeight;
+            const fresh = data.messages.filter(m => !messageExists(m));
+            container.insertAdjacentHTML('afterbegin', fresh.map(renderHistoryMessage).join(''));
+            loadReactionCounts(fresh.map(m => m.id));
+            // Keep the message the user was looking at in place
+            container.scrollTop += container.scrollHeight - previousHeight;
+            container.setAttribute('data-older-cursor', data.next_cursor || '');
+        }catch(error){
+            console.error('Error loading older messages:', error);
+        }finally{
+            loading = false;
+        }
+    }
+
+    container.addEventListener('scroll', loadOlder, {passive: true});
+}
+
+// Poll for new messages while SSE is not connected
 async function pollForNewMessages() {
-    // If SSE is active for this room, skip polling to avoid duplicate work
-    if (window._es && window._es.readyState === 1) return;
+    // If SSE is active for this room, skip the fetch to avoid duplicate work but keep the loop alive
+    // so polling resumes if the stream drops
+    if (!(window._es && window._es.readyState === 1) && !chatSocketOpen()) {
+        await fetchNewMessages();
+    }
+    setTimeout(pollForNewMessages, 3000); // Poll every 3 seconds
+}
+
+// Fetch messages newer than lastMessageTimestamp once
+async function fetchNewMessages() {
     if (!currentChatId || !currentChatType) return;
 
     try {
@@ -470,9 +687,6 @@ async function pollForNewMessages() {
     } catch (error) {
         console.error('Error fetching new messages:', error);
     }
-
-    // Continue polling
-    setTimeout(pollForNewMessages, 3000); // Poll every 3 seconds
 }
 
 // Return true if user is near the bottom of a scrollable container
@@ -602,45 +816,52 @@ function replyToMessage(messageId) {
     showReplyBox(messageId);
 }
 
-function updateReactionCounts(messageId, reactions) {
+// summary is {counts: {emoji: n}, mine: [emoji]} as returned by /api/react_message and /api/reactions;
+// 'reactions' room events only carry counts
+function updateReactionCounts(messageId, summary) {
     const container = document.getElementById(`reactions-${messageId}`);
     if (!container) return;
 
-    // Parse reactions JSON if it's a string
-    if (typeof reactions === 'string') {
+    if (typeof summary === 'string') {
         try {
-            reactions = JSON.parse(reactions);
+            summary = JSON.parse(summary);
         } catch (e) {
             console.error('Failed to parse reactions:', e);
             return;
         }
     }
+    const counts = (summary && summary.counts) || {};
+    const mine = (summary && summary.mine) || [];
 
-    // Build counts HTML
-    const counts = [];
-    for (const [emoji, userIds] of Object.entries(reactions)) {
-        if (Array.isArray(userIds) && userIds.length > 0) {
-            counts.push(`${emoji} ${userIds.length}`);
-        }
-    }
+    container.textContent = Object.entries(counts)
+        .filter(([, n]) => n > 0)
+        .map(([emoji, n]) => `${emoji} ${n}`)
+        .join(' • ');
 
-    // Update DOM
-    container.textContent = counts.join(' • ');
-    
-    // Update aria-pressed state on reaction buttons
+    // Update aria-pressed state on reaction buttons (room broadcasts carry no 'mine')
     const messageActions = container.closest('.message-actions');
-    if (messageActions) {
+    if (messageActions && summary && summary.mine) {
         messageActions.querySelectorAll('.message-action[data-emoji]').forEach(btn => {
-            const emoji = btn.getAttribute('data-emoji');
-            const userIds = reactions[emoji] || [];
-            // Normalize to strings for comparison with currentUserId (template injects it as string)
-            const userIdStrs = (Array.isArray(userIds) ? userIds.map(u => String(u)) : []);
-            const isPressed = userIdStrs.includes(String(currentUserId));
-            btn.setAttribute('aria-pressed', isPressed);
+            btn.setAttribute('aria-pressed', mine.includes(btn.getAttribute('data-emoji')));
         });
     }
 }
 
+// Fill in reaction counts for messages added to the page after it rendered (one request per page)
+async function loadReactionCounts(messageIds) {
+    if (!messageIds.length) return;
+    try {
+        const response = await fetch(`/api/reactions?ids=${encodeURIComponent(messageIds.join(','))}`);
+        const data = await response.json();
+        if (data.status !== 'success') return;
+        for (const [messageId, summary] of Object.entries(data.reactions)) {
+            updateReactionCounts(messageId, summary);
+        }
+    } catch (error) {
+        console.error('Error loading reactions:', error);
+    }
+}
+
 function reactToMessage(messageId, emoji) {
     const btn = document.querySelector(`.message-action[data-emoji="${emoji}"][data-message-id="${messageId}"]`);
     if (btn) btn.disabled = true;
@@ -808,6 +1029,8 @@ document.addEventListener('visibilitychange', function(){
 });
 
 async function updateActiveCounts(){
+    // The multiplexed stream pushes these counts; only poll while it is down
+    if (ssePresenceActive()) return;
     try{
         // Find elements with data-active-target attribute
         // Format: data-active-target="type:id" where type is chat|topic|relationship
@@ -905,6 +1128,10 @@ function startRoomPing(intervalMs = 20000){
     const [type, id] = val.split(':');
 
     async function ping(){
+        if(chatSocketOpen()){
+            socketRequest('ping', {room: val}).catch(() => {});
+            return;
+        }
         try{
             await fetchWithCSRF('/api/room_ping', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({type: type, id: id}) });
         }catch(e){ /* ignore */ }
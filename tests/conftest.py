@@ -0,0 +1,49 @@
+import os
+import tempfile
+
+import pytest
+
+# Point the app at a scratch database before it is imported; the fixtures below create and
+# drop every table, which must never happen to instance/gossip.db.
+_DB_DIR = tempfile.mkdtemp(prefix='gossip-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_DB_DIR, 'test.db')
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from app import PRESENCE, app, db  # noqa: E402
+from models import User  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limits():
+    # every test logs in from 127.0.0.1; don't let earlier tests use up the login budget
+    from app import RATE_LIMITER
+    RATE_LIMITER.reset()
+    yield
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.test_client() as client:
+        with app.app_context():
+            db.create_all()
+            yield client
+            db.session.remove()
+            PRESENCE.flush()  # buffered heartbeats belong to this test's users
+            db.drop_all()
+
+
+def create_user(username, password='pass', **kwargs):
+    kwargs.setdefault('status', 'approved')
+    user = User(name=username.title(), class_name='x', username=username, password=generate_password_hash(password),
+                email=f'{username}@example.com', **kwargs)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(client, username, password='pass'):
+    client.get('/logout')
+    return client.post('/login', data={'username': username, 'password': password})
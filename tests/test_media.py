@@ -0,0 +1,346 @@
+import hashlib
+import io
+import json
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+import app as app_module
+from app import app, db
+from conftest import create_user, login
+from media import MediaProcessor
+from models import Message, Topic
+from utils import image_variant_path, make_image_variants
+
+
+@pytest.fixture
+def client(client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    yield client
+
+
+def png_bytes(width, height):
+    buf = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def test_variants_are_written_next_to_the_original(tmp_path):
+    path = str(tmp_path / 'wide.png')
+    original = png_bytes(2000, 1000)
+    with open(path, 'wb') as f:
+        f.write(original)
+    variants = make_image_variants(path, {'thumb': 320, 'medium': 800, 'full': 1200, 'huge': 4000})
+    assert variants == {'full': 1200, 'medium': 800, 'thumb': 320}  # never upscaled
+    with open(path, 'rb') as f:
+        assert f.read() == original  # the upload keeps matching its content hash
+    assert image_variant_path(path, 'full') == str(tmp_path / 'wide_full.png')
+    for name, width in variants.items():
+        for webp in (False, True):
+            with Image.open(image_variant_path(path, name, webp=webp)) as image:
+                assert image.width == width and image.format == ('WEBP' if webp else 'PNG')
+
+    small = str(tmp_path / 'small.png')
+    with open(small, 'wb') as f:
+        f.write(png_bytes(500, 500))
+    assert make_image_variants(small, {'thumb': 320, 'medium': 800, 'full': 1200}, webp=False) == {'full': 500, 'thumb': 320}
+
+
+def test_process_pool_optimizes_and_reports(tmp_path):
+    path = tmp_path / 'photo.png'
+    path.write_bytes(png_bytes(1600, 800))
+    done = []
+    processor = MediaProcessor(mode='process', workers=1, options={'sizes': {'full': 400}})
+    try:
+        processor.submit(str(path), lambda ok, result: done.append((ok, result))).result(timeout=60)
+        bad = tmp_path / 'bad.png'
+        bad.write_bytes(b'not an image')
+        assert processor.submit(str(bad), lambda ok, result: done.append((ok, result))).exception(timeout=60) is not None
+    finally:
+        processor.shutdown()
+    assert done == [(True, {'full': 400}), (False, None)]
+    assert (processor.processed, processor.failed, processor.pending) == (1, 1, 0)
+    with Image.open(image_variant_path(str(path), 'full')) as image:
+        assert image.width == 400
+
+
+def test_send_message_returns_before_image_is_processed(client, monkeypatch):
+    create_user('pic')
+    topic = Topic(name='photos')
+    db.session.add(topic)
+    db.session.commit()
+    client.post('/login', data={'username': 'pic', 'password': 'pass'})
+
+    release, published = threading.Event(), threading.Event()
+    events = []
+
+    def slow_variants(path, **options):
+        release.wait(10)
+        return make_image_variants(path, **options)
+
+    def capture(room_key, payload, coalesce_key=None):
+        events.append((room_key, payload))
+        published.set()
+
+    processor = MediaProcessor(mode='thread', workers=1, process_fn=slow_variants, options=app_module.IMAGE_PROCESSOR.options)
+    monkeypatch.setattr(app_module, 'IMAGE_PROCESSOR', processor)
+    monkeypatch.setattr(app_module, 'publish_to_room', capture)
+    try:
+        resp = client.post('/api/send_message', data={
+            'topic_id': topic.id, 'content': 'look',
+            'image': (io.BytesIO(png_bytes(2000, 1000)), 'photo.png'),
+        }, content_type='multipart/form-data')
+        assert resp.get_json()['has_image']
+        assert events == [] and processor.pending == 1  # stored raw; still being processed
+
+        db.session.rollback()  # release the request's transaction before the worker records variants
+        release.set()
+        assert published.wait(10)
+    finally:
+        release.set()
+        processor.shutdown()
+    room_key, payload = events[0]
+    assert room_key == f'topic:{topic.id}'
+    message = db.session.get(Message, payload['message']['id'])
+    assert json.loads(message.image_variants) == {'thumb': 320, 'medium': 800, 'full': 1200}
+
+    # serve_upload picks the requested size, as WebP when the browser accepts it
+    url = payload['message']['image_url']
+    assert url.endswith('size=medium')
+    assert payload['message']['image_srcset'] == ', '.join(
+        f"{url.replace('medium', name)} {width}w" for name, width in (('thumb', 320), ('medium', 800), ('full', 1200)))
+    resp = client.get(url, headers={'Accept': 'image/avif,image/webp,*/*'})
+    assert resp.mimetype == 'image/webp' and 'Accept' in resp.headers['Vary']
+    assert Image.open(io.BytesIO(resp.data)).width == 800
+    resp = client.get(url.replace('medium', 'thumb'), headers={'Accept': 'image/png'})
+    assert resp.mimetype == 'image/png' and Image.open(io.BytesIO(resp.data)).width == 320
+    assert Image.open(io.BytesIO(client.get(payload['message']['image_full_url']).data)).width == 1200
+    resp = client.get(f"/uploads/{message.image_path}", headers={'Accept': 'image/webp'})
+    assert hashlib.sha256(resp.data).hexdigest() in message.image_path  # cached as immutable, so never rewritten
+    assert 'immutable' in resp.headers['Cache-Control'] and resp.mimetype == 'image/png'
+    assert client.get('/uploads/images/../../config.py').status_code == 404
+
+
+def test_non_image_upload_is_rejected(client):
+    create_user('faker')
+    topic = Topic(name='t')
+    db.session.add(topic)
+    db.session.commit()
+    client.post('/login', data={'username': 'faker', 'password': 'pass'})
+    resp = client.post('/api/send_message', data={
+        'topic_id': topic.id, 'content': 'x', 'image': (io.BytesIO(b'<script>'), 'evil.png'),
+    }, content_type='multipart/form-data')
+    assert resp.status_code == 415 and resp.get_json()['status'] == 'error'
+    assert Message.query.count() == 0
+
+
+def test_uploads_are_stored_without_their_metadata(client, monkeypatch):
+    create_user('tourist')
+    topic = Topic(name='trips')
+    db.session.add(topic)
+    db.session.commit()
+    login(client, 'tourist')
+    monkeypatch.setattr(app_module, 'IMAGE_PROCESSOR', MediaProcessor(mode='inline', options=app_module.IMAGE_PROCESSOR.options))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # orientation: rotated 90 degrees
+    exif[0x010F] = 'PhoneMaker'
+    exif[0x8825] = {1: 'S', 2: (1.0, 17.0, 42.0)}  # GPS
+    buf = io.BytesIO()
+    Image.new('RGB', (300, 200), (20, 90, 200)).save(buf, format='JPEG', exif=exif.tobytes(), comment=b'home')
+    message_id = client.post('/api/send_message', data={
+        'topic_id': topic.id, 'content': 'beach', 'image': (io.BytesIO(buf.getvalue()), 'beach.jpg'),
+    }, content_type='multipart/form-data').get_json()['message_id']
+
+    path = db.session.get(Message, message_id).image_path
+    resp = client.get(f'/uploads/{path}')
+    assert hashlib.sha256(resp.data).hexdigest() in path  # the hash is of the cleaned file
+    assert b'PhoneMaker' not in resp.data and b'home' not in resp.data
+    with Image.open(io.BytesIO(resp.data)) as image:
+        assert dict(image.getexif()) == {0x0112: 6} and image.size == (300, 200)
+
+
+def test_identical_uploads_are_stored_once_and_collected_when_unused(client, monkeypatch):
+    from models import MediaObject
+    create_user('admin', is_admin=True, admin_level=2)
+    first, second = Topic(name='one'), Topic(name='two')
+    db.session.add_all([first, second])
+    db.session.commit()
+    client.post('/login', data={'username': 'admin', 'password': 'pass'})
+    processor = MediaProcessor(mode='inline', options=app_module.IMAGE_PROCESSOR.options)
+    monkeypatch.setattr(app_module, 'IMAGE_PROCESSOR', processor)
+    meme = png_bytes(900, 900)
+
+    def post(topic):
+        return client.post('/api/send_message', data={
+            'topic_id': topic.id, 'content': 'lol', 'image': (io.BytesIO(meme), 'meme.JPEG.png'),
+        }, content_type='multipart/form-data').get_json()['message_id']
+
+    ids = [post(first), post(first), post(second)]
+    messages = [db.session.get(Message, i) for i in ids]
+    assert len({m.image_path for m in messages}) == 1
+    path = messages[0].image_path
+    assert path.startswith('images/') and path.count('/') == 3  # sharded by hash prefix
+    assert processor.processed == 1  # reposts reuse the processed variants
+    assert all(m.image_variants for m in messages)
+    media = db.session.get(MediaObject, path)
+    assert media.ref_count == 3 and media.variants
+
+    stored = os.path.join(app.config['UPLOAD_FOLDER'], path)
+    thumb = os.path.join(app.config['UPLOAD_FOLDER'], image_variant_path(path, 'thumb', webp=True))
+    assert os.path.isfile(stored) and os.path.isfile(thumb)
+
+    assert client.post(f'/api/delete_topic/{first.id}').get_json()['status'] == 'success'
+    db.session.expire_all()
+    assert db.session.get(MediaObject, path).ref_count == 1
+    assert os.path.isfile(stored)
+
+    assert client.post(f'/api/delete_message/{ids[2]}').get_json()['status'] == 'success'
+    db.session.expire_all()
+    assert db.session.get(MediaObject, path) is None
+    assert not os.path.exists(stored) and not os.path.exists(thumb)
+
+
+def test_reconcile_recounts_and_registers_older_uploads(client):
+    from models import MediaObject
+    user = create_user('r')
+    topic = Topic(name='t')
+    db.session.add(topic)
+    db.session.commit()
+    legacy = 'images/0123456789abcdef.png'
+    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'images'), exist_ok=True)
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], legacy), 'wb') as f:
+        f.write(png_bytes(10, 10))
+    db.session.add_all([Message(topic_id=topic.id, user_id=user.id, content='a', image_path=legacy),
+                        Message(topic_id=topic.id, user_id=user.id, content='b', image_path=legacy),
+                        Message(topic_id=topic.id, user_id=user.id, content='c', image_path=legacy, is_deleted=True),
+                        MediaObject(path='images/stale.png', kind='image', ref_count=5)])
+    db.session.commit()
+
+    assert app_module.reconcile_media_refs() == 2
+    assert db.session.get(MediaObject, legacy).ref_count == 2
+    assert app_module.collect_media() == ['images/stale.png']
+
+
+def test_uploads_are_cacheable_and_served_without_loading_the_user(client, monkeypatch):
+    from sqlalchemy import event
+    create_user('voicer')
+    topic = Topic(name='voices')
+    db.session.add(topic)
+    db.session.commit()
+    client.post('/login', data={'username': 'voicer', 'password': 'pass'})
+    audio = b'OggS' + bytes(range(256)) * 40
+    message_id = client.post('/api/send_message', data={
+        'topic_id': topic.id, 'content': '', 'voice': (io.BytesIO(audio), 'note.ogg'),
+    }, content_type='multipart/form-data').get_json()['message_id']
+    url = f"/uploads/{db.session.get(Message, message_id).voice_path}"
+
+    statements = []
+    listener = lambda *args: statements.append(1)  # noqa: E731
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        resp = client.get(url)
+        assert resp.status_code == 200 and resp.data == audio
+        assert set(resp.headers['Cache-Control'].split(', ')) == {'private', 'max-age=31536000', 'immutable'}
+        etag = resp.headers['ETag']
+        assert not etag.startswith('W/')
+        assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+        part = client.get(url, headers={'Range': 'bytes=100-199'})
+        assert part.status_code == 206 and part.data == audio[100:200]
+        assert part.headers['Content-Range'] == f'bytes 100-199/{len(audio)}'
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    assert statements == []
+
+    monkeypatch.setitem(app.config, 'UPLOADS_ACCEL_REDIRECT', '/protected-uploads/')
+    resp = client.get(url)
+    assert resp.headers['X-Accel-Redirect'] == '/protected-uploads/' + url[len('/uploads/'):]
+    assert resp.data == b'' and resp.mimetype == 'audio/ogg'
+
+    client.get('/logout')
+    assert client.get(url).status_code in (302, 401)
+
+
+def test_missing_variant_falls_back_without_long_caching(client):
+    create_user('w')
+    client.post('/login', data={'username': 'w', 'password': 'pass'})
+    path = 'images/ab/cd/' + 'ab' * 32 + '.png'
+    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'images/ab/cd'))
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], path), 'wb') as f:
+        f.write(png_bytes(100, 100))
+
+    resp = client.get(f'/uploads/{path}?size=thumb')  # not processed yet
+    assert resp.status_code == 200
+    assert set(resp.headers['Cache-Control'].split(', ')) == {'private', 'no-cache'}
+    assert 'immutable' in client.get(f'/uploads/{path}').headers['Cache-Control']
+
+
+def test_uploads_stream_to_disk_and_oversized_ones_are_cut_off(client, monkeypatch):
+    create_user('streamer')
+    topic = Topic(name='streams')
+    db.session.add(topic)
+    db.session.commit()
+    client.post('/login', data={'username': 'streamer', 'password': 'pass'})
+    monkeypatch.setitem(app.config, 'UPLOAD_LIMITS', {'image': 1024 * 1024, 'voice': 64 * 1024})
+    incoming = os.path.join(app.config['UPLOAD_FOLDER'], '.incoming')
+
+    big = io.BytesIO(b'OggS' + b'\0' * (4 * 1024 * 1024))
+    resp = client.post('/api/send_message', data={
+        'topic_id': topic.id, 'content': 'long one', 'voice': (big, 'long.ogg'),
+    }, content_type='multipart/form-data')
+    assert resp.status_code == 413 and 'Voice uploads' in resp.get_json()['message']
+    assert Message.query.count() == 0
+    client.get('/api/messages/none')  # the next request closes the previous one's spools
+    assert os.listdir(incoming) == []
+
+    assert client.post('/api/send_message', data={
+        'topic_id': topic.id, 'content': 'x', 'voice': (io.BytesIO(b'OggS'), 'notes.txt'),
+    }, content_type='multipart/form-data').status_code == 415
+
+    audio = b'OggS' + os.urandom(32 * 1024)
+    message_id = client.post('/api/send_message', data={
+        'topic_id': topic.id, 'content': '', 'voice': (io.BytesIO(audio), 'short.ogg'),
+    }, content_type='multipart/form-data').get_json()['message_id']
+    voice_path = db.session.get(Message, message_id).voice_path
+    assert os.path.basename(voice_path) == hashlib.sha256(audio).hexdigest() + '.ogg'
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], voice_path), 'rb') as f:
+        assert f.read() == audio
+    client.get('/api/messages/none')
+    assert os.listdir(incoming) == []
+
+
+def test_upload_body_is_read_before_the_write_lock_is_taken(client, monkeypatch):
+    from sqlalchemy import event
+    import uploads
+
+    create_user('waiter')
+    topic = Topic(name='locks')
+    db.session.add(topic)
+    db.session.commit()
+    client.post('/login', data={'username': 'waiter', 'password': 'pass'})
+    topic_id = topic.id
+    db.session.rollback()
+
+    log = []
+    real_write = uploads.UploadSpool.write
+
+    def write(self, data):
+        log.append('upload')
+        return real_write(self, data)
+
+    def on_execute(conn, cursor, statement, *args):
+        if statement.startswith('BEGIN') and threading.current_thread() is threading.main_thread():
+            log.append(statement)
+
+    monkeypatch.setattr(uploads.UploadSpool, 'write', write)
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    try:
+        resp = client.post('/api/send_message', data={
+            'topic_id': topic_id, 'content': 'slow', 'voice': (io.BytesIO(b'OggS' + b'\0' * 300000), 'v.ogg'),
+        }, content_type='multipart/form-data')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+    assert resp.get_json()['status'] == 'success'
+    immediate = log.index('BEGIN IMMEDIATE')
+    assert 'upload' in log[:immediate] and 'upload' not in log[immediate:]  # the body was read first
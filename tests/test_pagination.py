@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+from app import db
+from conftest import create_user, login
+from models import Topic, Message, PrivateChat, PrivateMessage
+
+
+def test_older_messages_walks_history_without_gaps(client):
+    user = create_user('reader')
+    topic = Topic(name='busy')
+    db.session.add(topic)
+    db.session.commit()
+    base = datetime(2024, 1, 1)
+    # Pairs of messages share a timestamp so the id tiebreaker matters
+    for i in range(120):
+        db.session.add(Message(topic_id=topic.id, user_id=user.id, content=f'm{i}',
+                               created_at=base + timedelta(seconds=i // 2)))
+    db.session.commit()
+    expected = [m.id for m in Message.query.order_by(Message.created_at, Message.id).all()]
+
+    login(client, 'reader')
+    seen = []
+    cursor = None
+    while True:
+        params = {'chat_type': 'topic', 'chat_id': topic.id, 'limit': 25}
+        if cursor:
+            params['before'] = cursor
+        data = client.get('/api/older_messages', query_string=params).get_json()
+        assert data['status'] == 'success'
+        seen = [m['id'] for m in data['messages']] + seen
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+
+    assert seen == expected
+
+    r = client.get('/api/older_messages', query_string={'chat_type': 'topic', 'chat_id': topic.id, 'before': 'bogus'})
+    assert r.status_code == 400
+
+
+def test_room_pages_render_newest_page_only(client):
+    user = create_user('owner')
+    create_user('other')
+    chat = PrivateChat(user_id=user.id)
+    db.session.add(chat)
+    db.session.commit()
+    base = datetime(2024, 1, 1)
+    for i in range(60):
+        db.session.add(PrivateMessage(chat_id=chat.id, user_id='admin', content=f'msg-{i:02d}',
+                                      created_at=base + timedelta(minutes=i)))
+    db.session.commit()
+
+    login(client, 'owner')
+    html = client.get(f'/my_private_chat/{chat.id}').get_data(as_text=True)
+    assert 'msg-59' in html and 'msg-10' in html
+    assert 'msg-09' not in html
+    # Unread state covers the whole chat, not just the rendered page
+    assert PrivateMessage.query.filter_by(chat_id=chat.id, is_read=False).count() == 0
+
+    client.get('/logout')
+    login(client, 'other')
+    r = client.get('/api/older_messages', query_string={'chat_type': 'private', 'chat_id': chat.id})
+    assert r.status_code == 403
+
+
+class QueryCounter:
+    """Count SQL statements issued while the block runs."""
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(db.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def _topic_with_authors(n):
+    topic = Topic(name=f'room-{n}')
+    db.session.add(topic)
+    db.session.commit()
+    for i in range(n):
+        author = create_user(f'author{n}-{i}')
+        db.session.add(Message(topic_id=topic.id, user_id=author.id, content=f'hi {i}',
+                               identity_revealed=bool(i % 2)))
+    db.session.commit()
+    return topic.id
+
+
+def _count_listing_queries(client, topic_id):
+    counts = []
+    db.session.expire_all()
+    for request in (
+        lambda: client.get(f'/topic/{topic_id}'),
+        lambda: client.get(f'/api/get_topic_messages/{topic_id}'),
+        lambda: client.get('/api/older_messages', query_string={'chat_type': 'topic', 'chat_id': topic_id}),
+        lambda: client.post('/api/new_messages', json={'chat_type': 'topic', 'chat_id': topic_id}),
+    ):
+        with QueryCounter() as counter:
+            assert request().status_code == 200
+        counts.append(counter.count)
+    return counts
+
+
+def test_message_listings_use_bounded_queries(client):
+    create_user('viewer')
+    small = _topic_with_authors(3)
+    large = _topic_with_authors(30)
+    login(client, 'viewer')
+
+    assert _count_listing_queries(client, large) == _count_listing_queries(client, small)
@@ -0,0 +1,232 @@
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+from app import db, PRESENCE, ACTIVITY, ACTIVE_COUNT_CACHE, compute_global_active_count
+from conftest import create_user
+from models import User
+from presence import PresenceBuffer
+from ratelimit import SlidingWindowLimiter
+
+
+def test_buffer_batches_heartbeats_and_retries_failed_flush():
+    batches = []
+    fail = [True]
+
+    def flush_fn(rows):
+        if fail[0]:
+            raise RuntimeError('db down')
+        batches.append(rows)
+
+    buf = PresenceBuffer(flush_fn, interval=3600)
+    now = datetime.utcnow()
+    for i in range(50):
+        buf.touch('u1', now + timedelta(seconds=i))
+    buf.touch('u2', now - timedelta(hours=2))
+
+    assert set(buf.seen_since(now - timedelta(minutes=5))) == {'u1'}
+    assert buf.flush() == 0  # failed, kept for the next round
+    fail[0] = False
+    assert buf.flush() == 2
+    assert len(batches) == 1
+    rows = {r['id']: r['last_login'] for r in batches[0]}
+    assert rows['u1'] == now + timedelta(seconds=49)
+    assert buf.flush() == 0
+
+
+def test_ping_is_buffered_and_counted_before_flush(client):
+    user = create_user('pinger')
+    client.post('/login', data={'username': 'pinger', 'password': 'pass'})
+    user.last_login = None
+    db.session.commit()
+    ACTIVITY.clear()
+    ACTIVE_COUNT_CACHE.clear()
+
+    updates = []
+
+    def on_execute(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith('UPDATE USER'):
+            updates.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    try:
+        for _ in range(20):
+            assert client.post('/api/ping').status_code == 200
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+
+    assert updates == []
+    assert compute_global_active_count() == 1
+
+    db.session.rollback()  # release this session's transaction before the flush writes
+    PRESENCE.flush()
+    assert db.session.get(User, user.id).last_login is not None
+
+
+def test_flush_skips_users_that_no_longer_exist(client):
+    from app import _write_presence
+    user = create_user('stayer')
+    user_id = user.id
+    db.session.rollback()
+    seen = datetime(2030, 1, 1)
+    buf = PresenceBuffer(_write_presence, interval=3600)
+    buf.touch(user_id, seen)
+    buf.touch('deleted-user', seen)
+    assert buf.flush() == 2
+    assert buf.flush() == 0  # nothing requeued
+    assert db.session.get(User, user_id).last_login == seen
+
+
+def test_room_counts_follow_pings_and_posts(client):
+    from app import compute_topic_active_count
+    from models import Topic
+    for name in ('ann', 'ben', 'cat'):
+        create_user(name)
+    topic = Topic(name='lobby')
+    db.session.add(topic)
+    db.session.commit()
+    ACTIVITY.clear()
+
+    client.post('/login', data={'username': 'ann', 'password': 'pass'})
+    client.post('/api/room_ping', json={'type': 'topic', 'id': topic.id})
+    client.get('/logout')
+    client.post('/login', data={'username': 'ben', 'password': 'pass'})
+    client.post('/api/send_message', data={'topic_id': topic.id, 'content': 'hello'})
+
+    assert compute_topic_active_count(topic.id) == 2
+
+    # an hour later both have dropped out of the window
+    assert ACTIVITY.count(f'topic:{topic.id}', now=datetime.utcnow() + timedelta(hours=1)) == 0
+
+
+def test_active_counts_query_count_does_not_grow_with_ids(client):
+    from app import INSTANCE_SETTINGS
+    from models import PrivateChat, Topic
+    viewer = create_user('viewer')
+    chats = [PrivateChat(user_id=viewer.id) for _ in range(30)]
+    topics = [Topic(name=f't{i}') for i in range(30)]
+    db.session.add_all(chats + topics)
+    db.session.commit()
+    client.post('/login', data={'username': 'viewer', 'password': 'pass'})
+
+    def statements(n):
+        url = ('/api/active_counts?chat_ids=' + ','.join(c.id for c in chats[:n])
+               + '&topic_ids=' + ','.join(t.id for t in topics[:n]))
+        seen = []
+        listener = lambda *args: seen.append(1)  # noqa: E731
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            data = client.get(url).get_json()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        assert len(data['chat_active']) == n and len(data['topic_active']) == n
+        return len(seen)
+
+    show = INSTANCE_SETTINGS.get('show_active_users')
+    INSTANCE_SETTINGS['show_active_users'] = True
+    try:
+        assert statements(30) == statements(3)
+    finally:
+        INSTANCE_SETTINGS['show_active_users'] = show
+
+
+class FakeSortedSetRedis:
+    """Just enough of redis-py's sorted-set and pipeline API for the presence store."""
+
+    def __init__(self):
+        self.zsets, self.ttls, self.round_trips = {}, {}, 0
+
+    def pipeline(self, transaction=True):
+        redis, calls = self, []
+
+        class Pipe:
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: calls.append((name, args, kwargs))
+
+            def execute(self):
+                redis.round_trips += 1
+                return [getattr(redis, name)(*args, **kwargs) for name, args, kwargs in calls]
+        return Pipe()
+
+    @staticmethod
+    def _bound(value):
+        return {'-inf': float('-inf'), '+inf': float('inf')}.get(value, value)
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zremrangebyscore(self, key, lo, hi):
+        zset = self.zsets.get(key, {})
+        for member in [m for m, s in zset.items() if self._bound(lo) <= s <= self._bound(hi)]:
+            del zset[member]
+
+    def expire(self, key, seconds):
+        self.ttls[key] = seconds
+
+    def zcount(self, key, lo, hi):
+        return sum(1 for s in self.zsets.get(key, {}).values() if self._bound(lo) <= s <= self._bound(hi))
+
+    def zrangebyscore(self, key, lo, hi, withscores=False):
+        rows = sorted((s, m) for m, s in self.zsets.get(key, {}).items()
+                      if self._bound(lo) <= s <= self._bound(hi))
+        return [(m.encode(), s) for s, m in rows]
+
+
+def test_redis_room_presence_uses_sorted_sets(client, monkeypatch):
+    import app as app_module
+    fake = FakeSortedSetRedis()
+    monkeypatch.setattr(app_module, '_redis_client', fake)
+    monkeypatch.setattr(app_module, 'USE_REDIS_PRESENCE', True)
+    ACTIVITY.clear()
+
+    now = datetime.utcnow()
+    uid = '3f2b8c1e-0000-4000-8000-000000000001'  # UUID ids must survive the round trip
+    app_module.add_presence('topic:a', uid, now)
+    app_module.add_presence('topic:a', 'u2', now - timedelta(minutes=2))
+    app_module.add_presence('topic:b', 'u3', now - timedelta(minutes=30))  # outside the window
+    app_module.add_presence('topic:b', 'u4', now - timedelta(days=1))  # beyond retention
+    key_b = app_module._presence_redis_key('topic:b')
+    assert set(fake.zsets[key_b]) == {'u3'}  # trimmed on write
+    assert fake.ttls[key_b] >= app_module.get_active_window_minutes() * 60
+
+    window = now - timedelta(minutes=5)
+    assert set(app_module.get_presence_entries('topic:a', window)) == {uid, 'u2'}
+
+    ACTIVITY.clear()  # counts must come from Redis, not this worker's windows
+    fake.round_trips = 0
+    counts = app_module.compute_room_active_counts(['topic:a', 'topic:b', 'relationship:c'])
+    assert counts == {'topic:a': 2, 'topic:b': 0, 'relationship:c': 0}
+    assert fake.round_trips == 1
+
+
+def test_janitor_reclaims_stale_presence_and_rate_limit_state():
+    import app as app_module
+    from presence import Janitor
+    now = datetime.utcnow()
+    old = now - timedelta(hours=2)
+    with app_module.ROOM_PRESENCE_LOCK:
+        app_module.ROOM_PRESENCE.clear()
+        app_module.ROOM_PRESENCE.update({'topic:gone': {'u1': old, 'u2': old}, 'topic:live': {'u1': old, 'u3': now}})
+    limiter = SlidingWindowLimiter()
+    limiter.hit('send:quiet', 5, 0.01)
+    limiter.hit('send:busy', 5, 3600)
+    ACTIVITY.clear()
+    ACTIVITY.touch('topic:gone', 'u1', old)
+    ACTIVITY.touch('topic:live', 'u3', now)
+
+    janitor = Janitor(interval=3600)
+    janitor.add('room_presence', app_module._sweep_room_presence)
+    janitor.add('activity_windows', ACTIVITY.sweep)
+    janitor.add('rate_limits', limiter.sweep)
+    janitor.add('broken', lambda: 1 / 0)  # a failing sweep must not stop the others
+
+    time.sleep(0.02)
+    assert janitor.run_once() == {'room_presence': 3, 'activity_windows': 1, 'rate_limits': 1}
+    assert app_module.ROOM_PRESENCE == {'topic:live': {'u3': now}}
+    assert set(limiter._hits) == {'send:busy'}
+    assert ACTIVITY.count('topic:live') == 1
+
+    assert janitor.run_once()['room_presence'] == 0
+    stats = janitor.stats()['sweeps']
+    assert stats['room_presence'] == {'held': 1, 'reclaimed': 0, 'reclaimed_total': 3}
+    assert stats['rate_limits']['held'] == 1
@@ -0,0 +1,85 @@
+from app import app, db
+import app as app_module
+from conftest import create_user, login
+from models import User
+from ratelimit import SlidingWindowLimiter
+
+
+def test_sliding_window_allows_budget_then_waits_for_oldest_hit(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('ratelimit.time.time', lambda: clock[0])
+    limiter = SlidingWindowLimiter()
+    for _ in range(3):
+        assert limiter.hit('k', 3, 10) == (True, None)
+        clock[0] += 1
+    allowed, retry_after = limiter.hit('k', 3, 10)
+    assert not allowed and retry_after == 7  # first hit (t=1000) leaves the window at t=1010
+    assert limiter.hit('other', 3, 10)[0]  # keys are independent
+
+    clock[0] = 1010.5
+    assert limiter.hit('k', 3, 10)[0]
+    assert limiter.denied == 1
+
+
+def test_redis_failure_falls_back_to_local_limiter():
+    class BrokenRedis:
+        def pipeline(self, transaction=True):
+            raise ConnectionError('redis down')
+
+    limiter = SlidingWindowLimiter(redis_client=BrokenRedis())
+    assert [limiter.hit('k', 2, 60)[0] for _ in range(3)] == [True, True, False]
+
+
+def test_endpoints_and_socket_ops_share_per_user_budgets(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'RATE_LIMITS', {'ping': (2, 60), 'login': (3, 60)})
+    create_user('spammer')
+    client.post('/login', data={'username': 'spammer', 'password': 'pass'})
+
+    assert client.post('/api/ping').status_code == 200
+    assert client.post('/api/room_ping', json={'type': 'topic', 'id': 'x'}).status_code != 429
+    resp = client.post('/api/ping')
+    assert resp.status_code == 429
+    assert resp.get_json()['code'] == 'rate_limited'
+    assert int(resp.headers['Retry-After']) >= 1
+
+    with app.test_request_context():
+        from flask_login import login_user
+        login_user(db.session.query(User).filter_by(username='spammer').one())
+        reply = app_module.handle_socket_op({'op': 'ping'}, sub=None)
+    assert reply['code'] == 'rate_limited'
+
+    client.get('/logout')
+
+
+def test_login_budget_counts_failures_per_username_and_address(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'RATE_LIMITS', {'login': (3, 60)})
+    create_user('spammer')
+    create_user('bystander')
+    for _ in range(5):  # successful logins are free
+        assert login(client, 'spammer').status_code == 302
+    client.get('/logout')
+
+    for _ in range(3):
+        assert client.post('/login', data={'username': 'spammer', 'password': 'wrong'}).status_code == 200
+    assert client.post('/login', data={'username': 'spammer', 'password': 'pass'}).status_code == 429
+    assert client.post('/admin/login', data={'username': 'Spammer', 'password': 'pass'}).status_code == 429
+    # other accounts, and the same account from another address, keep their own budgets
+    assert login(client, 'bystander').status_code == 302
+    client.get('/logout')
+    elsewhere = client.post('/login', data={'username': 'spammer', 'password': 'pass'},
+                            environ_base={'REMOTE_ADDR': '10.0.0.7'})
+    assert elsewhere.status_code == 302
+
+
+def test_retry_after_checks_without_charging(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('ratelimit.time.time', lambda: clock[0])
+    limiter = SlidingWindowLimiter()
+    assert limiter.retry_after('k', 2, 10) is None
+    limiter.hit('k', 2, 10)
+    clock[0] += 4
+    assert limiter.retry_after('k', 2, 10) is None
+    limiter.hit('k', 2, 10)
+    assert limiter.retry_after('k', 2, 10) == 6
+    clock[0] += 6.5
+    assert limiter.retry_after('k', 2, 10) is None
@@ -0,0 +1,135 @@
+from sqlalchemy import event
+
+from app import REACTION_EVENTS, db
+from conftest import create_user, login
+from models import Message, MessageReaction, ReactionCount, Relationship, RelationshipMessage, Topic
+
+
+def react(client, message_id, emoji):
+    resp = client.post('/api/react_message', json={'message_id': message_id, 'emoji': emoji})
+    assert resp.status_code == 200, resp.get_json()
+    return resp.get_json()['reactions']
+
+
+def test_toggle_keeps_rows_and_counts_in_step(client):
+    create_user('ann')
+    create_user('ben')
+    author = create_user('author')
+    topic = Topic(name='t')
+    db.session.add(topic)
+    db.session.commit()
+    message = Message(topic_id=topic.id, user_id=author.id, content='hi')
+    db.session.add(message)
+    db.session.commit()
+
+    login(client, 'ann')
+    assert react(client, message.id, '👍') == {'counts': {'👍': 1}, 'mine': ['👍']}
+    assert react(client, message.id, '❤️') == {'counts': {'❤️': 1, '👍': 1}, 'mine': ['❤️', '👍']}
+    login(client, 'ben')
+    assert react(client, message.id, '👍') == {'counts': {'❤️': 1, '👍': 2}, 'mine': ['👍']}
+    login(client, 'ann')
+    assert react(client, message.id, '👍') == {'counts': {'❤️': 1, '👍': 1}, 'mine': ['❤️']}
+    assert react(client, message.id, '❤️') == {'counts': {'👍': 1}, 'mine': []}
+
+    assert MessageReaction.query.count() == 1
+    assert [(c.emoji, c.count) for c in ReactionCount.query.all()] == [('👍', 1)]  # zero counts are removed
+    assert client.post('/api/react_message', json={'message_id': 'nope', 'emoji': '👍'}).status_code == 404
+    assert client.post('/api/react_message', json={'message_id': message.id, 'emoji': 'x' * 17}).status_code == 400
+
+
+def test_bulk_summaries_in_one_query_and_cleanup_on_delete(client):
+    create_user('admin', is_admin=True, admin_level=1)
+    author = create_user('author')
+    topic = Topic(name='t')
+    rel = Relationship(category='dating', person1='a')
+    db.session.add_all([topic, rel])
+    db.session.commit()
+    messages = [Message(topic_id=topic.id, user_id=author.id, content=str(i)) for i in range(30)]
+    rel_message = RelationshipMessage(relationship_id=rel.id, user_id=author.id, content='r')
+    db.session.add_all(messages + [rel_message])
+    db.session.commit()
+
+    login(client, 'author')
+    for message in messages[::3]:
+        react(client, message.id, '😂')
+    react(client, rel_message.id, '❤️')  # relationship messages keep their reactions too
+    login(client, 'admin')
+    react(client, messages[0].id, '😂')
+
+    ids = ','.join(m.id for m in messages + [rel_message])
+    statements = []
+
+    def listener(conn, cursor, statement, *args):
+        if 'reaction' in statement:
+            statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        data = client.get('/api/reactions', query_string={'ids': ids}).get_json()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    assert len(statements) == 1
+    summaries = data['reactions']
+    assert len(summaries) == 11
+    assert summaries[messages[0].id] == {'counts': {'😂': 2}, 'mine': ['😂']}
+    assert summaries[messages[3].id] == {'counts': {'😂': 1}, 'mine': []}
+    assert summaries[rel_message.id] == {'counts': {'❤️': 1}, 'mine': []}
+    assert messages[1].id not in summaries
+
+    page = client.get(f'/topic/{topic.id}').get_data(as_text=True)
+    assert '😂 2' in page
+
+    db.session.rollback()
+    assert client.post(f'/api/delete_topic/{topic.id}').get_json()['status'] == 'success'
+    assert [r.message_id for r in MessageReaction.query.all()] == [rel_message.id]
+    assert [c.message_id for c in ReactionCount.query.all()] == [rel_message.id]
+
+
+def test_toggles_are_broadcast_as_batched_counts(client, monkeypatch):
+    create_user('ann')
+    author = create_user('author')
+    rel = Relationship(category='dating', person1='a')
+    db.session.add(rel)
+    db.session.commit()
+    message = RelationshipMessage(relationship_id=rel.id, user_id=author.id, content='r')
+    db.session.add(message)
+    db.session.commit()
+    published = []
+    monkeypatch.setattr(REACTION_EVENTS, 'publish_fn', lambda *args: published.append(args))
+    monkeypatch.setattr(REACTION_EVENTS, 'window', 60)  # flushed by hand below
+
+    login(client, 'ann')
+    for emoji in ('👍', '❤️', '👍', '😂'):
+        react(client, message.id, emoji)
+    login(client, 'author')
+    react(client, message.id, '😂')
+    db.session.rollback()
+    assert published == []
+    assert REACTION_EVENTS.flush() == 1
+    assert published == [(f'relationship:{rel.id}',
+                          {'type': 'reactions', 'message_id': message.id, 'counts': {'❤️': 1, '😂': 2}},
+                          f'reactions:{message.id}')]
+
+
+def test_locked_rooms_keep_their_reactions_private(client):
+    author = create_user('author')
+    create_user('outsider')
+    open_topic, locked = Topic(name='open'), Topic(name='locked', is_locked=True)
+    db.session.add_all([open_topic, locked])
+    db.session.commit()
+    public = Message(topic_id=open_topic.id, user_id=author.id, content='hi')
+    hidden = Message(topic_id=locked.id, user_id=author.id, content='secret')
+    db.session.add_all([public, hidden])
+    db.session.commit()
+    public_id, hidden_id = public.id, hidden.id
+    db.session.add_all([MessageReaction(message_id=hidden_id, user_id=author.id, emoji='👍'),
+                        ReactionCount(message_id=hidden_id, emoji='👍', count=1)])
+    db.session.commit()
+
+    login(client, 'outsider')
+    react(client, public_id, '😂')
+    data = client.get('/api/reactions', query_string={'ids': f'{public_id},{hidden_id}'}).get_json()
+    assert list(data['reactions']) == [public_id]
+    resp = client.post('/api/react_message', json={'message_id': hidden_id, 'emoji': '👍'})
+    assert resp.status_code == 403
+    assert ReactionCount.query.filter_by(message_id=hidden_id).one().count == 1
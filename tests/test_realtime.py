@@ -0,0 +1,168 @@
+import json
+import threading
+import time
+
+import redis
+
+from realtime import RESYNC_FRAME, BroadcastHub, ChangeBatcher, make_broker
+
+
+def _payload(frame):
+    data = [line[len('data: '):] for line in frame.splitlines() if line.startswith('data: ')]
+    return json.loads(data[0])
+
+
+def test_publish_serializes_once_and_reaches_every_subscriber():
+    hub = BroadcastHub()
+    subs = [hub.subscribe('topic:1') for _ in range(50)]
+    other = hub.subscribe('topic:2')
+
+    delivered = hub.publish('topic:1', {'type': 'message', 'message': {'id': 'a'}})
+
+    assert delivered == 50
+    frames = [s.get(timeout=0) for s in subs]
+    # every subscriber receives the very same serialized string
+    assert all(f is frames[0] for f in frames)
+    assert _payload(frames[0])['message']['id'] == 'a'
+    assert other.get(timeout=0) is None
+    assert hub.subscriber_counts() == {'topic:1': 50, 'topic:2': 1}
+
+
+def test_unsubscribe_drops_empty_rooms_and_wakes_waiter():
+    hub = BroadcastHub()
+    sub = hub.subscribe('chat:9')
+    result = []
+    t = threading.Thread(target=lambda: result.append(sub.get(timeout=5)))
+    t.start()
+    hub.unsubscribe(sub)
+    t.join(1)
+
+    assert not t.is_alive()
+    assert result == [None]
+    assert hub.subscriber_count('chat:9') == 0
+    assert hub.subscriber_counts() == {}
+
+
+def test_sqlite_broker_reaches_subscribers_in_another_process_hub(tmp_path):
+    path = str(tmp_path / 'events.db')
+    # two hubs stand in for two gunicorn workers sharing the same event log
+    worker1, worker3 = BroadcastHub(), BroadcastHub()
+    publisher = make_broker(worker1, 'sqlite', sqlite_path=path, poll_interval=0.01)
+    listener = make_broker(worker3, 'sqlite', sqlite_path=path, poll_interval=0.01)
+    listener.start()
+    time.sleep(0.05)
+    sub = worker3.subscribe('topic:1')
+
+    publisher.publish('topic:1', json.dumps({'type': 'message'}))
+
+    frame = sub.get(timeout=2)
+    assert frame.startswith('id: ')
+    assert _payload(frame) == {'type': 'message'}
+
+
+def test_make_broker_auto_prefers_redis_then_sqlite(tmp_path):
+    hub = BroadcastHub()
+    assert make_broker(hub, 'auto').name == 'memory'
+    assert make_broker(hub, 'auto', sqlite_path=str(tmp_path / 'e.db')).name == 'sqlite'
+    assert make_broker(hub, 'auto', redis_client=redis.Redis()).name == 'redis'
+
+
+def test_full_queue_drops_oldest_and_coalesces_by_key():
+    hub = BroadcastHub(max_pending=3)
+    sub = hub.subscribe('topic:1')
+    for i in range(5):
+        hub.publish('topic:1', {'n': i})
+    hub.publish('topic:1', {'reaction': 1}, coalesce_key='reactions:m1')
+    hub.publish('topic:1', {'reaction': 2}, coalesce_key='reactions:m1')
+
+    frames = [_payload(sub.get(timeout=0)) for _ in range(3)]
+    assert frames == [{'n': 3}, {'n': 4}, {'reaction': 2}]
+    assert sub.get(timeout=0) is None
+    assert hub.stats()['dropped'] == {'topic:1': 3}
+
+
+def test_subscriber_stuck_over_limit_is_evicted():
+    hub = BroadcastHub(max_pending=1, grace=0)
+    sub = hub.subscribe('topic:1')
+    hub.publish('topic:1', {'n': 0})
+    hub.publish('topic:1', {'n': 1})  # queue full: start of the grace period
+    time.sleep(0.01)
+    hub.publish('topic:1', {'n': 2})
+
+    assert sub.closed
+    assert sub.get(timeout=0) is None
+    assert hub.subscriber_count('topic:1') == 0
+    assert hub.stats()['evicted'] == {'topic:1': 1}
+
+
+def test_last_event_id_replays_only_missed_events():
+    hub = BroadcastHub(replay_size=10)
+    broker = make_broker(hub, 'memory')
+    for i in range(5):
+        broker.publish('topic:1', json.dumps({'n': i}))
+    broker.publish('topic:2', json.dumps({'other': True}))
+
+    sub = hub.subscribe('topic:1', last_event_id=3)
+
+    frames = [sub.get(timeout=0) for _ in range(2)]
+    assert [f.splitlines()[0] for f in frames] == ['id: 4', 'id: 5']
+    assert [_payload(f) for f in frames] == [{'n': 3}, {'n': 4}]
+    assert sub.get(timeout=0) is None
+
+
+def test_resume_from_before_the_ring_buffer_asks_for_resync():
+    hub = BroadcastHub(replay_size=2)
+    broker = make_broker(hub, 'memory')
+    for i in range(5):
+        broker.publish('topic:1', json.dumps({'n': i}))
+
+    assert hub.subscribe('topic:1', last_event_id=1).get(timeout=0) == RESYNC_FRAME
+    # ids from before a restart are ahead of anything this process has seen
+    assert hub.subscribe('topic:1', last_event_id=99).get(timeout=0) == RESYNC_FRAME
+    assert hub.subscribe('topic:1', last_event_id=5).get(timeout=0) is None
+
+
+def test_multi_room_subscriber_replays_in_id_order_and_routes_control_frames():
+    hub = BroadcastHub(replay_exclude=('stream:',))
+    broker = make_broker(hub, 'memory')
+    broker.publish('topic:1', json.dumps({'n': 1}))
+    broker.publish('chat:2', json.dumps({'n': 2}))
+    broker.publish('topic:1', json.dumps({'n': 3}))
+
+    sub = hub.subscribe(['topic:1', 'chat:2'], last_event_id=0, control_room='stream:abc')
+    assert [_payload(sub.get(timeout=0)) for _ in range(3)] == [{'n': 1}, {'n': 2}, {'n': 3}]
+
+    broker.publish('stream:abc', json.dumps({'type': 'control', 'subscribe': ['topic:9']}))
+    assert sub.get(timeout=0) is None
+    assert [_payload(f) for f in sub.pop_control()] == [{'type': 'control', 'subscribe': ['topic:9']}]
+
+    hub.add_rooms(sub, ['topic:9'])
+    hub.remove_rooms(sub, ['chat:2'])
+    broker.publish('topic:9', json.dumps({'n': 4}))
+    broker.publish('chat:2', json.dumps({'n': 5}))
+    assert _payload(sub.get(timeout=0)) == {'n': 4}
+    assert sub.get(timeout=0) is None
+    # control rooms are not buffered for replay
+    assert hub.stats()['replay_rooms'] == 3
+
+
+def test_change_batcher_publishes_one_event_per_key_per_window():
+    built, published = [], []
+
+    def build(keys):
+        built.append(sorted(keys))
+        return {key: {'key': key} for key in keys if key != 'gone'}
+
+    batcher = ChangeBatcher(build, lambda room, payload, key: published.append((room, payload, key)),
+                            window=0.05, key_prefix='reactions:')
+    for _ in range(200):
+        batcher.mark('m1', 'topic:1')
+    batcher.mark('m2', 'topic:2')
+    batcher.mark('gone', 'topic:1')
+    assert published == []
+    time.sleep(0.3)
+
+    assert built == [['gone', 'm1', 'm2']]
+    assert sorted(published) == [('topic:1', {'key': 'm1'}, 'reactions:m1'), ('topic:2', {'key': 'm2'}, 'reactions:m2')]
+    batcher.mark('m1', 'topic:1')  # a later change starts a new window
+    assert batcher.flush() == 1 and batcher.marked == 203 and batcher.published == 3
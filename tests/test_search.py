@@ -0,0 +1,100 @@
+import json
+
+from app import db
+from conftest import create_user, login
+from models import Message, PrivateChat, PrivateMessage, Relationship, RelationshipMessage, Topic
+
+
+def search(client, **params):
+    resp = client.get('/api/search', query_string=params)
+    assert resp.status_code == 200, resp.get_json()
+    return resp.get_json()
+
+
+def test_index_follows_inserts_edits_and_deletes(client):
+    user = create_user('writer')
+    topic = Topic(name='news')
+    db.session.add(topic)
+    db.session.commit()
+    login(client, 'writer')
+    client.post('/api/send_message', data={'topic_id': topic.id, 'content': 'The canteen chapati is back'})
+    db.session.add(Message(topic_id=topic.id, user_id=user.id, content='Chapatis <b>sold out</b> again'))
+    db.session.commit()
+
+    hits = search(client, q='chapati')['results']
+    assert [h['type'] for h in hits] == ['topic', 'topic']  # prefix match covers 'Chapatis'
+    assert hits[0]['snippet'] == '<mark>Chapatis</mark> &lt;b&gt;sold out&lt;/b&gt; again'
+    assert hits[0]['sender_name'] == 'writer' and hits[0]['url'] == f'/topic/{topic.id}'
+
+    sold = Message.query.filter(Message.content.like('%sold%')).one()
+    sold.content = 'Ugali only today'
+    db.session.commit()
+    assert len(search(client, q='chapati')['results']) == 1
+    assert len(search(client, q='ugali')['results']) == 1
+
+    Message.query.filter_by(topic_id=topic.id).delete(synchronize_session=False)  # bulk, bypasses the ORM
+    db.session.commit()
+    assert search(client, q='chapati')['results'] == []
+    assert search(client, q='"OR (chapati*')['results'] == []  # FTS5 syntax in q is just text
+
+
+def test_search_respects_locks_and_private_chat_owners(client):
+    owner = create_user('owner')
+    other = create_user('other')
+    create_user('boss', is_admin=True, admin_level=2)
+    open_topic, locked = Topic(name='open'), Topic(name='locked', is_locked=True,
+                                                  allowed_user_ids=json.dumps([other.id]))
+    rel = Relationship(category='dating', person1='a')
+    db.session.add_all([open_topic, locked, rel])
+    db.session.commit()
+    chat = PrivateChat(user_id=owner.id)
+    db.session.add(chat)
+    db.session.commit()
+    db.session.add_all([
+        Message(topic_id=open_topic.id, user_id=other.id, content='exam leak open'),
+        Message(topic_id=locked.id, user_id=other.id, content='exam leak locked'),
+        RelationshipMessage(relationship_id=rel.id, user_id=other.id, content='exam leak rel', identity_revealed=True),
+        PrivateMessage(chat_id=chat.id, user_id=owner.id, content='exam leak private'),
+    ])
+    db.session.commit()
+
+    def contents(username, **params):
+        login(client, username)
+        return sorted(h['content'] for h in search(client, q='exam leak', **params)['results'])
+
+    assert contents('owner') == ['exam leak open', 'exam leak private', 'exam leak rel']
+    assert contents('other') == ['exam leak locked', 'exam leak open', 'exam leak rel']
+    assert contents('boss') == ['exam leak locked', 'exam leak open', 'exam leak private', 'exam leak rel']
+    assert contents('owner', type='topic', room_id=locked.id) == []
+    assert contents('boss', type='private') == ['exam leak private']
+    hit = search(client, q='rel')['results'][0]
+    assert hit['sender_name'] == 'Other' and hit['url'] == f'/relationship_chat/{rel.id}'
+    assert client.get('/api/search?q=exam&type=bogus').status_code == 400
+    assert client.get('/api/search?q=%22%22').status_code == 400
+
+
+def test_pages_merge_kinds_newest_first_without_repeats(client):
+    from datetime import datetime, timedelta
+    user = create_user('pager')
+    topic, rel = Topic(name='t'), Relationship(category='dating', person1='p')
+    db.session.add_all([topic, rel])
+    db.session.commit()
+    start = datetime(2024, 1, 1)
+    for i in range(25):
+        model = Message(topic_id=topic.id) if i % 3 else RelationshipMessage(relationship_id=rel.id)
+        model.user_id, model.content, model.created_at = user.id, f'match number {i}', start + timedelta(minutes=i)
+        db.session.add(model)
+        db.session.add(Message(topic_id=topic.id, user_id=user.id, content=f'noise {i}', created_at=start))
+    db.session.commit()
+    login(client, 'pager')
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        data = search(client, q='match', limit=10, **({'cursor': cursor} if cursor else {}))
+        seen += [h['content'] for h in data['results']]
+        pages += 1
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+    assert pages == 3
+    assert seen == [f'match number {i}' for i in reversed(range(25))]
@@ -0,0 +1,124 @@
+import json
+
+import pytest
+from flask_login import login_user
+
+import app as app_module
+from app import app, db
+from conftest import create_user
+from models import Message, MessageReaction, Relationship, RelationshipMessage, Topic
+from realtime import LocalBroker, parse_frame
+
+
+@pytest.fixture
+def client(client, monkeypatch):
+    # deliver room events straight into this process' hub
+    monkeypatch.setattr(app_module, 'SSE_BROKER', LocalBroker(app_module.SSE_HUB))
+    monkeypatch.setattr(app_module.REACTION_EVENTS, 'window', 0)
+    yield client
+
+
+def socket_op(user, sub, **msg):
+    """Run one /ws op as user, the way chat_socket does (one transaction per op)."""
+    with app.test_request_context('/ws'):
+        login_user(user)
+        try:
+            return app_module.handle_socket_op(msg, sub)
+        finally:
+            db.session.rollback()
+
+
+def events(sub):
+    frames = []
+    while (frame := sub.get(timeout=0)) is not None:
+        frames.append(json.loads(parse_frame(frame)[1]))
+    return frames
+
+
+def test_subscribe_send_reply_and_react_over_the_socket(client):
+    user = create_user('sock')
+    other = create_user('other')
+    topic, locked = Topic(name='open'), Topic(name='locked', is_locked=True, allowed_user_ids=json.dumps([other.id]))
+    rel = Relationship(category='dating', person1='a')
+    db.session.add_all([topic, locked, rel])
+    db.session.commit()
+    topic_id, locked_id, rel_id = topic.id, locked.id, rel.id
+    sub = app_module.SSE_HUB.subscribe([f'user:{user.id}'])
+    try:
+        reply = socket_op(user, sub, op='subscribe', rooms=[f'topic:{topic_id}', f'topic:{locked_id}', f'relationship:{rel_id}'])
+        assert reply['status'] == 'success'
+        assert reply['denied'] == [f'topic:{locked_id}']
+        assert reply['rooms'] == sorted([f'user:{user.id}', f'topic:{topic_id}', f'relationship:{rel_id}'])
+
+        sent = socket_op(user, sub, op='send', topic_id=topic_id, content='over the socket')
+        assert sent['status'] == 'success' and sent['content'] == 'over the socket'
+        assert [(e['type'], e['message']['content']) for e in events(sub)] == [('message', 'over the socket')]
+
+        rel_sent = socket_op(user, sub, op='send', relationship_id=rel_id, content='rel note', identity_revealed=True)
+        assert db.session.get(RelationshipMessage, rel_sent['message_id']).identity_revealed
+        assert [e['room'] for e in events(sub)] == [f'relationship:{rel_id}']
+
+        answered = socket_op(other, sub, op='reply', parent_id=sent['message_id'], content='answer')
+        assert answered['status'] == 'success'
+        assert db.session.get(Message, answered['message_id']).parent_id == sent['message_id']
+        assert [(e['type'], e['message']['parent_id']) for e in events(sub)] == [('reply', sent['message_id'])]
+
+        reacted = socket_op(other, sub, op='react', message_id=sent['message_id'], emoji='👍')
+        assert reacted == {'status': 'success', 'reactions': {'counts': {'👍': 1}, 'mine': ['👍']}}
+        assert MessageReaction.query.count() == 1
+        assert events(sub) == [{'type': 'reactions', 'message_id': sent['message_id'], 'counts': {'👍': 1},
+                                'room': f'topic:{topic_id}'}]
+
+        reply = socket_op(user, sub, op='unsubscribe', rooms=[f'topic:{topic_id}', f'user:{user.id}'])
+        assert reply['rooms'] == sorted([f'user:{user.id}', f'relationship:{rel_id}'])  # the user room stays
+        socket_op(user, sub, op='send', topic_id=topic_id, content='not delivered')
+        assert events(sub) == []
+    finally:
+        app_module.SSE_HUB.unsubscribe(sub)
+
+
+def test_socket_ops_report_errors_in_their_acks(client):
+    user = create_user('sock')
+    locked = Topic(name='locked', is_locked=True)
+    db.session.add(locked)
+    db.session.commit()
+    locked_id = locked.id
+    sub = app_module.SSE_HUB.subscribe([f'user:{user.id}'])
+    try:
+        assert socket_op(user, sub, op='subscribe', rooms=[f'topic:{locked_id}', 'stream:x'])['denied'] == [
+            f'topic:{locked_id}', 'stream:x']
+        assert socket_op(user, sub, op='send', content='where?') == {
+            'status': 'error', 'message': 'topic_id or relationship_id required'}
+        assert socket_op(user, sub, op='send', topic_id=locked_id, content='let me in') == {
+            'status': 'error', 'message': 'Topic is locked'}
+        assert socket_op(user, sub, op='reply', parent_id='missing', content='hi') == {
+            'status': 'error', 'message': 'Parent message not found'}
+        assert socket_op(user, sub, op='reply', content='hi')['message'] == 'Missing parent or content'
+        assert socket_op(user, sub, op='react', message_id='missing', emoji='👍') == {
+            'status': 'error', 'message': 'Message not found'}
+        assert socket_op(user, sub, op='react', message_id='missing')['message'] == 'Missing message id or emoji'
+        assert socket_op(user, sub, op='dance') == {'status': 'error', 'message': 'Unknown op: dance'}
+        assert Message.query.count() == 0 and events(sub) == []
+    finally:
+        app_module.SSE_HUB.unsubscribe(sub)
+
+
+def test_socket_handshake_must_come_from_an_allowed_origin(client, monkeypatch):
+    create_user('sock')
+    client.post('/login', data={'username': 'sock', 'password': 'pass'})
+    resp = client.get('/ws', headers={'Origin': 'https://evil.example', 'Connection': 'Upgrade',
+                                      'Upgrade': 'websocket', 'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ==',
+                                      'Sec-WebSocket-Version': '13'})
+    assert resp.status_code == 403  # refused before the upgrade
+
+    def allowed(origin):
+        headers = {'Origin': origin} if origin else {}
+        with app.test_request_context('/ws', base_url='https://chat.example.com', headers=headers):
+            return app_module.socket_origin_allowed()
+
+    assert allowed('https://chat.example.com')
+    assert allowed(None)  # not a browser, so no visitor's cookies either
+    assert not allowed('https://chat.example.com.evil.example')
+    assert not allowed('null')
+    monkeypatch.setitem(app.config, 'WEBSOCKET_ALLOWED_ORIGINS', ['https://app.example.com'])
+    assert allowed('https://app.example.com/')
@@ -0,0 +1,95 @@
+import threading
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+
+from app import REACTION_EVENTS, db
+from conftest import create_user, login
+from models import Message, Topic
+from sqlite_tuning import configure_sqlite_engine, sqlite_pragmas
+
+
+def _engine(path, begin_mode='IMMEDIATE'):
+    engine = create_engine(f'sqlite:///{path}', pool_size=8, max_overflow=0)
+    configure_sqlite_engine(engine, sqlite_pragmas({'SQLITE_BUSY_TIMEOUT_MS': 10000}), begin_mode=begin_mode)
+    return engine
+
+
+def test_pragmas_applied_on_connect(tmp_path):
+    engine = _engine(tmp_path / 'p.db')
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert conn.exec_driver_sql('PRAGMA synchronous').scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql('PRAGMA busy_timeout').scalar() == 10000
+        assert conn.exec_driver_sql('PRAGMA cache_size').scalar() == -20000
+    engine.dispose()
+
+
+def test_concurrent_read_then_write_has_no_lock_errors(tmp_path):
+    # Each transaction reads before writing, like a request that loads current_user then posts.
+    # With deferred BEGIN this pattern fails fast with "database is locked" under contention.
+    engine = _engine(tmp_path / 's.db')
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE msg (id INTEGER PRIMARY KEY, n INTEGER)'))
+
+    errors = []
+    workers, per_worker = 8, 40
+
+    def worker():
+        for _ in range(per_worker):
+            try:
+                with engine.begin() as conn:
+                    count = conn.execute(text('SELECT count(*) FROM msg')).scalar()
+                    conn.execute(text('INSERT INTO msg (n) VALUES (:n)'), {'n': count})
+            except OperationalError as exc:
+                errors.append(exc)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with engine.connect() as conn:
+        total = conn.execute(text('SELECT count(*) FROM msg')).scalar()
+    engine.dispose()
+    assert errors == []
+    assert total == workers * per_worker
+
+
+def test_begin_mode_per_endpoint(client, monkeypatch):
+    monkeypatch.setattr(REACTION_EVENTS, 'window', 0)  # publish before the tables are dropped
+    user = create_user('poller')
+    topic = Topic(name='t')
+    db.session.add(topic)
+    db.session.commit()
+    message = Message(topic_id=topic.id, user_id=user.id, content='hi')
+    db.session.add(message)
+    db.session.commit()
+    topic_id, message_id, user_id = topic.id, message.id, user.id
+    login(client, 'poller')
+
+    def begins(method, url, **kwargs):
+        db.session.rollback()  # the test's app context (and session) is shared by every request
+        log = []
+
+        def on_execute(conn, cursor, statement, *args):
+            if statement.startswith('BEGIN') and threading.current_thread() is threading.main_thread():
+                log.append(statement.split()[1])
+
+        event.listen(db.engine, 'before_cursor_execute', on_execute)
+        try:
+            resp = client.open(url, method=method, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', on_execute)
+        assert resp.status_code == 200, (url, resp.status_code)
+        return set(log)
+
+    # heartbeats and the poll only read, so they never queue for the write lock
+    assert begins('POST', '/api/ping') == {'DEFERRED'}
+    assert begins('POST', '/api/room_ping', json={'type': 'topic', 'id': topic_id}) == {'DEFERRED'}
+    assert begins('POST', '/api/new_messages', json={'chat_id': topic_id, 'chat_type': 'topic'}) == {'DEFERRED'}
+    assert begins('POST', '/api/stream/subscribe', json={'stream_id': f'{user_id}.s', 'subscribe': [f'topic:{topic_id}']}) == {'DEFERRED'}
+    assert begins('GET', f'/topic/{topic_id}') == {'DEFERRED'}
+    assert begins('POST', '/api/react_message', json={'message_id': message_id, 'emoji': '👍'}) == {'IMMEDIATE'}
+    assert begins('POST', '/api/send_message', data={'topic_id': topic_id, 'content': 'hey'}) == {'DEFERRED', 'IMMEDIATE'}
@@ -0,0 +1,135 @@
+import json
+import queue
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from app import app, db
+from conftest import create_user, login
+from models import PrivateChat, PrivateMessage, Relationship, Topic
+from realtime import LocalBroker, parse_frame
+
+
+@pytest.fixture
+def client(client, monkeypatch):
+    # deliver room events straight into this process' hub
+    monkeypatch.setattr(app_module, 'SSE_BROKER', LocalBroker(app_module.SSE_HUB))
+    monkeypatch.setattr(app_module, 'SSE_HEARTBEAT_SECONDS', 0.1)
+    monkeypatch.setitem(app_module.INSTANCE_SETTINGS, 'show_active_users', True)
+    yield client
+
+
+class Stream:
+    """An open /stream/multi response, read on its own thread and test client.
+
+    The stream's request context lives for as long as the response is read, so it must not
+    share a thread (or a context-preserving test client) with the other requests of the test.
+    """
+
+    def __init__(self, rooms, username):
+        self.frames = queue.Queue()
+        self._stop = threading.Event()
+        self.client = app.test_client()
+        login(self.client, username)
+        self._thread = threading.Thread(target=self._read, args=(','.join(rooms),), daemon=True)
+        self._thread.start()
+
+    def _read(self, rooms):
+        resp = self.client.get('/stream/multi', query_string={'rooms': rooms}, buffered=False)
+        try:
+            assert resp.mimetype == 'text/event-stream'
+            for chunk in resp.response:
+                chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+                if chunk.startswith(('data: ', 'id: ')):
+                    self.frames.put(json.loads(parse_frame(chunk)[1]))
+                if self._stop.is_set():  # keepalives arrive every SSE_HEARTBEAT_SECONDS
+                    break
+        finally:
+            resp.close()
+
+    def next_of(self, kind, timeout=5):
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self.frames.get(timeout=max(0, deadline - time.monotonic()))
+            if frame['type'] == kind:
+                return frame
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(5)
+        assert not self._thread.is_alive()
+
+
+def test_stream_handshake_subscriptions_and_room_events(client):
+    viewer_id = create_user('viewer').id
+    topic, locked = Topic(name='open'), Topic(name='locked', is_locked=True)
+    rel = Relationship(category='dating', person1='a')
+    db.session.add_all([topic, locked, rel])
+    db.session.commit()
+    topic_id, locked_id, rel_id = topic.id, locked.id, rel.id
+    login(client, 'viewer')
+    db.session.rollback()
+
+    stream = Stream([f'topic:{topic_id}', f'topic:{locked_id}'], 'viewer')
+    try:
+        hello = stream.next_of('hello')
+        assert hello['stream_id'].startswith(f"{viewer_id}.")
+        assert hello['rooms'] == [f'topic:{topic_id}'] and hello['denied'] == [f'topic:{locked_id}']
+        presence = stream.next_of('presence')
+        assert presence['global_active'] >= 1 and presence['active'][f'topic:{topic_id}'] >= 0
+
+        resp = client.post('/api/stream/subscribe', json={
+            'stream_id': hello['stream_id'],
+            'subscribe': [f'relationship:{rel_id}', f'topic:{locked_id}'],
+            'unsubscribe': [f'topic:{topic_id}'],
+        }).get_json()
+        assert resp == {'status': 'success', 'subscribed': [f'relationship:{rel_id}'], 'denied': [f'topic:{locked_id}']}
+        assert stream.next_of('subscribed')['rooms'] == [f'relationship:{rel_id}']
+
+        app_module.publish_to_room(f'topic:{topic_id}', {'type': 'message', 'message': {'content': 'gone'}})
+        app_module.publish_to_room(f'relationship:{rel_id}', {'type': 'message', 'message': {'content': 'here'}})
+        event = stream.next_of('message')
+        assert event['room'] == f'relationship:{rel_id}' and event['message']['content'] == 'here'
+
+        # another user's stream id is refused
+        assert client.post('/api/stream/subscribe', json={'stream_id': 'someone.else'}).status_code == 404
+    finally:
+        stream.close()
+    assert app_module.SSE_HUB.subscriber_count(f'relationship:{rel_id}') == 0  # closing the response unsubscribes
+
+
+def test_unread_deltas_reach_the_owner_and_the_admins(client):
+    owner = create_user('owner')
+    create_user('admin', is_admin=True, admin_level=2)
+    chat = PrivateChat(user_id=owner.id)
+    db.session.add(chat)
+    db.session.commit()
+    chat_id = chat.id
+    db.session.add(PrivateMessage(chat_id=chat_id, user_id=owner.id, content='help?', is_read=False))
+    db.session.commit()
+
+    owner_id = owner.id
+    db.session.rollback()
+    owner_stream, admin_stream = Stream([], 'owner'), Stream([], 'admin')
+    try:
+        owner_stream.next_of('hello')
+        admin_stream.next_of('hello')
+        login(client, 'admin')
+        db.session.rollback()
+        client.post('/api/private_message', data={'chat_id': chat_id, 'content': 'on it'})
+        assert owner_stream.next_of('unread') == {'type': 'unread', 'delta': 1, 'chat_id': chat_id,
+                                                  'room': f'user:{owner_id}'}
+        assert admin_stream.next_of('unread')['room'] == 'admin:unread'
+
+        # the admin view marks both messages read; the owner's badge drops by the reply it counted
+        db.session.rollback()
+        assert client.get(f'/admin/private_chat/{chat_id}').status_code == 200
+        assert owner_stream.next_of('unread')['delta'] == -1
+        assert admin_stream.next_of('unread')['delta'] == -2
+    finally:
+        owner_stream.close()
+        admin_stream.close()
+    db.session.rollback()
+    assert PrivateMessage.query.filter_by(is_read=False).count() == 0
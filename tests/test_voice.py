@@ -0,0 +1,117 @@
+import io
+import os
+
+import pytest
+
+import app as app_module
+from app import app, db
+from conftest import create_user
+from media import MediaProcessor
+from models import Message, Topic
+
+
+@pytest.fixture
+def client(client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    yield client
+
+
+def test_pitch_shift_moves_the_pitch_and_keeps_the_length():
+    np = pytest.importorskip('numpy')
+    from voice import SAMPLE_RATE, apply_preset, pitch_shift
+
+    def dominant_hz(samples):
+        spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+        return np.fft.rfftfreq(len(samples), 1.0 / SAMPLE_RATE)[np.argmax(spectrum)]
+
+    t = np.arange(SAMPLE_RATE, dtype=np.float32) / SAMPLE_RATE
+    tone = (0.5 * np.sin(2 * np.pi * 200 * t)).astype(np.float32)
+    for factor in (0.72, 1.35):
+        shifted = pitch_shift(tone, factor)
+        assert len(shifted) == len(tone)
+        assert dominant_hz(shifted) == pytest.approx(200 * factor, rel=0.05)
+    for voice_type in ('cartoon', 'female', 'deep', 'robot'):
+        rendered = apply_preset(tone, voice_type)
+        assert len(rendered) == len(tone) and np.max(np.abs(rendered)) == pytest.approx(0.89, rel=1e-3)
+
+
+def test_voice_effect_is_rendered_once_and_served_in_place_of_the_upload(client, monkeypatch):
+    renders = []
+
+    def fake_render(src_path, dst_path, voice_type, **options):
+        renders.append((voice_type, options))
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            dst.write(src.read() + voice_type.encode())
+        return {'voice_type': voice_type}
+
+    monkeypatch.setattr(app_module, 'VOICE_EFFECTS_ENABLED', True)
+    monkeypatch.setattr(app_module, 'VOICE_PROCESSOR', MediaProcessor(
+        kind='voice', mode='inline', process_fn=fake_render, options=app_module.VOICE_PROCESSOR.options))
+    create_user('deepvoice')
+    topic = Topic(name='voices')
+    db.session.add(topic)
+    db.session.commit()
+    client.post('/login', data={'username': 'deepvoice', 'password': 'pass'})
+
+    audio = b'OggS' + os.urandom(2048)
+
+    def send(voice_type):
+        resp = client.post('/api/send_message', data={
+            'topic_id': topic.id, 'content': '', 'voice_type': voice_type, 'voice': (io.BytesIO(audio), 'note.ogg'),
+        }, content_type='multipart/form-data')
+        return db.session.get(Message, resp.get_json()['message_id'])
+
+    first, second = send('deep'), send('deep')
+    assert [r[0] for r in renders] == ['deep']  # the repost reused the render
+    assert renders[0][1] == {'max_seconds': 120, 'bitrate': '32k'}
+
+    with app.test_request_context():
+        url = app_module.voice_url(second)
+    assert url.endswith('?voice=deep') and first.voice_path == second.voice_path
+    resp = client.get(url)
+    assert resp.data == audio + b'deep' and 'immutable' in resp.headers['Cache-Control']
+
+    plain = send('normal')
+    with app.test_request_context():
+        plain_url = app_module.voice_url(plain)
+    assert client.get(plain_url).data == audio
+    assert len(renders) == 1
+
+    monkeypatch.setattr(app_module, 'VOICE_EFFECTS_ENABLED', False)
+    robot = send('robot')  # effects unavailable: the upload is played as is, and revalidated
+    with app.test_request_context():
+        robot_url = app_module.voice_url(robot)
+    resp = client.get(robot_url)
+    assert resp.data == audio and 'no-cache' in resp.headers['Cache-Control']
+
+
+def test_voice_notes_are_published_without_waiting_for_the_render(client, monkeypatch):
+    import threading
+    release = threading.Event()
+
+    def slow_render(src_path, dst_path, voice_type, **options):
+        release.wait(10)
+        return {'voice_type': voice_type}
+
+    processor = MediaProcessor(kind='voice', mode='thread', workers=1, process_fn=slow_render,
+                               options=app_module.VOICE_PROCESSOR.options)
+    events = []
+    monkeypatch.setattr(app_module, 'VOICE_EFFECTS_ENABLED', True)
+    monkeypatch.setattr(app_module, 'VOICE_PROCESSOR', processor)
+    monkeypatch.setattr(app_module, 'publish_to_room', lambda room_key, payload, coalesce_key=None: events.append(payload))
+    create_user('queued')
+    topic = Topic(name='queue')
+    db.session.add(topic)
+    db.session.commit()
+    client.post('/login', data={'username': 'queued', 'password': 'pass'})
+    try:
+        resp = client.post('/api/send_message', data={
+            'topic_id': topic.id, 'content': 'listen', 'voice_type': 'cartoon',
+            'voice': (io.BytesIO(b'OggS' + os.urandom(1024)), 'note.ogg'),
+        }, content_type='multipart/form-data')
+        assert resp.get_json()['has_voice']
+        assert processor.pending == 1  # still rendering
+        assert [e['message']['voice_url'].endswith('?voice=cartoon') for e in events] == [True]
+    finally:
+        release.set()
+        processor.shutdown()
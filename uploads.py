@@ -0,0 +1,128 @@
+"""Streaming multipart uploads.
+
+Werkzeug parses a multipart body before the view runs, buffering each file in a spooled
+temporary file. UploadRequest replaces that with an UploadSpool per file part: chunks go
+straight to a temporary file under UPLOAD_FOLDER/.incoming while they are hashed, the first
+bytes are checked against the file's extension, and the per-type size limit
+(UPLOAD_LIMITS) is enforced as the bytes arrive. A payload that is too large or isn't the type
+its name claims is rejected (413 / 415) as soon as that is known, without reading the rest of it.
+utils.store_media then moves the spool into its content-addressed path instead of copying
+and hashing the file again.
+"""
+import hashlib
+import os
+import uuid
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+INCOMING_DIR = '.incoming'
+HEAD_BYTES = 12  # enough for every signature in SIGNATURES
+
+
+def _is_mp3(head):
+    return head.startswith(b'ID3') or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0)
+
+
+# extension -> check on the first bytes of the file
+SIGNATURES = {
+    'png': lambda head: head.startswith(b'\x89PNG\r\n\x1a\n'),
+    'jpg': lambda head: head.startswith(b'\xff\xd8\xff'),
+    'jpeg': lambda head: head.startswith(b'\xff\xd8\xff'),
+    'gif': lambda head: head[:6] in (b'GIF87a', b'GIF89a'),
+    'webp': lambda head: head[:4] == b'RIFF' and head[8:12] == b'WEBP',
+    'mp3': _is_mp3,
+    'wav': lambda head: head[:4] == b'RIFF' and head[8:12] == b'WAVE',
+    'ogg': lambda head: head.startswith(b'OggS'),
+}
+
+
+def upload_kind(filename):
+    """'image' or 'voice' for an allowed upload name, else None."""
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    if ext in current_app.config['ALLOWED_IMAGE_EXTENSIONS']:
+        return 'image'
+    if ext in current_app.config['ALLOWED_VOICE_EXTENSIONS']:
+        return 'voice'
+    return None
+
+
+class UploadSpool:
+    """Writable, then readable, temporary file for one uploaded file, hashed as it is written."""
+
+    def __init__(self, directory, ext, kind, limit):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{uuid.uuid4().hex}.part')
+        self.ext = ext
+        self.kind = kind
+        self.limit = limit
+        self.size = 0
+        self._file = open(self.path, 'w+b')
+        self._hash = hashlib.sha256()
+        self._head = b''
+        self._checked = False
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit and self.size > self.limit:
+            raise RequestEntityTooLarge(f'{self.kind.capitalize()} uploads are limited to {self.limit // (1024 * 1024)} MB.')
+        if not self._checked:
+            self._head += data[:HEAD_BYTES]
+            if len(self._head) >= HEAD_BYTES:
+                self._check()
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def _check(self):
+        self._checked = True
+        signature = SIGNATURES.get(self.ext)
+        if signature and not signature(self._head):
+            raise UnsupportedMediaType(f'That file is not a valid {self.ext} {self.kind}.')
+
+    def seek(self, offset, whence=0):
+        # the parser seeks back to the start once the part is complete
+        if not self._checked:
+            self._check()
+        return self._file.seek(offset, whence)
+
+    def move_to(self, final_path):
+        """Close the spool and rename it to final_path (same filesystem as UPLOAD_FOLDER)."""
+        self._file.close()
+        os.replace(self.path, final_path)
+
+    def close(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        # read, readline, tell, readable, seekable, ... come from the underlying file
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Request class that streams image/voice parts into UploadSpools (see module docstring)."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if not filename:  # an empty file input
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        kind = upload_kind(filename)
+        if kind is None:
+            raise UnsupportedMediaType('Only image and voice uploads are accepted.')
+        limit = current_app.config.get('UPLOAD_LIMITS', {}).get(kind)
+        if limit and content_length and content_length > limit:
+            raise RequestEntityTooLarge(f'{kind.capitalize()} uploads are limited to {limit // (1024 * 1024)} MB.')
+        directory = os.path.join(current_app.config['UPLOAD_FOLDER'], INCOMING_DIR)
+        spool = UploadSpool(directory, filename.rsplit('.', 1)[1].lower(), kind, limit)
+        # tracked here too: if parsing fails, request.files never holds the spool to close it
+        self.__dict__.setdefault('_upload_spools', []).append(spool)
+        return spool
+
+    def close(self):
+        super().close()
+        for spool in self.__dict__.pop('_upload_spools', ()):
+            spool.close()
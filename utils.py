@@ -1,9 +1,9 @@
+import hashlib
 import os
+import re
 import uuid
-from werkzeug.utils import secure_filename
 from flask import current_app
 from PIL import Image
-import secrets
 
 def allowed_file(filename, file_type='image'):
     """Check if file extension is allowed"""
@@ -14,60 +14,280 @@ def allowed_file(filename, file_type='image'):
     
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed
 
-def save_image(file):
-    """Save uploaded image and return filename"""
-    if file and allowed_file(file.filename, 'image'):
-        # Generate unique filename
-        file_ext = file.filename.rsplit('.', 1)[1].lower()
-        filename = f"{uuid.uuid4().hex}.{file_ext}"
-        
-        # Ensure upload directory exists
-        upload_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'images')
-        os.makedirs(upload_dir, exist_ok=True)
-        
-        file_path = os.path.join(upload_dir, filename)
-        
-        # Open and optimize image
-        image = Image.open(file)
-        
-        # Resize if too large (max 1200px width)
-        if image.width > 1200:
-            ratio = 1200 / image.width
-            new_height = int(image.height * ratio)
-            image = image.resize((1200, new_height), Image.Resampling.LANCZOS)
-        
-        # Save optimized image
-        image.save(file_path, optimize=True, quality=85)
-        
-        return f"images/{filename}"
+def media_path(kind_dir, digest, ext):
+    """Content-addressed path for an upload: <kind_dir>/<2 hex>/<2 hex>/<sha256>.<ext>."""
+    return f"{kind_dir}/{digest[:2]}/{digest[2:4]}/{digest}.{ext}"
+
+_CONTENT_ADDRESSED = re.compile(r'^[a-z]+/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]+$')
+
+def is_content_addressed(path):
+    """True for paths made by media_path (the same path always holds the same upload)."""
+    return bool(_CONTENT_ADDRESSED.match(path))
+
+def store_media(file, kind_dir, copy=None):
+    """Save an upload under its content hash and return its path under UPLOAD_FOLDER.
+
+    Identical uploads map to the same path, so a repost writes nothing new. The bytes are
+    hashed while being copied to a temporary file, which is then moved into place (or
+    dropped if that content is already stored). copy(src, write), when given, writes a
+    cleaned version of the upload instead (see strip_image_metadata); the hash is of what
+    it writes.
+    """
+    file_ext = file.filename.rsplit('.', 1)[1].lower()
+    # one spelling per format, so the same bytes never get two paths
+    file_ext = {'jpeg': 'jpg'}.get(file_ext, file_ext)
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    if copy is None and hasattr(file.stream, 'move_to'):
+        # already written and hashed while the request was parsed (uploads.UploadSpool)
+        path = media_path(kind_dir, file.stream.sha256, file_ext)
+        final_path = os.path.join(upload_folder, path)
+        if not os.path.exists(final_path):
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            file.stream.move_to(final_path)
+        return path
+    os.makedirs(os.path.join(upload_folder, kind_dir), exist_ok=True)
+    tmp_path = os.path.join(upload_folder, kind_dir, f".{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as out:
+            def write(chunk):
+                digest.update(chunk)
+                out.write(chunk)
+            file.stream.seek(0)
+            (copy or _copy_stream)(file.stream, write)
+        path = media_path(kind_dir, digest.hexdigest(), file_ext)
+        final_path = os.path.join(upload_folder, path)
+        if not os.path.exists(final_path):
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+        return path
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _copy_stream(src, write):
+    for chunk in iter(lambda: src.read(64 * 1024), b''):
+        write(chunk)
+
+def _read_exact(src, size):
+    data = src.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated image')
+    return data
+
+# JPEG segments kept ahead of the image data: JFIF (APP0), ICC profile (APP2), Adobe colour
+# transform (APP14) and everything that isn't an APPn/COM segment (tables, frame header).
+# EXIF/XMP (APP1), IPTC (APP13), other APPn and comments are dropped.
+_JPEG_KEEP_APP = {0xE0: (b'JFIF', b'JFXX'), 0xE2: (b'ICC_PROFILE',), 0xEE: (b'Adobe',)}
+_PNG_TEXT_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'eXIf', b'tIME'}
+EXIF_ORIENTATION = 0x0112
+
+def _strip_jpeg(src, write):
+    write(_read_exact(src, 2))  # SOI
+    while True:
+        marker = _read_exact(src, 2)
+        while marker[1] == 0xFF:  # fill bytes
+            marker = marker[1:] + _read_exact(src, 1)
+        if marker[0] != 0xFF:
+            raise ValueError('Bad JPEG marker')
+        length_bytes = _read_exact(src, 2)
+        body = _read_exact(src, int.from_bytes(length_bytes, 'big') - 2)
+        code = marker[1]
+        if code == 0xE1 and body.startswith(b'Exif\x00\x00'):
+            # keep only the orientation, so the photo still displays upright
+            exif = Image.Exif()
+            try:
+                exif.load(body)
+                orientation = exif.get(EXIF_ORIENTATION)
+            except Exception:
+                orientation = None
+            if orientation and orientation != 1:
+                kept = Image.Exif()
+                kept[EXIF_ORIENTATION] = orientation
+                kept = kept.tobytes()
+                write(marker + (len(kept) + 2).to_bytes(2, 'big') + kept)
+            continue
+        if code == 0xFE or (0xE0 <= code <= 0xEF and not body.startswith(_JPEG_KEEP_APP.get(code, ()))):
+            continue
+        write(marker + length_bytes + body)
+        if code == 0xDA:  # start of scan: the rest is image data
+            _copy_stream(src, write)
+            return
+
+def _strip_png(src, write):
+    write(_read_exact(src, 8))  # signature
+    while True:
+        header = _read_exact(src, 8)
+        length, chunk_type = int.from_bytes(header[:4], 'big'), header[4:]
+        if chunk_type in _PNG_TEXT_CHUNKS:
+            _read_exact(src, length + 4)
+            continue
+        write(header)
+        remaining = length + 4  # data and CRC
+        while remaining:
+            chunk = _read_exact(src, min(remaining, 64 * 1024))
+            write(chunk)
+            remaining -= len(chunk)
+        if chunk_type == b'IEND':
+            return
+
+def _gif_sub_blocks(src, write=None):
+    while True:
+        size = _read_exact(src, 1)
+        data = _read_exact(src, size[0])
+        if write:
+            write(size + data)
+        if not size[0]:
+            return
+
+def _strip_gif(src, write):
+    header = _read_exact(src, 13)  # signature, screen descriptor
+    write(header)
+    if header[10] & 0x80:
+        write(_read_exact(src, 3 << ((header[10] & 7) + 1)))
+    while True:
+        introducer = _read_exact(src, 1)
+        if introducer == b';':  # trailer
+            write(introducer)
+            return
+        if introducer == b'!':
+            label = _read_exact(src, 1)
+            if label == b'\xfe':  # comment
+                _gif_sub_blocks(src)
+                continue
+            if label == b'\xff':
+                app_block = _read_exact(src, 12)  # size byte + application identifier
+                if app_block[1:9] != b'NETSCAPE':  # keep only the animation loop count
+                    _gif_sub_blocks(src)
+                    continue
+                write(introducer + label + app_block)
+            else:
+                write(introducer + label)
+            _gif_sub_blocks(src, write)
+        elif introducer == b',':
+            descriptor = _read_exact(src, 9)
+            write(introducer + descriptor)
+            if descriptor[8] & 0x80:
+                write(_read_exact(src, 3 << ((descriptor[8] & 7) + 1)))
+            write(_read_exact(src, 1))  # LZW minimum code size
+            _gif_sub_blocks(src, write)
+        else:
+            raise ValueError('Bad GIF block')
+
+def strip_image_metadata(src, write):
+    """Copy an image, leaving out EXIF (GPS, camera), XMP, IPTC and comments.
+
+    Works on the file structure, so the pixels are copied byte for byte; a JPEG keeps its
+    EXIF orientation and nothing else. Raises ValueError for an unknown or malformed file.
+    """
+    head = src.read(8)
+    src.seek(0)
+    if head.startswith(b'\xff\xd8'):
+        _strip_jpeg(src, write)
+    elif head.startswith(b'\x89PNG\r\n\x1a\n'):
+        _strip_png(src, write)
+    elif head[:6] in (b'GIF87a', b'GIF89a'):
+        _strip_gif(src, write)
+    else:
+        raise ValueError('Unsupported image format')
+
+def remove_media(upload_folder, path):
+    """Delete a stored upload and any image variants or voice renders written next to it."""
+    stem = os.path.splitext(os.path.join(upload_folder, path))[0]
+    directory = os.path.dirname(stem)
+    name = os.path.basename(stem)
+    if not os.path.isdir(directory):
+        return
+    for entry in os.listdir(directory):
+        if entry == name or entry.startswith(name + '.') or entry.startswith(name + '_'):
+            os.remove(os.path.join(directory, entry))
+
+def is_image(file):
+    """True when an uploaded file has an image extension and its contents parse as one."""
+    if not (file and allowed_file(file.filename, 'image')):
+        return False
+    try:
+        Image.open(file.stream).verify()
+    except Exception:
+        return False
+    finally:
+        file.stream.seek(0)
+    return True
+
+def store_image(file, verified=False):
+    """Save an uploaded image without its metadata and return its path under UPLOAD_FOLDER.
+
+    The file is checked with is_image unless the caller already did (verified). EXIF, XMP
+    and comments are removed before the file is hashed (strip_image_metadata), since the
+    stored file is served as is; resizing and re-encoding happen later in
+    make_image_variants (see media.MediaProcessor).
+    """
+    if file and (verified or is_image(file)):
+        try:
+            return store_media(file, 'images', copy=strip_image_metadata)
+        except ValueError:
+            return None
     return None
 
+def image_variant_path(path, size=None, webp=False):
+    """Path of a variant of a stored image: <name>_<size>.<ext>, or .webp for the WebP copy.
+
+    size None is the upload itself, which is never rewritten so it keeps matching its hash.
+    """
+    stem, ext = os.path.splitext(path)
+    if size:
+        stem = f"{stem}_{size}"
+    return stem + ('.webp' if webp else ext)
+
+def voice_render_path(path, voice_type):
+    """Path of a voice note rendered with a voice effect: <name>_<voice_type>.ogg (see voice.py)."""
+    return f"{os.path.splitext(path)[0]}_{voice_type}.ogg"
+
+def _save_atomic(image, path, **params):
+    # write to a temporary file and swap it in, so readers never see a half-written image
+    tmp_path = f"{path}.tmp"
+    try:
+        image.save(tmp_path, **params)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _resized(image, max_width):
+    if image.width <= max_width:
+        return image
+    ratio = max_width / image.width
+    return image.resize((max_width, max(1, int(image.height * ratio))), Image.Resampling.LANCZOS)
+
+def make_image_variants(file_path, sizes, quality=85, webp=True):
+    """Resize an uploaded image into the sizes {name: max width} next to the original.
+
+    The stored upload is left as it is (its path is its content hash, see store_image); 'full'
+    is written as a variant like the rest. Smaller sizes are only written when the image is
+    wider than them. With webp, each size also gets a .webp copy. Runs in the image worker pool,
+    so it must not touch current_app. Returns {name: width} for the sizes written.
+    """
+    image = Image.open(file_path)
+    image_format = image.format
+    full = _resized(image, sizes.get('full', image.width))
+    variants = {}
+    for name, max_width in sorted(sizes.items(), key=lambda kv: -kv[1]):
+        if name != 'full' and full.width <= max_width:
+            continue
+        variant = full if name == 'full' else _resized(full, max_width)
+        _save_atomic(variant, image_variant_path(file_path, name), format=image_format, optimize=True, quality=quality)
+        if webp:
+            webp_image = variant if variant.mode in ('RGB', 'RGBA') else variant.convert('RGBA')
+            _save_atomic(webp_image, image_variant_path(file_path, name, webp=True), format='WEBP', quality=quality)
+        variants[name] = variant.width
+    return variants
+
 def save_voice(file):
     """Save uploaded voice file and return filename"""
     if file and allowed_file(file.filename, 'voice'):
-        file_ext = file.filename.rsplit('.', 1)[1].lower()
-        filename = f"{uuid.uuid4().hex}.{file_ext}"
-        
-        upload_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'voice')
-        os.makedirs(upload_dir, exist_ok=True)
-        
-        file_path = os.path.join(upload_dir, filename)
-        file.save(file_path)
-        
-        return f"voice/{filename}"
+        return store_media(file, 'voice')
     return None
 
-def generate_voice_modification(audio_path, voice_type):
-    """Placeholder for voice modification"""
-    # In production, integrate with audio processing libraries
-    voice_types = {
-        'cartoon': 'high-pitched, animated',
-        'deep': 'low-pitched, resonant', 
-        'female': 'soft, higher-pitched',
-        'robot': 'mechanical, synthesized'
-    }
-    return voice_types.get(voice_type, 'normal')
-
 def format_timestamp(dt):
     """Format datetime for display"""
     return dt.strftime('%b %d, %Y %I:%M %p')
\ No newline at end of file
@@ -0,0 +1,210 @@
+"""Voice effects for voice notes.
+
+Message.voice_type picks a preset from VOICE_PRESETS. render_voice decodes the stored upload
+to mono PCM with ffmpeg, applies the preset with NumPy (pitch shift, spectral tilt for the
+formant colour, ring modulation for 'robot'), peak-normalizes, caps the length and encodes
+Opus in an Ogg container. It runs in a media.MediaProcessor pool (app.VOICE_PROCESSOR), and
+the render is stored next to the upload (utils.voice_render_path), so each clip is processed
+once per voice type however often it is posted or played.
+
+NumPy and the ffmpeg binary are optional: without them available() is False and voice notes
+are served as uploaded.
+"""
+import os
+import shutil
+import subprocess
+
+try:
+    import numpy as np
+except ImportError:  # voice effects disabled
+    np = None
+
+SAMPLE_RATE = 48000  # Opus' native rate
+FRAME = 2048  # ~43 ms analysis frames for the time stretch
+HOP = FRAME // 4
+BLOCK_FRAMES = 256  # frames transformed at once (~2 MB of complex64 spectra)
+RESAMPLE_BLOCK = 1 << 16
+
+# pitch: frequency ratio; tilt_db: spectral tilt per octave around 1 kHz (brighter > 0);
+# ring_hz: ring-modulation carrier
+VOICE_PRESETS = {
+    'cartoon': {'pitch': 1.7, 'tilt_db': 3.0},
+    'female': {'pitch': 1.35, 'tilt_db': 1.5},
+    'deep': {'pitch': 0.72, 'tilt_db': -2.0},
+    'robot': {'pitch': 0.9, 'ring_hz': 55.0},
+}
+
+
+def available():
+    """True when NumPy and ffmpeg are both installed."""
+    return np is not None and shutil.which('ffmpeg') is not None
+
+
+def decode_pcm(path, rate=SAMPLE_RATE, max_seconds=None):
+    """Decode any audio file to mono float32 samples in [-1, 1], at most max_seconds long."""
+    cmd = ['ffmpeg', '-v', 'error', '-nostdin', '-i', path]
+    if max_seconds:
+        cmd += ['-t', str(max_seconds)]
+    cmd += ['-f', 's16le', '-ac', '1', '-ar', str(rate), '-']
+    pcm = subprocess.run(cmd, capture_output=True, check=True, timeout=120).stdout
+    return np.frombuffer(pcm, dtype='<i2').astype(np.float32) / 32768.0
+
+
+def encode_opus(samples, path, rate=SAMPLE_RATE, bitrate='32k'):
+    """Encode mono float samples to Ogg/Opus at path, written atomically."""
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+    tmp_path = f'{path}.tmp'
+    try:
+        subprocess.run(['ffmpeg', '-v', 'error', '-nostdin', '-y', '-f', 's16le', '-ac', '1', '-ar', str(rate),
+                        '-i', '-', '-c:a', 'libopus', '-b:a', bitrate, '-f', 'ogg', tmp_path],
+                       input=pcm, capture_output=True, check=True, timeout=120)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _window():
+    return np.hanning(FRAME).astype(np.float32)
+
+
+def _overlap_add(out, norm, first, frames, window):
+    """Add frames (FRAME long, HOP apart, the first at frame index first) into out, and their
+    squared window into norm, one HOP-sized slice per overlap instead of one index per sample."""
+    overlap = FRAME // HOP
+    count = len(frames)
+    span = slice(first * HOP, (first + count + overlap - 1) * HOP)
+    target, weight = out[span].reshape(-1, HOP), norm[span].reshape(-1, HOP)
+    parts, window_sq = frames.reshape(count, overlap, HOP), (window ** 2).reshape(overlap, HOP)
+    for q in range(overlap):
+        target[q:q + count] += parts[:, q]
+        weight[q:q + count] += window_sq[q]
+
+
+def _wrap(phase):
+    return (phase + np.float32(np.pi)) % np.float32(2 * np.pi) - np.float32(np.pi)
+
+
+def time_stretch(samples, ratio):
+    """Phase-vocoder time stretch: about ratio times as long, same pitch.
+
+    Frames are read every HOP / ratio samples and written every HOP samples; each bin's phase
+    is advanced by its measured frequency so the overlapping frames stay coherent. Frames are
+    transformed BLOCK_FRAMES at a time in float32/complex64, carrying the last frame's phases
+    into the next block, so memory stays at a few MB besides the output.
+    """
+    if ratio == 1 or len(samples) < FRAME:
+        return samples
+    samples = np.asarray(samples, dtype=np.float32)
+    starts = np.unique(np.arange(0, len(samples) - FRAME + 1, HOP / ratio).astype(np.int64))
+    window = _window()
+    omega = (2 * np.pi * np.arange(FRAME // 2 + 1) / FRAME).astype(np.float32)  # bin centre, radians per sample
+    out_len = (len(starts) - 1) * HOP + FRAME
+    out = np.zeros(out_len, dtype=np.float32)
+    norm = np.zeros(out_len, dtype=np.float32)
+    offsets = np.arange(FRAME)
+    last_phase = last_start = out_phase = None
+    for first in range(0, len(starts), BLOCK_FRAMES):
+        block = starts[first:first + BLOCK_FRAMES]
+        spectra = np.fft.rfft(samples[block[:, None] + offsets] * window, axis=1).astype(np.complex64)
+        phases = np.angle(spectra)
+        previous = np.vstack([phases[:1] if last_phase is None else last_phase[None], phases[:-1]])
+        read_hops = np.maximum(np.diff(block, prepend=block[0] if last_start is None else last_start), 1)
+        read_hops = read_hops[:, None].astype(np.float32)
+        deviation = _wrap(phases - previous - omega * read_hops)
+        # wrapped before summing so float32 keeps its precision over long clips
+        advance = _wrap((omega + deviation / read_hops) * HOP)
+        if out_phase is None:
+            advance[0], out_phase = 0, phases[0]
+        synth = out_phase + np.cumsum(advance, axis=0)
+        frames = np.fft.irfft(np.abs(spectra) * np.exp(1j * synth).astype(np.complex64), n=FRAME, axis=1)
+        _overlap_add(out, norm, first, frames.astype(np.float32) * window, window)
+        last_phase, last_start, out_phase = phases[-1], block[-1], _wrap(synth[-1])
+    out /= np.maximum(norm, np.float32(1e-3))
+    return out
+
+
+def _resample(samples, length):
+    """Linearly resample to length points, RESAMPLE_BLOCK output samples at a time."""
+    out = np.empty(length, dtype=np.float32)
+    step = (len(samples) - 1) / max(length - 1, 1)
+    for first in range(0, length, RESAMPLE_BLOCK):
+        positions = np.arange(first, min(first + RESAMPLE_BLOCK, length)) * step
+        index = np.minimum(positions.astype(np.int64), len(samples) - 2)
+        frac = (positions - index).astype(np.float32)
+        out[first:first + len(positions)] = samples[index] * (1 - frac) + samples[index + 1] * frac
+    return out
+
+
+def pitch_shift(samples, factor):
+    """Shift pitch by factor, keeping the duration: stretch by factor, then resample back.
+
+    The stretched signal's length only approximates len(samples) * factor; resampling it to
+    exactly len(samples) keeps the duration and scales every frequency by that ratio.
+    """
+    if factor == 1 or len(samples) < FRAME:
+        return samples
+    return _resample(time_stretch(samples, factor), len(samples))
+
+
+def spectral_tilt(samples, db_per_octave, rate=SAMPLE_RATE):
+    """Tilt the spectrum around 1 kHz, a cheap stand-in for moving the formants.
+
+    Applied per frame (windowed overlap-add, BLOCK_FRAMES frames at a time) rather than as one
+    FFT of the whole clip, to keep memory bounded.
+    """
+    if not db_per_octave or len(samples) < FRAME:
+        return samples
+    freqs = np.fft.rfftfreq(FRAME, 1.0 / rate)
+    octaves = np.log2(np.maximum(freqs, 50.0) / 1000.0)
+    gains = np.clip(10 ** (db_per_octave * octaves / 20), 0.1, 8.0).astype(np.float32)
+    # pad so every sample is covered by the full set of overlapping frames
+    pad = FRAME - HOP
+    padded = np.concatenate([np.zeros(pad, np.float32), np.asarray(samples, np.float32), np.zeros(FRAME, np.float32)])
+    n_frames = (len(padded) - FRAME) // HOP + 1
+    window = _window()
+    out = np.zeros((n_frames - 1) * HOP + FRAME, dtype=np.float32)
+    norm = np.zeros_like(out)
+    offsets = np.arange(FRAME)
+    for first in range(0, n_frames, BLOCK_FRAMES):
+        block = np.arange(first, min(first + BLOCK_FRAMES, n_frames)) * HOP
+        spectra = np.fft.rfft(padded[block[:, None] + offsets] * window, axis=1).astype(np.complex64)
+        frames = np.fft.irfft(spectra * gains, n=FRAME, axis=1).astype(np.float32) * window
+        _overlap_add(out, norm, first, frames, window)
+    out /= np.maximum(norm, np.float32(1e-3))
+    return out[pad:pad + len(samples)]
+
+
+def ring_modulate(samples, carrier_hz, rate=SAMPLE_RATE):
+    t = np.arange(len(samples), dtype=np.float32) / rate
+    return samples * np.sin(2 * np.pi * carrier_hz * t, dtype=np.float32)
+
+
+def normalize(samples, peak=0.89):
+    """Scale so the loudest sample sits at peak (about -1 dBFS)."""
+    loudest = float(np.max(np.abs(samples))) if len(samples) else 0.0
+    return samples * (peak / loudest) if loudest > 0 else samples
+
+
+def apply_preset(samples, voice_type, rate=SAMPLE_RATE):
+    preset = VOICE_PRESETS[voice_type]
+    samples = pitch_shift(samples, preset.get('pitch', 1.0))
+    samples = spectral_tilt(samples, preset.get('tilt_db', 0.0), rate)
+    if preset.get('ring_hz'):
+        samples = ring_modulate(samples, preset['ring_hz'], rate)
+    return normalize(samples)
+
+
+def render_voice(src_path, dst_path, voice_type, max_seconds=120, bitrate='32k'):
+    """Render src_path with voice_type's preset to an Ogg/Opus file at dst_path.
+
+    Clips are cut at max_seconds, so with a fixed bitrate a render never exceeds about
+    max_seconds * bitrate / 8 bytes. Runs in a worker pool: must not touch current_app.
+    Returns {'voice_type', 'seconds', 'bytes'}.
+    """
+    samples = decode_pcm(src_path, max_seconds=max_seconds)
+    if not len(samples):
+        raise ValueError(f'No audio decoded from {src_path}')
+    encode_opus(apply_preset(samples, voice_type), dst_path, bitrate=bitrate)
+    return {'voice_type': voice_type, 'seconds': round(len(samples) / SAMPLE_RATE, 2),
+            'bytes': os.path.getsize(dst_path)}